@@ -12,7 +12,9 @@ from geordash.georchestraconfig import GeorchestraConfig
 from geordash.result_backend.redisbackend import RedisClient
 from geordash.checks.mapstore import MapstoreChecker
 from geordash.checks.gn_datadir import GeonetworkDatadirChecker
+from geordash.linkcheck import LinkChecker
 from geordash.decorators import is_superuser
+from geordash.metrics import metrics
 from config import url as redisurl
 import threading
 import logging
@@ -86,15 +88,33 @@ def create_app() -> Flask:
     conf = GeorchestraConfig()
     app.extensions["conf"] = conf
     app.extensions["owscache"] = OwsCapCache(conf, app)
+    # flags expired capabilities served in stale-while-revalidate mode
+    app.jinja_env.filters["stale"] = app.extensions["owscache"].is_stale
     app.extensions["msc"] = MapstoreChecker(conf)
     app.extensions["gndc"] = GeonetworkDatadirChecker(conf)
     app.extensions["rcli"] = RedisClient(redisurl)
+    app.extensions["linkcheck"] = LinkChecker(redisurl)
     from . import views, api, admin, dashboard
 
     dashboard.dash_bp.register_blueprint(views.tasks_bp)
     dashboard.dash_bp.register_blueprint(api.api_bp)
     dashboard.dash_bp.register_blueprint(admin.admin_bp)
     app.register_blueprint(dashboard.dash_bp)
+
+    @app.cli.command("warmup-cache")
+    def warmup_cache_command():
+        """prefetch the capabilities of all the services referenced by
+        mapstore, mviewer, the csw records and the beat schedule"""
+        from geordash.tasks.capabilities import warmup
+
+        r = warmup(lambda current, total: print(f"{current}/{total}", end="\r"))
+        for t in r["timings"]:
+            print(
+                f"{t['duration']:.2f}s {t['stype']} {t['url']}: "
+                + (t["exception"] or f"{t['nelems']} elements")
+            )
+        print(f"{r['failed']} failures, took {r['duration']:.2f}s")
+
     return app
 
 
@@ -102,7 +122,8 @@ def celery_init_app(app: Flask) -> Celery:
     class FlaskTask(Task):
         def __call__(self, *args: object, **kwargs: object) -> object:
             with app.app_context():
-                return self.run(*args, **kwargs)
+                with metrics.timer("gaia_task_seconds", task=self.name):
+                    return self.run(*args, **kwargs)
 
     celery_app = Celery(app.name, task_cls=FlaskTask)
     celery_app.config_from_object("geordash.celeryconfig")
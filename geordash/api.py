@@ -8,6 +8,9 @@ from flask import current_app as app
 import requests
 import json
 
+from geordash.utils import unmunge
+from geordash.checks.ows import probe_history
+
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
 
@@ -301,3 +304,23 @@ def geoserver_workspaces():
     if workspaces.status_code != 200:
         return workspaces.text
     return workspaces.json()
+
+
+@api_bp.route("/ows/<string:stype>/<string:url>/<string:lname>/probetimes.json")
+def ows_probetimes(stype, url, lname):
+    """
+    Get the timings of the last GetMap/GetFeature/GetTile probes of a layer,
+    by operation and sampled wmts tilematrix, most recent first, as recorded
+    by the owslayer checks
+    """
+    if stype not in ("wms", "wmts", "wfs"):
+        return abort(412)
+    url = unmunge(url)
+    return jsonify(
+        {
+            "stype": stype,
+            "url": url,
+            "layername": lname,
+            "probes": probe_history(stype, url, lname),
+        }
+    )
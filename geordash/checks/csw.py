@@ -2,13 +2,12 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
-import requests
-
 from flask import current_app as app
 from celery import shared_task
 from celery import group
 from owslib.ows import ExceptionReport
 from geordash.logwrap import get_logger
+from geordash.metrics import metrics
 from geordash.utils import objtype
 
 
@@ -66,7 +65,10 @@ def check_record(url, uuid):
 
     csw = service.s
     try:
-        csw.getrecordbyid([uuid])
+        with metrics.timer(
+            "gaia_probe_seconds", check="check_record", operation="GetRecordById"
+        ):
+            csw.getrecordbyid([uuid])
     except ExceptionReport as e:
         # most probably owslib.ows.ExceptionReport: 'OperationNotAllowedEx : Operation not allowed'
         ret["problems"].append(
@@ -101,7 +103,7 @@ def check_record(url, uuid):
                 url = url.removeprefix(localdomain)
             lname = u["name"]
             service = app.extensions["owscache"].get(stype, url)
-            if service.s is None:
+            if service.exception is not None:
                 ret["problems"].append(
                     {
                         "type": "OGCException",
@@ -116,13 +118,14 @@ def check_record(url, uuid):
                     stype == "wfs"
                     and lname
                     and ":" not in lname
-                    and service.s.updateSequence
-                    and service.s.updateSequence.isdigit()
+                    and service.updatesequence()
+                    and service.updatesequence().isdigit()
                 ):
                     ws = url.split("/")[-2]
                     lname = f"{ws}:{lname}"
                     get_logger("CheckCsw").debug(f"modified lname for {lname}")
-                if lname not in service.contents():
+                exists = app.extensions["owscache"].has_layers(stype, url, [lname])
+                if not exists or not exists[lname]:
                     ret["problems"].append(
                         {
                             "type": "NoSuchLayer",
@@ -145,44 +148,32 @@ def check_record(url, uuid):
                 )
                 and (u["url"] != None and u["url"].startswith("http"))
             ):
-                # check that the url exists
-                try:
-                    timeout = 5
-                    if "outputformat=shape-zip" in u["url"].lower():
-                        timeout = 60
-                    if "@" in u["url"]:
-                        from urllib.parse import urlparse
-                        from requests.auth import HTTPBasicAuth
-
-                        parts = urlparse(u["url"])
-                        r = requests.head(
-                            u["url"],
-                            timeout=timeout,
-                            auth=HTTPBasicAuth(parts.username, parts.password),
-                        )
-                    else:
-                        r = requests.head(u["url"], timeout=timeout)
-                    if r.status_code != 200 and r.status_code != 429:
-                        ret["problems"].append(
-                            {
-                                "type": "BrokenProtocolUrl",
-                                "url": u["url"],
-                                "protocol": u["protocol"],
-                                "code": r.status_code,
-                            }
-                        )
-                    else:
-                        hasvalidlink = True
-                    get_logger("CheckCsw").debug(f"{u['url']} -> {r.status_code}")
-                except Exception as e:
+                # check that the url exists, credentials in the url are sent as basic auth
+                timeout = 5
+                if "outputformat=shape-zip" in u["url"].lower():
+                    timeout = 60
+                r = app.extensions["linkcheck"].check(u["url"], timeout)
+                if r["exception"] is not None:
                     ret["problems"].append(
                         {
                             "type": "ConnectionFailure",
                             "url": u["url"],
-                            "exception": objtype(e),
-                            "exceptionstr": str(e),
+                            "exception": r["exception"],
+                            "exceptionstr": r["exceptionstr"],
                         }
                     )
+                elif r["code"] != 200 and r["code"] != 429:
+                    ret["problems"].append(
+                        {
+                            "type": "BrokenProtocolUrl",
+                            "url": u["url"],
+                            "protocol": u["protocol"],
+                            "code": r["code"],
+                        }
+                    )
+                else:
+                    hasvalidlink = True
+                get_logger("CheckCsw").debug(f"{u['url']} -> {r['code']}")
             elif u["protocol"] != None and u["url"] == None:
                 ret["problems"].append({"type": "EmptyUrl", "protocol": u["protocol"]})
             else:
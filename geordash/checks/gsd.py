@@ -6,7 +6,6 @@ from celery import shared_task
 from celery import group
 from flask import current_app as app
 from osgeo.ogr import Open
-import requests
 
 from gsdscanner import GSDatadirScanner
 from gsdscanner.datastore import Datastore
@@ -175,20 +174,19 @@ def check_coveragestore(
 
 def check_mdlink_resolves(m: dict):
     mdurl = m["url"]
-    try:
-        r = requests.head(mdurl)
-        if r.status_code != 200:
-            return {
-                "type": "BrokenMetadataUrl",
-                "url": mdurl,
-                "code": r.status_code,
-            }
-    except Exception as e:
+    r = app.extensions["linkcheck"].check(mdurl)
+    if r["exception"] is not None:
         return {
             "type": "ConnectionFailure",
             "url": mdurl,
-            "exception": objtype(e),
-            "exceptionstr": str(e),
+            "exception": r["exception"],
+            "exceptionstr": r["exceptionstr"],
+        }
+    if r["code"] != 200:
+        return {
+            "type": "BrokenMetadataUrl",
+            "url": mdurl,
+            "code": r["code"],
         }
     return True
 
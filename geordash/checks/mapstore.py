@@ -8,7 +8,6 @@ from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.exc import NoResultFound, OperationalError
 from sqlalchemy.orm import sessionmaker
 import json
-import requests
 from os import getenv
 
 from owslib.wms import WebMapService
@@ -21,6 +20,8 @@ from celery import shared_task
 from celery import Task
 from celery import group
 from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.httpclient import session
 from geordash.utils import objtype, normalize_gs_workspace_layer
 
 
@@ -209,8 +210,11 @@ def check_layers(layers, rescat, resid):
                         l["type"], l["name"], l["url"], l["id"]
                     )
                 )
-                s = app.extensions["owscache"].get(l["type"], l["url"])
-                if s.s is None:
+                exists = app.extensions["owscache"].has_layers(
+                    l["type"], l["url"], [l["name"]]
+                )
+                if exists is None:
+                    s = app.extensions["owscache"].get(l["type"], l["url"])
                     ret.append(
                         {
                             "type": "OGCException",
@@ -221,12 +225,7 @@ def check_layers(layers, rescat, resid):
                         }
                     )
                 else:
-                    get_logger("CheckMapstore").debug(
-                        "checking for layer presence in ows entry with ts {}".format(
-                            s.timestamp
-                        )
-                    )
-                    if l["name"] not in s.contents():
+                    if not exists[l["name"]]:
                         ret.append(
                             {
                                 "type": "NoSuchLayer",
@@ -237,7 +236,10 @@ def check_layers(layers, rescat, resid):
                         )
             case "3dtiles" | "cog":
                 try:
-                    response = requests.head(l["url"], allow_redirects=True)
+                    with metrics.timer(
+                        "gaia_probe_seconds", check="check_layers", operation="HEAD"
+                    ):
+                        response = session().head(l["url"], allow_redirects=True)
                     if response.status_code != 200:
                         ret.append(
                             {
@@ -285,7 +287,7 @@ def check_catalogs(catalogs):
                     )
             case "3dtiles" | "cog":
                 try:
-                    response = requests.head(c["url"], allow_redirects=True)
+                    response = session().head(c["url"], allow_redirects=True)
                     if response.status_code != 200:
                         ret.append(
                             {
@@ -2,13 +2,12 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
-import requests
-
 from flask import current_app as app
 from celery import shared_task
 from celery import Task
 from celery import group
 from geordash.logwrap import get_logger
+from geordash.httpclient import session
 from geordash.mviewer import parse_map
 from geordash.utils import unmunge, objtype
 
@@ -30,7 +29,7 @@ def check_all():
 
 @shared_task()
 def check_mviewer(url):
-    r = requests.get(url)
+    r = session().get(url)
     if r.status_code != 200:
         return {
             "problems": [{"type": "NoSuchResource", "restype": "mviewer", "resid": url}]
@@ -48,8 +47,11 @@ def check_mviewer(url):
                         l["type"], l["name"], l["url"]
                     )
                 )
-                s = app.extensions["owscache"].get(l["type"], l["url"])
-                if s.s is None:
+                exists = app.extensions["owscache"].has_layers(
+                    l["type"], l["url"], [l["name"]]
+                )
+                if exists is None:
+                    s = app.extensions["owscache"].get(l["type"], l["url"])
                     ret["problems"].append(
                         {
                             "type": "OGCException",
@@ -60,12 +62,7 @@ def check_mviewer(url):
                         }
                     )
                 else:
-                    get_logger("CheckMviewer").debug(
-                        "checking for layer presence in ows entry with ts {}".format(
-                            s.timestamp
-                        )
-                    )
-                    if l["name"] not in s.contents():
+                    if not exists[l["name"]]:
                         ret["problems"].append(
                             {
                                 "type": "NoSuchLayer",
@@ -76,14 +73,14 @@ def check_mviewer(url):
                         )
                     if "styles" in l:
                         for s in l["styles"]:
-                            r = requests.head(s, allow_redirects=True)
+                            r = session().head(s, allow_redirects=True)
                             if r.status_code != 200:
                                 ret["problems"].append({"type": "NoSuchSld", "url": s})
                             else:
                                 pass
                                 # check that r.text is parsable sld ?
                     if l["templateurl"]:
-                        r = requests.head(l["templateurl"], allow_redirects=True)
+                        r = session().head(l["templateurl"], allow_redirects=True)
                         if r.status_code != 200:
                             ret["problems"].append(
                                 {
@@ -2,21 +2,90 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
-import requests
 from requests.exceptions import ReadTimeout
 
 from celery import shared_task
 from celery import Task
 from celery import group
+from concurrent.futures import ThreadPoolExecutor
+from time import time, perf_counter
+import threading
+import json
+import math
+import statistics
 
 from flask import current_app as app
 from geordash.utils import find_localmduuid, unmunge, objtype
 from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.httpclient import session, owslib_session
+from geordash.probes import probe_concurrently
+from geordash.imagestats import image_stats
 
 import xml.etree.ElementTree as ET
-from lxml.etree import XMLSyntaxError
 from owslib.util import ServiceException
 
+# owsservice checks the layers by chunks of BATCH_SIZE layers per task, with
+# BATCH_WORKERS layers of a chunk checked concurrently
+BATCH_SIZE = 20
+BATCH_WORKERS = 4
+# the local csw service object is shared by the threads checking a chunk
+csw_lock = threading.Lock()
+# amount of uuids per GetRecordById request in the owsservice pre-pass
+MDUUIDS_BATCH = 50
+# lifetime of the map of the existing local metadata uuids of a service
+MDUUIDS_TTL = 6 * 3600
+# the last check of each layer is kept for incremental owsservice runs, until
+# the service isnt checked for that long
+LAYERSTATE_TTL = 30 * 86400
+# share of the unchanged layers checked again by an incremental owsservice run
+SAMPLE_RATIO = 0.1
+# amount of layers per carry_owslayers task of an incremental owsservice run
+CARRY_CHUNK = 100
+# celery truncates the repr of task args longer than 1024 chars in the
+# task-sent events parsed by CeleryEventsHandler, so the chunks of layer names
+# passed to a task are also cut to keep their args under ARGSREPR_MAX chars
+ARGSREPR_MAX = 1000
+# the response to a GetFeature probe is only read until its root element, up
+# to WFS_MAX_BYTES bytes and for WFS_MAX_SECONDS seconds
+WFS_MAX_BYTES = 256 * 1024
+WFS_MAX_SECONDS = 30
+# length of the excerpts of the responses kept in the problems
+EXCERPT_LENGTH = 2048
+# amount of levels of each tilematrixset probed on wmts layers, 0 to only
+# probe the center tile of the last level of the first tilematrixset
+WMTS_SAMPLE_LEVELS = 0
+# amount of probes kept in the timings history of each layer
+PROBE_HISTORY = 50
+# a probe slower than SLOW_THRESHOLD seconds, or than SLOW_FACTOR times the
+# median of the previous probes of the layer (once there are SLOW_MIN_SAMPLES
+# of them) is reported as a SlowResponse. probes faster than SLOW_MIN_LATENCY
+# seconds are never reported, whatever their median
+SLOW_THRESHOLD = 10
+SLOW_FACTOR = 3
+SLOW_MIN_SAMPLES = 5
+SLOW_MIN_LATENCY = 1
+# decode the images returned by the GetMap/GetTile probes to detect blank
+# ones (needs numpy and pillow, cf geordash/imagestats.py)
+BLANK_IMAGE_CHECK = False
+
+# the settings above can be overridden in config.py, read once at import
+try:
+    import config
+
+    BATCH_SIZE = getattr(config, "owslayer_batch_size", BATCH_SIZE)
+    BATCH_WORKERS = getattr(config, "owslayer_batch_workers", BATCH_WORKERS)
+    SAMPLE_RATIO = getattr(config, "owsservice_sample_ratio", SAMPLE_RATIO)
+    WFS_MAX_BYTES = getattr(config, "wfs_probe_max_bytes", WFS_MAX_BYTES)
+    WFS_MAX_SECONDS = getattr(config, "wfs_probe_max_seconds", WFS_MAX_SECONDS)
+    WMTS_SAMPLE_LEVELS = getattr(config, "wmts_sample_levels", WMTS_SAMPLE_LEVELS)
+    PROBE_HISTORY = getattr(config, "owslayer_probe_history", PROBE_HISTORY)
+    SLOW_THRESHOLD = getattr(config, "owslayer_slow_threshold", SLOW_THRESHOLD)
+    SLOW_FACTOR = getattr(config, "owslayer_slow_factor", SLOW_FACTOR)
+    BLANK_IMAGE_CHECK = getattr(config, "owslayer_blank_image_check", BLANK_IMAGE_CHECK)
+except ImportError:
+    pass
+
 
 def find_tilematrix_center(wmts, lname):
     """
@@ -68,20 +137,68 @@ def reduced_bbox(bbox):
 
 
 @shared_task()
-def owsservice(stype, url):
+def owsservice(stype, url, incremental=False):
+    """
+    checks all the layers of a service, in one owslayers task per chunk of
+    owslayer_batch_size layers, or one owslayer task per layer if set to 1.
+    if incremental, only the new, changed and previously failing layers are
+    checked, with a sample of the others (cf incremental_selection). the last
+    results of the layers which arent checked are carried forward in the
+    taskset by carry_owslayers tasks.
+    """
     service = app.extensions["owscache"].get(stype, url, True)
     if service.s is None:
         get_logger("CheckOws").error(f"Found no cache entry for {stype} at {url}")
         return False
+    lnames = list(service.contents())
+    carried = dict()
+    if incremental:
+        lnames, carried = incremental_selection(stype, unmunge(url), service)
+    prune_layerstates(stype, unmunge(url), service)
+    mdexists = resolve_localmduuids(service, lnames)
+    if mdexists:
+        key = mdexists_key(stype, unmunge(url))
+        p = app.extensions["owscache"].rediscli.pipeline()
+        p.delete(key)
+        p.hset(key, mapping={u: int(e) for u, e in mdexists.items()})
+        p.expire(key, MDUUIDS_TTL)
+        p.execute()
     taskslist = list()
-    for lname in service.contents():
-        taskslist.append(owslayer.s(stype, url, lname))
+    if BATCH_SIZE > 1:
+        for chunk in layernames_chunks(stype, url, lnames, BATCH_SIZE):
+            taskslist.append(owslayers.s(stype, url, chunk))
+    else:
+        for lname in lnames:
+            taskslist.append(owslayer.s(stype, url, lname))
+    for chunk in layernames_chunks(stype, url, list(carried.keys()), CARRY_CHUNK):
+        taskslist.append(carry_owslayers.s(stype, url, chunk))
     grouptask = group(taskslist)
     groupresult = grouptask.apply_async()
     groupresult.save()
     return groupresult
 
 
+def layernames_chunks(stype, url, lnames, size):
+    """
+    splits layer names in chunks of at most size names, whose (stype, url,
+    names) task args have a repr shorter than ARGSREPR_MAX chars. a single
+    name longer than that still gets its own chunk
+    """
+    chunk = list()
+    length = len(repr((stype, url, chunk)))
+    for lname in lnames:
+        # the name and its ', ' separator
+        nlen = len(repr(lname)) + 2
+        if len(chunk) > 0 and (len(chunk) == size or length + nlen > ARGSREPR_MAX):
+            yield chunk
+            chunk = list()
+            length = len(repr((stype, url, chunk)))
+        chunk.append(lname)
+        length += nlen
+    if len(chunk) > 0:
+        yield chunk
+
+
 @shared_task()
 def owslayer(stype, url, layername, single=False):
     """
@@ -94,164 +211,809 @@ def owslayer(stype, url, layername, single=False):
     :return: the list of errors
     """
     get_logger("CheckOws").info(f"checking layer {layername} in {stype} {url}")
-    ret = dict()
-    ret["problems"] = list()
     url = unmunge(url)
     service = app.extensions["owscache"].get(stype, url, single)
     if service.s is None:
         get_logger("CheckOws").error(f"Found no cache entry for {stype} at {url}")
         return False
+    mdexists = None
+    if not single:
+        mdexists = cached_mdexists(stype, url, find_localmduuid(service.s, layername))
+    ret = check_layer(stype, url, service, layername, mdexists)
+    record_layerstates(stype, url, service, {layername: ret})
+    return ret
+
+
+@shared_task()
+def owslayers(stype, url, layernames):
+    """
+    checks a chunk of layers from the same service, against a single
+    capabilities object, with the metadata of up to owslayer_batch_workers
+    layers checked concurrently, and the ows operations of all the layers
+    probed concurrently (cf geordash/probes.py). the results of each layer can be fetched from
+    /tasks/result/<taskid>:<layername>
+    :return: the problems of all the layers, and by layer name
+    """
+    get_logger("CheckOws").info(f"checking {len(layernames)} layers in {stype} {url}")
+    url = unmunge(url)
+    service = app.extensions["owscache"].get(stype, url)
+    if service.s is None:
+        get_logger("CheckOws").error(f"Found no cache entry for {stype} at {url}")
+        return False
+    uuids = set()
+    for layername in layernames:
+        if layername in service.contents():
+            uuids |= find_localmduuid(service.s, layername)
+    mdexists = cached_mdexists(stype, url, uuids)
+    flask_app = app._get_current_object()
+
+    def check(layername):
+        # the pool threads dont inherit the task app context
+        with flask_app.app_context():
+            try:
+                return (
+                    layername,
+                    check_layer(stype, url, service, layername, mdexists, False),
+                    True,
+                )
+            except Exception as e:
+                return (
+                    layername,
+                    {"problems": [check_exception(stype, url, layername, "check", e)]},
+                    False,
+                )
+
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS)) as pool:
+        checked = list(pool.map(check, layernames))
+    layers = {layername: r for (layername, r, ok) in checked}
+    # then probe all the layers of the chunk at once
+    probe_layers(stype, url, service, {n: r for (n, r, ok) in checked if ok})
+    record_layerstates(stype, url, service, layers)
+    return {
+        "problems": [p for r in layers.values() for p in r["problems"]],
+        "layers": layers,
+    }
+
+
+@shared_task()
+def carry_owslayers(stype, url, layernames):
+    """
+    returns the results of the last check of layers skipped by an incremental
+    owsservice run (the problems found and when it was checked, as kept by
+    record_layerstates), in the same form as an owslayers chunk
+    """
+    url = unmunge(url)
+    states = app.extensions["owscache"].rediscli.hmget(
+        layerstate_key(stype, url), layernames
+    )
+    layers = dict()
+    for lname, state in zip(layernames, states):
+        if state is None:
+            get_logger("CheckOws").warning(
+                f"last check of {lname} in {stype} {url} is gone, not carried forward"
+            )
+            continue
+        state = json.loads(state)
+        layers[lname] = {"problems": state["problems"], "checked": state["checked"]}
+    return {
+        "problems": [p for r in layers.values() for p in r["problems"]],
+        "layers": layers,
+    }
+
+
+def layerstate_key(stype, url):
+    return f"layerstate-{stype}-{url.replace('/','~')}"
+
+
+def record_layerstates(stype, url, service, layers):
+    """
+    keeps the results of the check of layers, along with the fingerprint the
+    layers had in the capabilities when checked
+    """
+    fingerprints = service.fingerprints()
+    now = time()
+    key = layerstate_key(stype, url)
+    p = app.extensions["owscache"].rediscli.pipeline()
+    p.hset(
+        key,
+        mapping={
+            lname: json.dumps(
+                {
+                    "fingerprint": fingerprints.get(lname),
+                    "checked": now,
+                    "problems": r["problems"],
+                }
+            )
+            for lname, r in layers.items()
+        },
+    )
+    p.expire(key, LAYERSTATE_TTL)
+    p.execute()
+
+
+def prune_layerstates(stype, url, service):
+    """
+    forgets the last check of the layers removed from the service
+    """
+    key = layerstate_key(stype, url)
+    rediscli = app.extensions["owscache"].rediscli
+    removed = [
+        n.decode() for n in rediscli.hkeys(key) if n.decode() not in service.contents()
+    ]
+    if removed:
+        rediscli.hdel(key, *removed)
+
+
+def incremental_selection(stype, url, service):
+    """
+    selects the layers of a service to check in an incremental run: the new
+    ones, the ones whose fingerprint changed since their last check, the ones
+    which had problems, and the owsservice_sample_ratio share of the others
+    checked the longest time ago, so that all the layers are eventually
+    checked again
+    :return: the names of the layers to check, and the last results of the
+    others by layer name
+    """
+    lnames = list(service.contents())
+    fingerprints = service.fingerprints()
+    states = app.extensions["owscache"].rediscli.hmget(
+        layerstate_key(stype, url), lnames
+    )
+    tocheck = list()
+    unchanged = dict()
+    new, changed, failed = (0, 0, 0)
+    for lname, state in zip(lnames, states):
+        if state is None:
+            new += 1
+            tocheck.append(lname)
+            continue
+        state = json.loads(state)
+        if state["fingerprint"] != fingerprints.get(lname):
+            changed += 1
+            tocheck.append(lname)
+        elif len(state["problems"]) > 0:
+            failed += 1
+            tocheck.append(lname)
+        else:
+            unchanged[lname] = state
+    sample = sorted(unchanged, key=lambda n: unchanged[n]["checked"])[
+        : math.ceil(len(unchanged) * SAMPLE_RATIO)
+    ]
+    tocheck += sample
+    carried = {
+        n: {"problems": s["problems"], "checked": s["checked"]}
+        for n, s in unchanged.items()
+        if n not in sample
+    }
+    get_logger("CheckOws").info(
+        f"incremental check of {stype} {url}: {new} new, {changed} changed, {failed} failing and {len(sample)} sampled layers to check, {len(carried)} carried forward"
+    )
+    return (tocheck, carried)
+
+
+def check_exception(stype, url, layername, operation, e):
+    """
+    returns the problem reported for a layer whose check failed with an
+    unexpected exception
+    """
+    get_logger("CheckOws").error(
+        f"checking {layername} in {stype} {url} failed with {objtype(e)} {str(e)}"
+    )
+    return {
+        "type": "ServiceException",
+        "operation": operation,
+        "layername": layername,
+        "stype": stype,
+        "url": url,
+        "e": objtype(e),
+        "estr": str(e),
+    }
+
+
+def mdexists_key(stype, url):
+    return f"mduuids-{stype}-{url.replace('/', '~')}"
+
+
+def local_csw():
+    localgn = app.extensions["conf"].get("localgn", "urls")
+    return app.extensions["owscache"].get("csw", "/" + localgn + "/srv/fre/csw")
+
+
+def resolve_localmduuids(service, lnames):
+    """
+    gathers the local metadata uuids referenced by the layers of a service,
+    and finds which ones exist in the local csw: from its cached records if it
+    was harvested, the others with GetRecordById requests for MDUUIDS_BATCH
+    uuids at a time
+    :return: a dict with a boolean by uuid, without the uuids whose request
+    failed
+    """
+    uuids = set()
+    for lname in lnames:
+        uuids |= find_localmduuid(service.s, lname)
+    if len(uuids) == 0:
+        return dict()
+    cswservice = local_csw()
+    if cswservice.s is None:
+        return dict()
+    mdexists = dict()
+    if cswservice.records is not None:
+        # records added since the last sync are still looked up below
+        known = set(cswservice.records)
+        mdexists = {u: True for u in uuids if u in known}
+    unknown = sorted(uuids - mdexists.keys())
+    for i in range(0, len(unknown), MDUUIDS_BATCH):
+        batch = unknown[i : i + MDUUIDS_BATCH]
+        try:
+            with csw_lock, metrics.timer(
+                "gaia_probe_seconds", check="owsservice", operation="GetRecordById"
+            ), owslib_session():
+                cswservice.s.getrecordbyid(batch, esn="brief")
+                records = cswservice.s.records
+        except Exception as e:
+            get_logger("CheckOws").error(
+                f"exception {str(e)} on getrecordbyid() for {len(batch)} uuids"
+            )
+            continue
+        for u in batch:
+            mdexists[u] = u in records
+    get_logger("CheckOws").info(
+        f"{len([e for e in mdexists.values() if e])} of the {len(uuids)} local metadata uuids referenced by {service.url} exist"
+    )
+    return mdexists
+
+
+def cached_mdexists(stype, url, uuids):
+    """
+    returns the existence of the given uuids, as found by the last owsservice
+    pre-pass on that service
+    """
+    if len(uuids) == 0:
+        return dict()
+    uuids = list(uuids)
+    r = app.extensions["owscache"].rediscli.hmget(mdexists_key(stype, url), uuids)
+    return {u: e == b"1" for u, e in zip(uuids, r) if e is not None}
+
+
+def check_layer(stype, url, service, layername, mdexists=None, run_probes=True):
+    """
+    runs the checks of owslayer on a layer of an already fetched service.
+    mdexists gives the existence of local metadata uuids resolved beforehand,
+    the others are looked up in the local csw. without run_probes, the ows
+    operation isnt tested, owslayers probes all the layers of a chunk at once
+    (cf probe_layers)
+    """
+    ret = dict()
+    ret["problems"] = list()
     l = service.contents()[layername]
     if hasattr(l, "metadataUrls"):
         for m in l.metadataUrls:
             mdurl = m["url"]
             # check first that the url exists
-            try:
-                r = requests.head(mdurl)
-                if r.status_code != 200:
-                    ret["problems"].append(
-                        {
-                            "type": "BrokenMetadataUrl",
-                            "url": mdurl,
-                            "code": r.status_code,
-                        }
-                    )
-                get_logger("CheckOws").debug(f"{mdurl} -> {r.status_code}")
-            except Exception as e:
+            r = app.extensions["linkcheck"].check(mdurl)
+            if r["exception"] is not None:
                 ret["problems"].append(
                     {
                         "type": "ConnectionFailure",
                         "url": mdurl,
-                        "exception": objtype(e),
-                        "exceptionstr": str(e),
+                        "exception": r["exception"],
+                        "exceptionstr": r["exceptionstr"],
+                    }
+                )
+            elif r["code"] != 200:
+                ret["problems"].append(
+                    {
+                        "type": "BrokenMetadataUrl",
+                        "url": mdurl,
+                        "code": r["code"],
                     }
                 )
+            get_logger("CheckOws").debug(f"{mdurl} -> {r['code']}")
         if len(l.metadataUrls) == 0:
             ret["problems"].append({"type": "NoMetadataUrl"})
 
     localmduuids = find_localmduuid(service.s, layername)
     # in a second time, make sure local md uuids are reachable via csw
-    if len(localmduuids) > 0:
-        localgn = app.extensions["conf"].get("localgn", "urls")
-        cswservice = app.extensions["owscache"].get(
-            "csw", "/" + localgn + "/srv/fre/csw"
-        )
-        csw = cswservice.s
+    known = {u: e for u, e in (mdexists or dict()).items() if u in localmduuids}
+    unknown = localmduuids - known.keys()
+    if len(unknown) > 0:
+        csw = local_csw().s
         try:
-            csw.getrecordbyid(list(localmduuids))
+            with csw_lock, metrics.timer(
+                "gaia_probe_seconds", check="owslayer", operation="GetRecordById"
+            ), owslib_session():
+                csw.getrecordbyid(list(unknown))
+                # replaced by the next getrecordbyid call
+                records = csw.records
         except Exception as e:
             get_logger("CheckOws").error(
-                f"exception {str(e)} on getrecordbyid({list(localmduuids)})"
+                f"exception {str(e)} on getrecordbyid({list(unknown)})"
             )
         else:
-            get_logger("CheckOws").debug(csw.records)
-            for uuid in localmduuids:
-                if uuid not in csw.records:
-                    ret["problems"].append({"type": "MissingMdUuid", "uuid": uuid})
-                else:
+            get_logger("CheckOws").debug(records)
+            for uuid in unknown:
+                known[uuid] = uuid in records
+                if known[uuid]:
                     get_logger("CheckOws").debug(
-                        f"md with uuid {uuid} exists, title {csw.records[uuid].title}"
+                        f"md with uuid {uuid} exists, title {records[uuid].title}"
                     )
+    for uuid in localmduuids:
+        if known.get(uuid) is False:
+            ret["problems"].append({"type": "MissingMdUuid", "uuid": uuid})
 
-    operation = ""
-    try:
-        if stype == "wms":
-            operation = "GetMap"
-            if operation not in [op.name for op in service.s.operations]:
-                ret["problems"].append(
+    if run_probes:
+        probe_layers(stype, url, service, {layername: ret})
+    return ret
+
+
+def probe_layers(stype, url, service, layers):
+    """
+    probes the ows operation of layers all at once (cf geordash/probes.py),
+    or a sample of tiles of each wmts layer if wmts_sample_levels is set,
+    adding the problems found to the layer results. for sampled tiles, the
+    latency of each tilematrix is added to the 'levels' of the layer result
+    :param layers: the results of the layers to probe, by layer name
+    """
+    # (layername, (tilematrixset, tilematrix) or None) -> probe
+    probes = dict()
+    for layername in layers:
+        try:
+            if stype == "wmts" and WMTS_SAMPLE_LEVELS > 0:
+                found = {
+                    (layername, (tms, tm)): tile_probe(
+                        service, layername, tms, tm, r, c
+                    )
+                    for (tms, tm, r, c) in sample_tiles(
+                        service.s, layername, WMTS_SAMPLE_LEVELS
+                    )
+                }
+            else:
+                found = {(layername, None): layer_probe(stype, service, layername)}
+        except (ServiceException, ReadTimeout) as e:
+            layers[layername]["problems"] += probe_problems(
+                stype, url, service, layername, "", e
+            )
+            continue
+        except Exception as e:
+            layers[layername]["problems"].append(
+                check_exception(stype, url, layername, "check", e)
+            )
+            continue
+        for key, (operation, call, reader) in found.items():
+            if call is not None:
+                probes[key] = (operation, call, reader)
+            elif operation is not None:
+                layers[layername]["problems"].append(
                     {"type": "NoSuchOwsOperation", "operation": operation}
                 )
-                return ret
-            defformat = service.s.getOperationByName("GetMap").formatOptions[0]
-            r = service.s.getmap(
+    timings = dict()
+    outcomes = probe_concurrently(probes, "owslayer", timings=timings)
+    found = dict()
+    samples = dict()
+    for key, (operation, call, reader) in probes.items():
+        (layername, tile) = key
+        outcome = outcomes[key]
+        try:
+            if isinstance(outcome, Exception) and not isinstance(
+                outcome, (ServiceException, ReadTimeout)
+            ):
+                raise outcome
+            found[key] = probe_problems(
+                stype, url, service, layername, operation, outcome
+            )
+        except Exception as e:
+            found[key] = [check_exception(stype, url, layername, operation, e)]
+        if key in timings:
+            samples[key] = {
+                "checked": time(),
+                "operation": operation,
+                "ttfb": timings[key]["ttfb"],
+                "total": timings[key]["total"],
+                "ok": len(found[key]) == 0,
+            }
+            if tile is not None:
+                (samples[key]["tilematrixset"], samples[key]["tilematrix"]) = tile
+    blank = {
+        key: p
+        for key, problems in found.items()
+        for p in problems
+        if p["type"] == "BlankImage"
+    }
+    if len(blank) > 0:
+        confirmed = confirm_blank_images(stype, service, blank, set(found.keys()))
+        for key in blank:
+            found[key] = [p for p in found[key] if p["type"] != "BlankImage"]
+            if confirmed[key] is not None:
+                found[key].append(confirmed[key])
+    found_slow = record_probetimes(stype, url, samples)
+    for key, problems in found.items():
+        (layername, tile) = key
+        if key in found_slow:
+            problems.append(found_slow[key])
+        if tile is not None:
+            for p in problems:
+                (p["tilematrixset"], p["tilematrix"]) = tile
+            latency = timings.get(key, {"ttfb": None, "total": None})
+            layers[layername].setdefault("levels", list()).append(
+                {
+                    "tilematrixset": tile[0],
+                    "tilematrix": tile[1],
+                    "ttfb": latency["ttfb"],
+                    "latency": latency["total"],
+                    "failures": len(problems),
+                }
+            )
+            get_logger("CheckOws").debug(
+                f"GetTile on {layername} at tilematrix {tile[1]} of {tile[0]} took {latency['total'] or 0:.2f}s, {len(problems)} problems"
+            )
+        layers[layername]["problems"] += problems
+
+
+def overview_probe(stype, service, layername, tile):
+    """
+    returns the probe of a representative image of a layer, as layer_probe: a
+    256x256 GetMap of its whole bounding box, or the GetTile at the center of
+    the first tilematrix of the tilematrixset, which covers the whole layer
+    :return: the (layername, tile) key of the overview and its probe, None if
+    the layer has no such tilematrix
+    """
+    l = service.contents()[layername]
+    if stype == "wms":
+        defformat = service.s.getOperationByName("GetMap").formatOptions[0]
+        return (
+            (layername, None),
+            (
+                "GetMap",
+                lambda: service.s.getmap(
+                    layers=[layername],
+                    srs="EPSG:4326",
+                    format=defformat,
+                    size=(256, 256),
+                    bbox=l.boundingBoxWGS84,
+                ),
+                None,
+            ),
+        )
+    if tile is None:
+        tile = find_tilematrix_center(service.s, layername)[:2]
+    # with 2 levels, the first one of each tilematrixset comes first
+    tiles = [t for t in sample_tiles(service.s, layername, 2) if t[0] == tile[0]]
+    if len(tiles) == 0:
+        return None
+    (tms, tm, r, c) = tiles[0]
+    return ((layername, (tms, tm)), tile_probe(service, layername, tms, tm, r, c))
+
+
+def confirm_blank_images(stype, service, blank, probed):
+    """
+    the GetMap probe only covers a tiny bbox at the center of the layer, and
+    the GetTile probe a single tile, which can legitimately be empty (eg a
+    sparse vector layer). a blank image is only reported when the overview of
+    the layer (cf overview_probe) is blank too
+    :param blank: the BlankImage problems by (layername, tile) key
+    :param probed: the keys of all the probes, whose overview doesnt need to
+    be probed again if it was among them
+    :return: the BlankImage problem to report by key, with the statistics of
+    the overview, None if the overview isnt blank
+    """
+    overview_of = dict()
+    overviews = dict()
+    for key in blank:
+        (layername, tile) = key
+        found = overview_probe(stype, service, layername, tile)
+        if found is None:
+            overview_of[key] = key
+            continue
+        (okey, probe) = found
+        overview_of[key] = okey
+        # the wms overview is always another request than the tiny GetMap
+        if stype == "wms" or okey not in probed:
+            overviews[okey] = probe
+    outcomes = probe_concurrently(overviews, "owslayer")
+    # the overviews already probed are blank if they are in blank
+    results = dict()
+    for okey, (operation, call, reader) in overviews.items():
+        results[okey] = None
+        outcome = outcomes[okey]
+        if isinstance(outcome, Exception):
+            get_logger("CheckOws").debug(
+                f"overview of {okey[0]} failed with {objtype(outcome)}, not reporting a blank image"
+            )
+            continue
+        stats = image_stats(outcome.read())
+        if stats is not None and stats.pop("blank"):
+            results[okey] = {"type": "BlankImage", "operation": operation} | stats
+    return {
+        key: results[okey] if okey in results else blank.get(okey)
+        for key, okey in overview_of.items()
+    }
+
+
+def probetimes_key(stype, url, layername, series):
+    """
+    the timings of the probes of a layer are kept by series, ie by operation
+    and for sampled wmts tiles by (tilematrixset, tilematrix)
+    :param series: an (operation, tilematrixset, tilematrix) tuple
+    """
+    (operation, tms, tm) = series
+    key = f"probetimes-{stype}-{url.replace('/','~')}-{layername}-{operation}"
+    return key if tms is None else f"{key}-{tms}-{tm}"
+
+
+def probeseries_key(stype, url, layername):
+    return f"probeseries-{stype}-{url.replace('/','~')}-{layername}"
+
+
+def probe_series(sample):
+    return (sample["operation"], sample.get("tilematrixset"), sample.get("tilematrix"))
+
+
+def probe_history(stype, url, layername):
+    """
+    returns the timings of the last probes of a layer by series, most recent
+    first
+    """
+    rediscli = app.extensions["owscache"].rediscli
+    series = [
+        tuple(json.loads(x))
+        for x in sorted(rediscli.smembers(probeseries_key(stype, url, layername)))
+    ]
+    p = rediscli.pipeline()
+    for ps in series:
+        p.lrange(probetimes_key(stype, url, layername, ps), 0, -1)
+    return [
+        {
+            "operation": operation,
+            "tilematrixset": tms,
+            "tilematrix": tm,
+            "probes": [json.loads(x) for x in history],
+        }
+        for ((operation, tms, tm), history) in zip(series, p.execute())
+        if len(history) > 0
+    ]
+
+
+def record_probetimes(stype, url, samples):
+    """
+    adds the timings of probes (time to first byte and total duration) to the
+    history of their series (cf probetimes_key), keeping the last
+    owslayer_probe_history ones. a successful probe is reported as slow when
+    it took longer than owslayer_slow_threshold seconds, or than
+    owslayer_slow_factor times the median of the previous successful probes
+    of its series
+    :param samples: the timings by (layername, tile) key
+    :return: the SlowResponse problems by key
+    """
+    if len(samples) == 0:
+        return dict()
+    keys = list(samples.keys())
+    hkeys = {
+        key: probetimes_key(stype, url, key[0], probe_series(samples[key]))
+        for key in keys
+    }
+    rediscli = app.extensions["owscache"].rediscli
+    p = rediscli.pipeline()
+    for key in keys:
+        p.lrange(hkeys[key], 0, -1)
+    histories = p.execute()
+    slow = dict()
+    for key, history in zip(keys, histories):
+        sample = samples[key]
+        if not sample["ok"]:
+            continue
+        totals = [h["total"] for h in map(json.loads, history) if h["ok"]]
+        median = statistics.median(totals) if len(totals) >= SLOW_MIN_SAMPLES else None
+        if sample["total"] > SLOW_THRESHOLD or (
+            median is not None
+            and sample["total"] > SLOW_MIN_LATENCY
+            and sample["total"] > SLOW_FACTOR * median
+        ):
+            slow[key] = {
+                "type": "SlowResponse",
+                "operation": sample["operation"],
+                "latency": round(sample["total"], 3),
+                "ttfb": (
+                    round(sample["ttfb"], 3) if sample["ttfb"] is not None else None
+                ),
+                "median": round(median, 3) if median is not None else None,
+                "threshold": SLOW_THRESHOLD,
+            }
+    p = rediscli.pipeline()
+    for key in keys:
+        p.lpush(hkeys[key], json.dumps(samples[key]))
+        p.ltrim(hkeys[key], 0, PROBE_HISTORY - 1)
+        p.expire(hkeys[key], LAYERSTATE_TTL)
+        skey = probeseries_key(stype, url, key[0])
+        p.sadd(skey, json.dumps(probe_series(samples[key])))
+        p.expire(skey, LAYERSTATE_TTL)
+    p.execute()
+    return slow
+
+
+def sample_tiles(wmts, lname, nlevels):
+    """
+    for a given wmts layer, samples tiles across all its tilematrixsets: for
+    each of them, the center tile of nlevels levels evenly spread from the
+    first to the last tilematrix within the tilematrixlimits (only the last
+    one if nlevels is 1)
+    :return: a list of (tilematrixset, tilematrix, row, column) tuples
+    """
+    l = wmts.contents[lname]
+    tiles = list()
+    for tms, tsetl in l.tilematrixsetlinks.items():
+        if tms not in wmts.tilematrixsets:
+            continue
+        tset = wmts.tilematrixsets[tms]
+        # geoserver/gwc sets tilematrixsetlinks, mapproxy doesnt
+        if len(tsetl.tilematrixlimits) > 0:
+            levels = list(tsetl.tilematrixlimits.keys())
+        else:
+            levels = list(tset.tilematrix.keys())
+        if len(levels) == 0:
+            continue
+        if nlevels > 1:
+            indexes = sorted(
+                {round(i * (len(levels) - 1) / (nlevels - 1)) for i in range(nlevels)}
+            )
+        else:
+            indexes = [len(levels) - 1]
+        for i in indexes:
+            tm = levels[i]
+            tml = tsetl.tilematrixlimits.get(tm)
+            if tml is not None:
+                r = tml.mintilerow + int((tml.maxtilerow - tml.mintilerow) / 2)
+                c = tml.mintilecol + int((tml.maxtilecol - tml.mintilecol) / 2)
+            else:
+                r = int(int(tset.tilematrix[tm].matrixheight) / 2)
+                c = int(int(tset.tilematrix[tm].matrixwidth) / 2)
+            tiles.append((tms, tm, r, c))
+    return tiles
+
+
+def tile_probe(service, layername, tms, tm, r, c):
+    """
+    returns the GetTile probe of a given tile, as layer_probe
+    """
+    return (
+        "GetTile",
+        lambda: service.s.gettile(
+            layer=layername, tilematrixset=tms, tilematrix=tm, row=r, column=c
+        ),
+        None,
+    )
+
+
+def layer_probe(stype, service, layername):
+    """
+    returns the ows operation probing a layer (GetMap with a tiny bbox at the
+    center of the layer, GetFeature of a single feature or GetTile at the
+    center of the last tilematrix), a function sending it with owslib, or
+    None if the service doesnt support that operation, and the reader
+    sending the request built by owslib in its place, if any (cf
+    geordash/probes.py)
+    """
+    l = service.contents()[layername]
+    if stype == "wms":
+        operation = "GetMap"
+        if operation not in [op.name for op in service.s.operations]:
+            return (operation, None, None)
+        defformat = service.s.getOperationByName("GetMap").formatOptions[0]
+        return (
+            operation,
+            lambda: service.s.getmap(
                 layers=[layername],
                 srs="EPSG:4326",
                 format=defformat,
                 size=(10, 10),
                 bbox=reduced_bbox(l.boundingBoxWGS84),
-            )
-            headers = r.info()
-            if (
-                headers["content-type"] != defformat
-            ):  # and headers['content-type'] != 'image/jpeg':
-                ret["problems"].append(
-                    {
-                        "type": "UnexpectedReturnedFormat",
-                        "operation": operation,
-                        "returned": headers["content-type"],
-                        "expected": defformat,
-                    }
-                )
-            # content-length only available for HEAD requests ?
-            if "content-length" in headers and not int(headers["content-length"]) > 0:
-                ret["problems"].append(
-                    {
-                        "type": "UnexpectedContentLength",
-                        "operation": operation,
-                        "length": headers["content-length"],
-                    }
-                )
-
-        elif stype == "wfs":
-            operation = "GetFeature"
-            feat = service.s.getfeature(
+            ),
+            None,
+        )
+    elif stype == "wfs":
+        return (
+            "GetFeature",
+            lambda: service.s.getfeature(
                 typename=[layername],
                 srsname=l.crsOptions[0],
                 #                bbox=reduced_bbox(l.boundingBoxWGS84),
                 maxfeatures=1,
+            ),
+            read_root_element,
+        )
+    elif stype == "wmts":
+        (tms, tm, r, c) = find_tilematrix_center(service.s, layername)
+        return tile_probe(service, layername, tms, tm, r, c)
+    return (None, None, None)
+
+
+def read_head(r, length):
+    """
+    returns the first bytes of a streamed response
+    """
+    head = b""
+    for chunk in r.iter_content(min(length, 8192)):
+        head += chunk
+        if len(head) >= length:
+            break
+    return head[:length]
+
+
+def read_root_element(req):
+    """
+    sends the request built by owslib for a GetFeature as a stream, and parses
+    the response incrementally until its root element, reading at most
+    wfs_probe_max_bytes bytes for at most wfs_probe_max_seconds seconds, so
+    that a server ignoring maxfeatures doesnt make the worker buffer all its
+    features. as owslib, raises a ServiceException for 400/401/403 answers
+    and exception reports, and an HTTPError for other errors.
+    :return: a dict with the root tag (None if not found), the parse error
+    and a truncated excerpt of the response
+    """
+    start = perf_counter()
+    ret = {"root": None, "error": None, "excerpt": "", "truncated": False}
+    head = b""
+    nread = 0
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    complete = False
+    with session().request(req.method, req.url, stream=True, **req.kwargs) as r:
+        if r.status_code in (400, 401, 403):
+            raise ServiceException(
+                read_head(r, EXCERPT_LENGTH).decode(errors="replace")
             )
-            xml = feat.read()
-            try:
-                root = ET.fromstring(xml.decode())
-                first_tag = root.tag.lower()
-                if not first_tag.endswith("featurecollection"):
-                    ret["problems"].append(
-                        {
-                            "type": "UnexpectedFirstXmlTag",
-                            "operation": operation,
-                            "first_tag": first_tag,
-                            "expected": "featurecollection",
-                        }
+        if r.status_code in (404, 500, 502, 503, 504):
+            r.raise_for_status()
+        try:
+            for chunk in r.iter_content(8192):
+                if len(head) < EXCERPT_LENGTH:
+                    head += chunk[: EXCERPT_LENGTH - len(head)]
+                nread += len(chunk)
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if root is None:
+                        root = elem
+                    elif event == "end" and elem is root:
+                        complete = True
+                # an exception report is read until its end, to get its message
+                if root is not None and (
+                    complete or not root.tag.lower().endswith("exceptionreport")
+                ):
+                    break
+                if nread >= WFS_MAX_BYTES:
+                    ret["truncated"] = True
+                    break
+                if perf_counter() - start > WFS_MAX_SECONDS:
+                    raise ReadTimeout(
+                        f"no root element in the GetFeature response after {WFS_MAX_SECONDS}s and {nread} bytes"
                     )
-            except XMLSyntaxError as e:
-                ret["problems"].append(
-                    {
-                        "type": "ExpectedXML",
-                        "operation": operation,
-                        "return": xml.decode(),
-                    }
-                )
-            except ET.ParseError as e:
-                ret["problems"].append(
-                    {"type": "XMLParseError", "operation": operation, "return": str(e)}
-                )
+            else:
+                # the whole response was read
+                parser.close()
+        except ET.ParseError as e:
+            ret["error"] = str(e)
+    ret["excerpt"] = head.decode(errors="replace")
+    if root is None:
+        if ret["error"] is None:
+            ret["error"] = f"no root element in the first {nread} bytes"
+        return ret
+    ret["root"] = root.tag
+    if root.tag.lower().endswith("exceptionreport"):
+        # the report was read up to its end or to the byte cap
+        raise ServiceException(
+            "\n".join(t.strip() for t in root.itertext() if t.strip())[:EXCERPT_LENGTH]
+        )
+    return ret
 
-        elif stype == "wmts":
-            operation = "GetTile"
-            (tms, tm, r, c) = find_tilematrix_center(service.s, layername)
-            tile = service.s.gettile(
-                layer=layername, tilematrixset=tms, tilematrix=tm, row=r, column=c
-            )
-            headers = tile.info()
-            if headers["content-type"] != l.formats[0]:
-                ret["problems"].append(
-                    {
-                        "type": "UnexpectedReturnedFormat",
-                        "operation": operation,
-                        "returned": headers["content-type"],
-                        "expected": l.formats[0],
-                    }
-                )
-            if "content-length" in headers and not int(headers["content-length"]) > 0:
-                ret["problems"].append(
-                    {
-                        "type": "UnexpectedContentLength",
-                        "operation": operation,
-                        "length": headers["content-length"],
-                    }
-                )
 
-    except (ServiceException, ReadTimeout) as e:
+def probe_problems(stype, url, service, layername, operation, outcome):
+    """
+    validates the outcome of a layer probe: the owslib response, or the
+    ServiceException/ReadTimeout it raised
+    :return: the list of problems
+    """
+    problems = list()
+    if isinstance(outcome, Exception):
+        e = outcome
         if (
             type(e) == ServiceException
             and type(e.args) == tuple
@@ -261,7 +1023,7 @@ def owslayer(stype, url, layername, single=False):
                 or "HTTP Status 401 – Unauthorized" in e.args[0]
             )
         ):
-            ret["problems"].append(
+            problems.append(
                 {
                     "type": "ForbiddenAccess",
                     "operation": operation,
@@ -274,7 +1036,7 @@ def owslayer(stype, url, layername, single=False):
             get_logger("CheckOws").warning(
                 f"{operation} failed on layer {layername} with {str(e)} exception, details not leaked in the job results"
             )
-            ret["problems"].append(
+            problems.append(
                 {
                     "type": "ServiceException",
                     "operation": operation,
@@ -286,7 +1048,7 @@ def owslayer(stype, url, layername, single=False):
                 }
             )
         else:
-            ret["problems"].append(
+            problems.append(
                 {
                     "type": "ServiceException",
                     "operation": operation,
@@ -297,8 +1059,69 @@ def owslayer(stype, url, layername, single=False):
                     "estr": str(e),
                 }
             )
-    else:
+        return problems
+
+    l = service.contents()[layername]
+    if stype == "wms" or stype == "wmts":
+        if stype == "wms":
+            expected = service.s.getOperationByName("GetMap").formatOptions[0]
+        else:
+            expected = l.formats[0]
+        headers = outcome.info()
+        if headers["content-type"] != expected:
+            problems.append(
+                {
+                    "type": "UnexpectedReturnedFormat",
+                    "operation": operation,
+                    "returned": headers["content-type"],
+                    "expected": expected,
+                }
+            )
+        # content-length only available for HEAD requests ?
+        if "content-length" in headers and not int(headers["content-length"]) > 0:
+            problems.append(
+                {
+                    "type": "UnexpectedContentLength",
+                    "operation": operation,
+                    "length": headers["content-length"],
+                }
+            )
+        if BLANK_IMAGE_CHECK and len(problems) == 0 and expected.startswith("image/"):
+            stats = image_stats(outcome.read())
+            if stats is not None and stats.pop("blank"):
+                problems.append({"type": "BlankImage", "operation": operation} | stats)
+
+    elif stype == "wfs":
+        # cf read_root_element
+        if outcome["root"] is not None:
+            first_tag = outcome["root"].lower()
+            if not first_tag.endswith("featurecollection"):
+                problems.append(
+                    {
+                        "type": "UnexpectedFirstXmlTag",
+                        "operation": operation,
+                        "first_tag": first_tag,
+                        "expected": "featurecollection",
+                    }
+                )
+        elif outcome["truncated"]:
+            problems.append(
+                {
+                    "type": "XMLParseError",
+                    "operation": operation,
+                    "return": f"{outcome['error']}: {outcome['excerpt']}",
+                }
+            )
+        else:
+            problems.append(
+                {
+                    "type": "ExpectedXML",
+                    "operation": operation,
+                    "return": f"{outcome['error']}: {outcome['excerpt']}",
+                }
+            )
+    if len(problems) == 0:
         get_logger("CheckOws").debug(
             f"{operation} on {layername} in {stype} at {url} succeeded"
         )
-    return ret
+    return problems
@@ -3,7 +3,7 @@
 # vim: ts=4 sw=4 et
 
 from flask import Blueprint
-from flask import request, render_template, abort, url_for
+from flask import request, render_template, abort, url_for, Response
 from flask import current_app as app
 import requests
 from functools import wraps
@@ -13,6 +13,7 @@ from geordash.checks.mapstore import get_resources_using_ows, get_res
 from geordash.api import mapstore_get, gninternalid, get_res_details
 from geordash.utils import find_localmduuid, unmunge
 from geordash.mviewer import parse_map
+from geordash.metrics import metrics
 
 import json
 
@@ -84,6 +85,30 @@ def debug():
     return app.extensions["conf"].tostr()
 
 
+@dash_bp.route("/debug/owscache.json")
+@check_role(role="SUPERUSER", json=True)
+def debug_owscache():
+    """
+    lists the capabilities entries resident in this process memory, with
+    their estimated size and the tier eviction statistics
+    """
+    tier = app.extensions["owscache"].services
+    return {
+        "budget": tier.budget,
+        "size": tier.size,
+        "stats": tier.stats,
+        "entries": tier.resident(),
+    }
+
+
+@dash_bp.route("/metrics")
+def prometheus_metrics():
+    """
+    cache, probes and tasks metrics of the whole deployment, for prometheus
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @dash_bp.route("/my-metadata")
 @check_role(role="GN_EDITOR")
 def my_metadata():
@@ -3,6 +3,20 @@
 # vim: ts=4 sw=4 et
 
 from celery.utils.log import get_task_logger
+import ast
+
+
+def truncated(args):
+    """
+    saferepr replaces the args past its maxlen by '...', parsed as Ellipsis
+    """
+    if args is Ellipsis:
+        return True
+    if isinstance(args, (tuple, list)):
+        return any(truncated(a) for a in args)
+    if isinstance(args, dict):
+        return any(truncated(v) for v in args.values())
+    return False
 
 
 class CeleryEventsHandler:
@@ -15,8 +29,17 @@ class CeleryEventsHandler:
     def task_sent(self, event):
         self._state.event(event)
         task = self._state.tasks.get(event["uuid"])
-        # XXX task.args is a string representing a tuple at that point, we need a proper tuple..
-        args = eval(task.args)
+        # task.args is the repr of the args tuple at that point, truncated by
+        # celery past 1024 chars (cf ARGSREPR_MAX in checks/ows.py)
+        try:
+            args = ast.literal_eval(task.args)
+        except (ValueError, SyntaxError):
+            args = Ellipsis
+        if truncated(args):
+            self.logger.warning(
+                f"cant parse the args of {event['type']} event, task id {task.id} named {task.name}: {task.args}"
+            )
+            return
         self.logger.info(
             f"got {event['type']} event, task id {task.id} named {task.name}, with args {args} ({type(args)})"
         )
@@ -0,0 +1,142 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from time import time, sleep
+import random
+import uuid
+
+from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+
+""" per-host concurrency limit shared by all the processes sending requests
+through the shared http session: a redis semaphore (a sorted set of slots,
+hostslots-<host>) sized by an adaptive limit (hostlimit-<host>). the limit
+starts at the host ceiling, is halved when the host answers 429/503, times out
+or gets much slower than usual, and grows back by about one slot per
+successful round of requests (additive increase, multiplicative decrease).
+"""
+
+# atomically drops the expired slots and takes one if under the limit
+ACQUIRE = """
+if redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+local limit = tonumber(redis.call('hget', KEYS[2], 'limit') or ARGV[4])
+if redis.call('zcard', KEYS[1]) < math.max(1, math.floor(limit)) then
+    redis.call('zadd', KEYS[1], ARGV[1] + ARGV[3], ARGV[2])
+    redis.call('expire', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# releases the slot and adapts the limit to the outcome of the request,
+# returns the new limit and whether the host looked congested
+RELEASE = """
+redis.call('zrem', KEYS[1], ARGV[1])
+local latency = tonumber(ARGV[2])
+local ceiling = tonumber(ARGV[4])
+local limit = tonumber(redis.call('hget', KEYS[2], 'limit') or ceiling)
+local ewma = tonumber(redis.call('hget', KEYS[2], 'ewma') or latency)
+local congested = ARGV[3] == '1'
+    or latency > tonumber(ARGV[5])
+    or (latency > 1 and latency > 3 * ewma)
+if congested then
+    limit = math.max(1, limit / 2)
+else
+    limit = math.min(ceiling, limit + 1 / limit)
+end
+ewma = 0.8 * ewma + 0.2 * latency
+redis.call('hset', KEYS[2], 'limit', limit, 'ewma', ewma)
+redis.call('expire', KEYS[2], ARGV[6])
+return {tostring(limit), congested and 1 or 0}
+"""
+
+
+class HostLimiter:
+    def __init__(
+        self, rediscli, ceiling=4, ceilings=None, slow_latency=10, interactive_wait=2
+    ):
+        self.rediscli = rediscli
+        # default and per-host maximum amount of concurrent requests
+        self.ceiling = ceiling
+        self.ceilings = ceilings or dict()
+        # a request slower than that always reduces the limit
+        self.slow_latency = slow_latency
+        # a slot not released after that delay is considered stale (eg crashed worker)
+        self.slot_ttl = 300
+        # after that delay waiting for a slot, send the request anyway
+        self.wait_timeout = 600
+        # same for the requests sent while answering a web request, which
+        # shouldnt wait behind the probes of the celery tasks
+        self.interactive_wait = interactive_wait
+        # forget the adapted limit of hosts which didnt get requests for a day
+        self.state_ttl = 86400
+        # dont honor Retry-After headers asking to wait longer than that
+        self.max_pause = 60
+        self.acquire_script = rediscli.register_script(ACQUIRE)
+        self.release_script = rediscli.register_script(RELEASE)
+
+    def ceiling_for(self, host):
+        return self.ceilings.get(host, self.ceiling)
+
+    def keys(self, host):
+        return [f"hostslots-{host}", f"hostlimit-{host}", f"hostpause-{host}"]
+
+    def acquire(self, host, interactive=False):
+        """
+        waits for a free slot for host, returns its token (None if it didnt
+        get one in time). interactive requests only wait interactive_wait seconds
+        """
+        token = uuid.uuid4().hex
+        start = time()
+        timeout = self.interactive_wait if interactive else self.wait_timeout
+        while True:
+            now = time()
+            if self.acquire_script(
+                keys=self.keys(host),
+                args=[now, token, self.slot_ttl, self.ceiling_for(host)],
+            ):
+                break
+            if now - start > timeout:
+                log = get_logger("HostLimiter")
+                (log.debug if interactive else log.warning)(
+                    f"waited {now - start:.0f}s for a slot on {host}, sending the request anyway"
+                )
+                token = None
+                break
+            sleep(random.uniform(0.05, 0.25))
+        metrics.observe("gaia_host_wait_seconds", time() - start, host=host)
+        return token
+
+    def release(self, host, token, latency, code=None, retryafter=None):
+        """
+        frees the slot and adapts the host limit: 429/503 answers (code None
+        for connection failures and timeouts) and slow answers halve it,
+        others raise it a bit
+        """
+        congested = code is None or code in (429, 503)
+        if code in (429, 503) and retryafter is not None and retryafter.isdigit():
+            pause = min(int(retryafter), self.max_pause)
+            if pause > 0:
+                self.rediscli.set(self.keys(host)[2], 1, ex=pause)
+        limit, congested = self.release_script(
+            keys=self.keys(host)[:2],
+            args=[
+                token or "",
+                latency,
+                1 if congested else 0,
+                self.ceiling_for(host),
+                self.slow_latency,
+                self.state_ttl,
+            ],
+        )
+        limit = float(limit)
+        metrics.set("gaia_host_concurrency_limit", int(limit), host=host)
+        if congested:
+            get_logger("HostLimiter").info(
+                f"{host} answered {code} in {latency:.2f}s, reducing its concurrency limit to {int(limit)}"
+            )
+        return limit
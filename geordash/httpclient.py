@@ -0,0 +1,236 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from redis import Redis
+from time import perf_counter
+from flask import has_request_context
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import owslib.util
+import requests
+import os
+import threading
+
+from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.hostlimit import HostLimiter
+
+""" a requests session shared by all the checks of a process, so that the
+probes against a given host reuse kept-alive connections instead of opening a
+new tcp/tls connection each time. sessions are per-process (celery/gunicorn
+fork after import) and hold one connection pool per host. the opened
+connections and the sent requests are counted per host in the
+gaia_http_connections_total and gaia_http_requests_total metrics. when a
+HostLimiter is configured, each request first waits for a slot on its host.
+"""
+
+# default (connect, read) timeouts, when the caller doesnt pass one
+DEFAULT_TIMEOUT = (5, 30)
+# amount of hosts with a connection pool, and connections kept per host
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 8
+# concurrent requests per host across all processes, 0 to disable the limit
+HOST_CONCURRENCY = 4
+# requests slower than that reduce the concurrency limit of their host
+SLOW_LATENCY = 10
+# requests sent while answering a web request wait at most that long for a slot
+INTERACTIVE_WAIT = 2
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        metrics.inc("gaia_http_connections_total", host=self.host)
+        get_logger("HttpClient").debug(
+            f"opening connection #{self.num_connections + 1} to {self.host}:{self.port}"
+        )
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        metrics.inc("gaia_http_connections_total", host=self.host)
+        get_logger("HttpClient").debug(
+            f"opening connection #{self.num_connections + 1} to {self.host}:{self.port}"
+        )
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    # time the requests of each thread waited for a slot on their host, cf
+    # slot_wait()
+    local = threading.local()
+
+    def __init__(self, limiter=None, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        metrics.inc("gaia_http_requests_total", host=host)
+        if self.limiter is None:
+            return super().send(request, **kwargs)
+        # eg a capabilities revalidation from a page, dont block it for long
+        start = perf_counter()
+        token = self.limiter.acquire(host, has_request_context())
+        waited = perf_counter() - start
+        self.local.wait = getattr(self.local, "wait", 0) + waited
+        start = perf_counter()
+        try:
+            r = super().send(request, **kwargs)
+        except Exception:
+            self.limiter.release(host, token, perf_counter() - start)
+            raise
+        self.limiter.release(
+            host,
+            token,
+            perf_counter() - start,
+            r.status_code,
+            r.headers.get("Retry-After"),
+        )
+        # counted in r.elapsed by requests
+        r.slot_wait = waited
+        return r
+
+
+def host_ceiling(url):
+    """
+    returns the maximum amount of concurrent requests to the host of url
+    allowed by the shared session (cf HostLimiter), None if it isnt limited
+    """
+    limiter = getattr(session().get_adapter(url), "limiter", None)
+    if limiter is None:
+        return None
+    return limiter.ceiling_for(urlparse(url).hostname)
+
+
+def slot_wait():
+    """
+    returns the time the requests sent by the current thread waited for a
+    slot on their host since the last call
+    """
+    wait = getattr(PooledAdapter.local, "wait", 0)
+    PooledAdapter.local.wait = 0
+    return wait
+
+
+class PooledSession(requests.Session):
+    def __init__(self, timeout, pool_connections, pool_maxsize, limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        adapter = PooledAdapter(
+            limiter=limiter,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def session():
+    """
+    returns the shared session of the current process, created on first use
+    with the http_timeout, http_pool_connections and http_pool_maxsize
+    settings from config.py, and limited to http_host_concurrency concurrent
+    requests per host (overridden by host in http_host_concurrency_limits)
+    across all processes. requests sent from a flask request context only
+    wait http_interactive_wait seconds for a slot
+    """
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            timeout, pool_connections, pool_maxsize = (
+                DEFAULT_TIMEOUT,
+                POOL_CONNECTIONS,
+                POOL_MAXSIZE,
+            )
+            limiter = None
+            try:
+                import config
+
+                timeout = getattr(config, "http_timeout", timeout)
+                pool_connections = getattr(
+                    config, "http_pool_connections", pool_connections
+                )
+                pool_maxsize = getattr(config, "http_pool_maxsize", pool_maxsize)
+                ceiling = getattr(config, "http_host_concurrency", HOST_CONCURRENCY)
+                if ceiling:
+                    limiter = HostLimiter(
+                        Redis.from_url(config.url),
+                        ceiling,
+                        getattr(config, "http_host_concurrency_limits", dict()),
+                        getattr(config, "http_slow_latency", SLOW_LATENCY),
+                        getattr(config, "http_interactive_wait", INTERACTIVE_WAIT),
+                    )
+            except ImportError:
+                pass
+            # dont close the parent's session, its sockets are shared with it
+            _session = PooledSession(timeout, pool_connections, pool_maxsize, limiter)
+            _session_pid = os.getpid()
+    return _session
+
+
+class OwslibRequests:
+    """
+    stands for the requests module in owslib.util, so that the requests sent
+    by owslib's openURL() go through the shared session in the threads which
+    entered owslib_session()
+    """
+
+    local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def _target(self):
+        if getattr(self.local, "session", None) is not None:
+            return self.local.session
+        return requests
+
+    def request(self, method, url, **kwargs):
+        return self._target().request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self._target().get(url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self._target().post(url, data=data, json=json, **kwargs)
+
+
+owslib.util.requests = OwslibRequests()
+
+
+@contextmanager
+def owslib_session(s=None):
+    """
+    makes the owslib calls (getmap, getfeature, gettile, getrecordbyid..) of
+    the enclosed block use the given session, or the shared one
+    """
+    local = OwslibRequests.local
+    previous = getattr(local, "session", None)
+    local.session = s if s is not None else session()
+    try:
+        yield local.session
+    finally:
+        local.session = previous
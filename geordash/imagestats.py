@@ -0,0 +1,65 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from io import BytesIO
+
+from geordash.logwrap import get_logger
+
+""" statistics on the pixels of the images returned by the GetMap/GetTile
+probes, to detect blank images (fully transparent or of a single colour) as
+returned by a layer whose datastore is broken. numpy and pillow are optional
+dependencies, only needed when owslayer_blank_image_check is enabled.
+"""
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+
+# the missing dependencies are only logged once
+_warned = False
+
+
+def image_stats(data):
+    """
+    decodes an image and returns statistics on its pixels: its size, the
+    share of fully transparent pixels, the amount of distinct colours (and
+    the colour if there's only one), and whether it is blank
+    :return: the statistics, or None if numpy/pillow arent installed or the
+    image cant be decoded
+    """
+    global _warned
+    if numpy is None:
+        if not _warned:
+            get_logger("ImageStats").warning(
+                "numpy and pillow are needed to check the images returned by the probes"
+            )
+            _warned = True
+        return None
+    try:
+        with Image.open(BytesIO(data)) as img:
+            px = numpy.asarray(img.convert("RGBA"))
+    except Exception as e:
+        get_logger("ImageStats").debug(f"cant decode the image: {str(e)}")
+        return None
+    height, width = px.shape[:2]
+    if width * height == 0:
+        return None
+    # one 32 bits integer per rgba pixel, to compare whole pixels at once
+    packed = numpy.ascontiguousarray(px).view(numpy.uint32).reshape(-1)
+    transparent = numpy.count_nonzero(px[..., 3] == 0) / packed.size
+    if numpy.all(packed == packed[0]):
+        colors = 1
+    else:
+        colors = len(numpy.unique(packed))
+    stats = {
+        "width": width,
+        "height": height,
+        "transparent": round(float(transparent), 4),
+        "colors": colors,
+        "blank": transparent == 1 or colors == 1,
+    }
+    if colors == 1:
+        stats["color"] = "#" + px[0, 0].tobytes().hex()
+    return stats
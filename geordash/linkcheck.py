@@ -0,0 +1,184 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from time import time, perf_counter
+from redis import Redis
+from redis.exceptions import LockError
+import hashlib
+import json
+
+from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.httpclient import session
+from geordash.utils import objtype
+
+# status codes returned by servers which dont implement HEAD, retried with a GET
+HEAD_UNSUPPORTED = (400, 403, 404, 405, 501)
+
+
+def normalize_url(url):
+    """
+    returns the url with a lowercase scheme and host, without the default port
+    and the fragment and with sorted query parameters, so that the various
+    spellings of a given link share the same cache entry
+    """
+    try:
+        p = urlsplit(url.strip())
+        scheme = p.scheme.lower()
+        netloc = (p.hostname or "").lower()
+        if ":" in netloc:
+            netloc = f"[{netloc}]"
+        if p.port and (scheme, p.port) not in (("http", 80), ("https", 443)):
+            netloc += f":{p.port}"
+        if p.username:
+            userinfo = p.username + (f":{p.password}" if p.password else "")
+            netloc = f"{userinfo}@{netloc}"
+        query = urlencode(sorted(parse_qsl(p.query, keep_blank_values=True)))
+        return urlunsplit((scheme, netloc, p.path or "/", query, ""))
+    except ValueError:
+        return url
+
+
+def covers(checked, timeout):
+    """
+    returns True if a check with the checked timeout (a number or a (connect,
+    read) tuple, None for the session default) gave the link at least as much
+    time as a check with the given timeout would
+    """
+    if checked == timeout:
+        return True
+    if checked is None or timeout is None:
+        return False
+    if not isinstance(checked, (tuple, list)):
+        checked = (checked, checked)
+    if not isinstance(timeout, (tuple, list)):
+        timeout = (timeout, timeout)
+    return checked[0] >= timeout[0] and checked[1] >= timeout[1]
+
+
+class LinkChecker:
+    """
+    checks that urls resolve, caching the results in redis by normalized url
+    (linkcheck-<sha1>) for success_ttl seconds when the link works and
+    failure_ttl seconds when it doesnt, so that a given metadata or download
+    url is checked once for all the layers, records and tasks referencing it.
+    a cached failure is only reused by checks with a timeout no longer than
+    the one it was checked with. a url is only checked by one process at a
+    time, the others wait for its result.
+    """
+
+    def __init__(self, redisurl):
+        self.rediscli = Redis.from_url(redisurl)
+        self.success_ttl = 86400
+        self.failure_ttl = 900
+        self.lock_timeout = 120
+        try:
+            import config
+
+            self.success_ttl = getattr(config, "linkcheck_success_ttl", 86400)
+            self.failure_ttl = getattr(config, "linkcheck_failure_ttl", 900)
+        except ImportError:
+            pass
+
+    def key(self, url):
+        # hashed, the url can contain credentials
+        return "linkcheck-" + hashlib.sha1(normalize_url(url).encode()).hexdigest()
+
+    def cached(self, url, timeout=None):
+        """
+        returns the cached result for url, or None. failures checked with a
+        shorter timeout than the given one (eg 5s for a link then checked as a
+        60s shape-zip download) arent returned
+        """
+        r = self.rediscli.get(self.key(url))
+        if r is None:
+            return None
+        res = json.loads(r)
+        if res["code"] != 200 and not covers(res.get("timeout"), timeout):
+            return None
+        return res
+
+    def check(self, url, timeout=None, force=False):
+        """
+        returns the result of the check of url, from the cache if possible:
+        a dict with the http code (None if the request failed, with the
+        exception type and string), the method used (HEAD or GET), the
+        latency in seconds and the timestamp of the check
+        """
+        key = self.key(url)
+        if not force:
+            res = self.cached(url, timeout)
+            if res is not None:
+                metrics.inc("gaia_linkcheck_lookups_total", result="hit")
+                return res
+        lock = self.rediscli.lock(f"lock-{key}", timeout=self.lock_timeout)
+        if not lock.acquire(blocking=False):
+            waitstart = time()
+            get_logger("LinkChecker").debug(
+                f"{url} already being checked by another process, waiting for it"
+            )
+            if lock.acquire(blocking_timeout=self.lock_timeout):
+                res = self.cached(url, timeout)
+                if res is not None and res["checked"] >= waitstart:
+                    lock.release()
+                    metrics.inc("gaia_linkcheck_lookups_total", result="merged")
+                    return res
+        try:
+            res = self.probe(url, timeout)
+            ttl = self.success_ttl if res["code"] == 200 else self.failure_ttl
+            self.rediscli.set(key, json.dumps(res), ex=ttl)
+            metrics.inc("gaia_linkcheck_lookups_total", result="checked")
+            return res
+        finally:
+            try:
+                if lock.owned():
+                    lock.release()
+            except LockError:
+                pass
+
+    def probe(self, url, timeout=None):
+        """
+        sends a HEAD request to url, falling back to a GET of the first byte if
+        the server doesnt seem to support HEAD. redirects arent followed, and
+        reported with their 3xx code (eg to a login page)
+        """
+        start = perf_counter()
+        res = {
+            "url": url,
+            "code": None,
+            "method": "HEAD",
+            "exception": None,
+            "exceptionstr": None,
+            "timeout": timeout,
+        }
+        try:
+            r = session().head(url, timeout=timeout, allow_redirects=False)
+            res["code"] = r.status_code
+            if r.status_code in HEAD_UNSUPPORTED:
+                res["method"] = "GET"
+                with session().get(
+                    url,
+                    timeout=timeout,
+                    allow_redirects=False,
+                    headers={"Range": "bytes=0-0"},
+                    stream=True,
+                ) as r:
+                    # the resource exists, even if only a part was requested
+                    res["code"] = 200 if r.status_code == 206 else r.status_code
+        except Exception as e:
+            res["exception"] = objtype(e)
+            res["exceptionstr"] = str(e)
+        res["latency"] = perf_counter() - start
+        res["checked"] = time()
+        metrics.observe(
+            "gaia_probe_seconds",
+            res["latency"],
+            check="linkcheck",
+            operation=res["method"],
+        )
+        get_logger("LinkChecker").debug(
+            f"{res['method']} {url} -> {res['code'] or res['exception']} in {res['latency']:.2f}s"
+        )
+        return res
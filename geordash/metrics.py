@@ -0,0 +1,195 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from contextlib import contextmanager
+from time import time, perf_counter
+from redis import Redis
+import atexit
+import threading
+
+from geordash.logwrap import get_logger
+
+""" metrics aggregated in redis across all the gunicorn workers and celery
+processes, exposed in the prometheus text format by the /gaia/metrics route.
+each process accumulates its observations in memory and adds them to the
+redis hashes (one per metric, metrics-<name>) every FLUSH_INTERVAL seconds,
+so that hot paths like in-memory cache hits dont cost a redis roundtrip.
+"""
+FLUSH_INTERVAL = 10
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "gaia_owscache_lookups_total": (
+        "counter",
+        "capabilities cache lookups by service type, tier (memory, redis, remote) and result",
+        None,
+    ),
+    "gaia_capabilities_fetch_seconds": (
+        "histogram",
+        "duration of the GetCapabilities requests by service",
+        LATENCY_BUCKETS,
+    ),
+    "gaia_capabilities_size_bytes": (
+        "gauge",
+        "size of the last fetched capabilities document by service",
+        None,
+    ),
+    "gaia_probe_seconds": (
+        "histogram",
+        "duration of the outbound requests done by the checks, by check and operation",
+        LATENCY_BUCKETS,
+    ),
+    "gaia_http_requests_total": (
+        "counter",
+        "requests sent through the shared http session by host",
+        None,
+    ),
+    "gaia_http_connections_total": (
+        "counter",
+        "connections opened by the shared http session by host, lower than the requests when they are reused",
+        None,
+    ),
+    "gaia_linkcheck_lookups_total": (
+        "counter",
+        "link checks by result (hit in the cache, checked, or merged with a concurrent check)",
+        None,
+    ),
+    "gaia_host_concurrency_limit": (
+        "gauge",
+        "current adaptive limit of concurrent requests by host",
+        None,
+    ),
+    "gaia_host_wait_seconds": (
+        "histogram",
+        "time spent waiting for a free request slot by host",
+        LATENCY_BUCKETS,
+    ),
+    "gaia_task_seconds": (
+        "histogram",
+        "duration of the celery tasks by task name",
+        TASK_BUCKETS,
+    ),
+}
+
+
+def labelstr(labels):
+    """
+    formats labels as in the prometheus exposition format
+    """
+    return ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in sorted(labels.items())
+    )
+
+
+class Metrics:
+    def __init__(self):
+        self.rediscli = None
+        self.lock = threading.Lock()
+        # metric name -> hash field -> pending increment
+        self.pending = dict()
+        # metric name -> hash field -> value, for gauges
+        self.gauges = dict()
+        self.lastflush = time()
+        try:
+            from config import url
+
+            self.rediscli = Redis.from_url(url)
+        except Exception as e:
+            get_logger("Metrics").error(f"cant connect to redis, metrics disabled: {e}")
+        atexit.register(self.flush)
+
+    def _add(self, name, field, value):
+        metric = self.pending.setdefault(name, dict())
+        metric[field] = metric.get(field, 0) + value
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self._add(name, labelstr(labels), value)
+        self.maybe_flush()
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, dict())[labelstr(labels)] = value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        ls = labelstr(labels)
+        with self.lock:
+            for b in METRICS[name][2]:
+                if value <= b:
+                    self._add(name, f"{ls}|{b}", 1)
+            self._add(name, f"{ls}|+Inf", 1)
+            self._add(name, f"{ls}|sum", value)
+            self._add(name, f"{ls}|count", 1)
+        self.maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        observes the duration of the enclosed block, even if it raises
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def maybe_flush(self):
+        if time() - self.lastflush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+            gauges, self.gauges = self.gauges, dict()
+            self.lastflush = time()
+        if self.rediscli is None or not (pending or gauges):
+            return
+        try:
+            p = self.rediscli.pipeline(transaction=False)
+            for name, fields in pending.items():
+                for field, value in fields.items():
+                    p.hincrbyfloat(f"metrics-{name}", field, value)
+            for name, fields in gauges.items():
+                p.hset(f"metrics-{name}", mapping=fields)
+            p.execute()
+        except Exception as e:
+            get_logger("Metrics").error(f"failed flushing metrics to redis: {e}")
+
+    def render(self):
+        """
+        returns all the metrics of the deployment in the prometheus text format
+        """
+        self.flush()
+        lines = list()
+        for name, (mtype, mhelp, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {mhelp}")
+            lines.append(f"# TYPE {name} {mtype}")
+            if self.rediscli is None:
+                continue
+            values = {
+                k.decode(): float(v)
+                for k, v in self.rediscli.hgetall(f"metrics-{name}").items()
+            }
+            if mtype != "histogram":
+                for ls, v in sorted(values.items()):
+                    lines.append(f"{name}{{{ls}}} {v:g}")
+                continue
+            for ls in sorted({k.rpartition("|")[0] for k in values}):
+                sep = "," if ls else ""
+                for b in list(buckets) + ["+Inf"]:
+                    v = values.get(f"{ls}|{b}", 0)
+                    lines.append(f'{name}_bucket{{{ls}{sep}le="{b}"}} {v:g}')
+                lines.append(f"{name}_sum{{{ls}}} {values.get(f'{ls}|sum', 0):g}")
+                lines.append(f"{name}_count{{{ls}}} {values.get(f'{ls}|count', 0):g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
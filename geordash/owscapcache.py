@@ -5,68 +5,538 @@
 from owslib.wms import WebMapService
 from owslib.wfs import WebFeatureService
 from owslib.wmts import WebMapTileService
-from owslib.csw import CatalogueServiceWeb
-from owslib.fes import PropertyIsEqualTo, And
+from owslib.csw import CatalogueServiceWeb, CswRecord
+from owslib.catalogue.csw2 import CatalogueServiceWeb as CatalogueServiceWeb202
+from owslib.fes import PropertyIsEqualTo, PropertyIsGreaterThanOrEqualTo, And
 from owslib.util import ServiceException
+from owslib.etree import etree
 from requests.exceptions import HTTPError, SSLError, ReadTimeout
 from urllib3.exceptions import MaxRetryError
 from lxml.etree import XMLSyntaxError
-from time import time
+from io import BytesIO
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time, perf_counter, sleep
+from datetime import datetime, timezone
 
 from redis import Redis
+from redis.exceptions import LockError
 import jsonpickle
+import importlib
+import hashlib
 import os
 import sys
+import struct
 import threading
 import json
 import traceback
 import requests
+import socket
+import zlib
 
 from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.httpclient import session, owslib_session
+from geordash.probes import ReplaySession
 import gsdscanner
-from geordash.utils import find_geoserver_datadir
+from geordash.utils import find_geoserver_datadir, objtype
 
 non_harvested = PropertyIsEqualTo("isHarvested", "false")
+# when synchronizing csw records, also fetch the ones modified slightly before
+# the last sync, in case of clock skew with the catalog
+CSW_SYNC_MARGIN = 600
+
+""" storage format for CachedEntry objects in redis:
+- ENTRY_MAGIC followed by a format version byte
+- then a zlib-compressed payload made of:
+  - the length of the json header, as a 4-bytes big-endian integer
+  - the json header (stype, url, timestamp, summary, exception, blob lengths)
+  - the raw capabilities document
+  - in version 1, the raw xml of each csw record, in the order listed in the header
+the owslib objects are only rebuilt from the xml when accessed.
+since version 2, csw records are stored apart from the entry, in a redis hash
+(cf RecordStore) - the header only gives their amount, or None if they werent
+fetched.
+"""
+ENTRY_MAGIC = b"GAIACE"
+ENTRY_FORMAT_VERSION = 2
+
+# approximate ratio between the memory used by owslib/lxml objects and the
+# size of the xml they were parsed from, used for the in-memory tier accounting
+PARSED_XML_FACTOR = 8
+
+# pub/sub channel telling the other processes which in-memory entries are outdated
+INVALIDATION_CHANNEL = "owscache-invalidations"
+
+
+class CachedCatalogueServiceWeb(CatalogueServiceWeb202):
+    """
+    a CatalogueServiceWeb built from an already fetched capabilities document,
+    instead of sending a GetCapabilities request to the remote service.
+    subsequent requests (getrecords2, getrecordbyid..) go to the remote, to
+    the endpoints advertised by the capabilities.
+    """
+
+    def __init__(self, url, xml, timeout=60):
+        # owslib parses the cached document as the response to its
+        # GetCapabilities request, so that _invoke() isnt overridden: it
+        # finds the operation endpoints from the name of its caller
+        with owslib_session(ReplaySession(cached_response(url, xml))):
+            super().__init__(url, timeout=timeout)
+
+
+def cached_response(url, xml):
+    """
+    returns a requests response object holding an already fetched xml document
+    """
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.headers["Content-Type"] = "text/xml"
+    r._content = xml
+    return r
+
+
+def capabilities_xml(s):
+    """
+    returns the raw capabilities document backing an owslib service object
+    as bytes, or None if it can't be found
+    """
+    if isinstance(s, CatalogueServiceWeb202):
+        # _exml is overwritten by each request, only valid right after the fetch
+        return etree.tostring(s._exml)
+    if getattr(s, "_capabilities", None) is not None:
+        return etree.tostring(s._capabilities)
+    return None
+
+
+def layer_fingerprint(s, stype, name):
+    """
+    returns a hash of the properties of a layer whose change calls for checking
+    it again: its title, bbox, metadata urls, formats and styles
+    """
+    l = s.contents[name]
+    if stype == "wms":
+        # the getmap formats are advertised for the whole service
+        try:
+            formats = s.getOperationByName("GetMap").formatOptions
+        except KeyError:
+            formats = list()
+    elif stype == "wfs":
+        formats = getattr(l, "outputFormats", None)
+    else:
+        formats = getattr(l, "formats", None)
+    props = {
+        "title": l.title,
+        "bbox": l.boundingBoxWGS84,
+        "metadataUrls": sorted(m["url"] for m in getattr(l, "metadataUrls", list())),
+        "formats": formats,
+        "styles": sorted(getattr(l, "styles", None) or dict()),
+    }
+    return hashlib.sha1(
+        json.dumps(props, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# versions of the GetCapabilities requests, the same as the ones requested by owslib
+CAPABILITIES_VERSIONS = {"wms": "1.3.0", "wfs": "1.1.0", "wmts": "1.0.0", "csw": "2.0.2"}
+
+
+def capabilities_version(stype, previous):
+    """
+    returns the version in which to request the capabilities of a service: the
+    one of the previous entry if it was fetched successfully (eg wms services
+    only answering in 1.1.1), so that revalidating it compares and parses the
+    same document, else the default one
+    """
+    if previous is not None and previous.xml is not None and previous.summary:
+        return previous.summary.get("version") or CAPABILITIES_VERSIONS[stype]
+    return CAPABILITIES_VERSIONS[stype]
+
+
+def capabilities_params(stype, version):
+    """
+    returns the query parameters of a GetCapabilities request for the given
+    service type and version
+    """
+    return {"service": stype.upper(), "request": "GetCapabilities", "version": version}
+
+
+def root_attribute(xml, name):
+    """
+    returns the given attribute of the root element of an xml document,
+    without parsing the whole document
+    """
+    try:
+        for event, elem in etree.iterparse(BytesIO(xml), events=("start",)):
+            return elem.get(name)
+    except XMLSyntaxError:
+        pass
+    return None
+
+
+def restore_exception(e):
+    """
+    rebuild a cached exception from its type name and message, falls back
+    to a plain Exception if the type can't be found or instantiated
+    """
+    module, _, name = e["type"].rpartition(".")
+    try:
+        k = getattr(importlib.import_module(module), name)
+        if isinstance(k, type) and issubclass(k, BaseException):
+            return k(e["str"])
+    except Exception:
+        pass
+    return Exception(e["str"])
+
+
+class RecordStore(MutableMapping):
+    """
+    dict-like view over the csw records of a cached entry, stored in the
+    records-<entry key> redis hash as one field per record (its zlib-compressed
+    xml), the field names being the uuids index. records are only fetched and
+    parsed when accessed, and updating a record only writes that one.
+    """
+
+    def __init__(self, rediscli, rkey):
+        self.rediscli = rediscli
+        self.rkey = rkey
+        self.key = f"records-{rkey}"
+
+    def __getitem__(self, uuid):
+        x = self.rediscli.hget(self.key, uuid)
+        if x is None:
+            raise KeyError(uuid)
+        return CswRecord(etree.fromstring(zlib.decompress(x)))
+
+    def __setitem__(self, uuid, r):
+        if getattr(r, "xml", None) is None:
+            get_logger("OwsCapCache").warning(
+                f"record {uuid} has no xml, not persisting it in {self.key}"
+            )
+            return
+        p = self.rediscli.pipeline()
+        p.hset(self.key, uuid, zlib.compress(r.xml))
+        p.ttl(self.key)
+        p.ttl(self.rkey)
+        _, ttl, ettl = p.execute()
+        # the hash was created by this write, expire it along with the entry
+        if ttl < 0 and ettl > 0:
+            self.rediscli.expire(self.key, ettl)
+
+    def __delitem__(self, uuid):
+        if not self.rediscli.hdel(self.key, uuid):
+            raise KeyError(uuid)
+
+    def __contains__(self, uuid):
+        return bool(self.rediscli.hexists(self.key, uuid))
+
+    def __iter__(self):
+        for uuid in self.rediscli.hkeys(self.key):
+            yield uuid.decode()
+
+    def __len__(self):
+        return self.rediscli.hlen(self.key)
+
+    def items(self):
+        for uuid, x in self.rediscli.hscan_iter(self.key):
+            yield (uuid.decode(), CswRecord(etree.fromstring(zlib.decompress(x))))
+
+    def values(self):
+        for uuid, r in self.items():
+            yield r
 
 
 class CachedEntry:
+    # csw records harvesting settings, overridden from config.py by OwsCapCache
+    csw_page_size = 100
+    csw_harvest_workers = 4
+
     def __init__(self, stype, url):
         self.stype = stype
         self.url = url
-        self.s = None
-        self.records = None
+        self._s = None
+        # raw capabilities document, used to rebuild self._s on demand
+        self.xml = None
+        # compact description of the service, usable without rebuilding self._s
+        self.summary = None
+        self._records = None
+        # raw xml of each csw record by uuid, used to rebuild self._records on demand
+        self._recordsxml = None
         self.timestamp = None
         self.exception = None
+        # http validators returned with the capabilities, for conditional requests
+        self.etag = None
+        self.lastmodified = None
+        # when the csw records were last synchronized with the catalog
+        self.lastsync = None
+        # for failures, amount of consecutive failed fetches and when to retry
+        self.failures = 0
+        self.retry_at = None
+        # incremented each time the entry is persisted in redis
+        self.revision = None
+        # the csw records were synchronized in memory and not persisted yet
+        self.dirty = False
+
+    @property
+    def s(self):
+        if self._s is None and self.xml is not None:
+            self._s = self.build_service()
+        return self._s
+
+    @s.setter
+    def s(self, value):
+        self._s = value
+
+    @property
+    def records(self):
+        if self._records is None and self._recordsxml is not None:
+            self._records = dict()
+            for uuid, x in self._recordsxml.items():
+                self._records[uuid] = CswRecord(etree.fromstring(x))
+            self._recordsxml = None
+        return self._records
+
+    @records.setter
+    def records(self, value):
+        self._records = value
+        self._recordsxml = None
+
+    def build_service(self):
+        """
+        instantiate the owslib service object from the cached capabilities document
+        """
+        start = time()
+        version = self.summary.get("version") if self.summary else None
+        if self.stype == "wms":
+            s = WebMapService(self.url, version=version or "1.3.0", xml=self.xml)
+        elif self.stype == "wfs":
+            s = WebFeatureService(self.url, version=version or "1.1.0", xml=self.xml)
+        elif self.stype == "wmts":
+            s = WebMapTileService(self.url, xml=self.xml)
+        elif self.stype == "csw":
+            s = CachedCatalogueServiceWeb(self.url, self.xml)
+        else:
+            return None
+        get_logger("OwsCapCache").debug(
+            f"rebuilt {self.stype} service object for {self.url} from {len(self.xml)} bytes of capabilities in {time() - start:.3f}s"
+        )
+        return s
+
+    def set_service(self, s):
+        """
+        sets the freshly fetched owslib service object, keeping its raw
+        capabilities document and a summary of it for persistence
+        """
+        self.s = s
+        self.xml = capabilities_xml(s)
+        self.summary = {
+            "version": s.version,
+            "updateSequence": s.updateSequence,
+            "title": s.identification.title if s.identification else None,
+        }
+        if self.stype in ("wms", "wmts", "wfs"):
+            self.summary["names"] = list(s.contents.keys())
+            self.summary["fingerprints"] = self.fingerprints()
+
+    def names(self):
+        """
+        returns the layer names of the service, without rebuilding self._s if possible
+        """
+        if self._s is None and self.summary is not None:
+            return self.summary.get("names", list())
+        if self.s is None:
+            return list()
+        return list(self.s.contents.keys())
+
+    def fingerprints(self):
+        """
+        returns the fingerprint of each layer of the service (cf
+        layer_fingerprint), without rebuilding self._s if possible
+        """
+        if self._s is None and self.summary is not None:
+            if "fingerprints" in self.summary:
+                return self.summary["fingerprints"]
+        if self.s is None or self.stype not in ("wms", "wmts", "wfs"):
+            return dict()
+        return {n: layer_fingerprint(self.s, self.stype, n) for n in self.s.contents}
+
+    def updatesequence(self):
+        if self._s is None and self.summary is not None:
+            return self.summary.get("updateSequence")
+        return self.s.updateSequence if self.s is not None else None
 
     def nelems(self):
+        if self.exception is not None:
+            return 0
         if self.stype in ("wms", "wmts", "wfs"):
+            if self._s is None and self.summary is not None:
+                return len(self.summary["names"])
             return len(self.s.contents)
         else:
+            if self._recordsxml is not None:
+                return len(self._recordsxml)
             if self.records:
                 return len(self.records)
             else:
                 return 0
 
+    def records_xml(self):
+        """
+        returns the raw xml of the in-memory csw records by uuid, or None if
+        the records werent fetched or are already in a RecordStore
+        """
+        if self._recordsxml is not None:
+            return self._recordsxml
+        if self._records is None or isinstance(self._records, RecordStore):
+            return None
+        recordsxml = dict()
+        for uuid, r in self._records.items():
+            if getattr(r, "xml", None) is None:
+                get_logger("OwsCapCache").warning(
+                    f"record {uuid} from {self.url} has no xml, not persisting it"
+                )
+                continue
+            recordsxml[uuid] = r.xml
+        return recordsxml
+
+    def dumps(self):
+        """
+        serializes the entry to bytes, cf the storage format described above.
+        the csw records themselves have to be persisted separately.
+        """
+        blobs = list()
+        header = {
+            "stype": self.stype,
+            "url": self.url,
+            "timestamp": self.timestamp,
+            "summary": self.summary,
+            "exception": None,
+            "etag": self.etag,
+            "lastmodified": self.lastmodified,
+            "lastsync": self.lastsync,
+            "failures": self.failures,
+            "retry_at": self.retry_at,
+            "revision": self.revision,
+            "xml": 0,
+            "records": None,
+        }
+        if self.exception is not None:
+            header["exception"] = {
+                "type": objtype(self.exception),
+                "str": str(self.exception),
+            }
+        if self.xml is not None:
+            header["xml"] = len(self.xml)
+            blobs.append(self.xml)
+        if self._recordsxml is not None or self._records is not None:
+            header["records"] = self.nelems()
+        jheader = json.dumps(header).encode("utf-8")
+        payload = b"".join([struct.pack(">I", len(jheader)), jheader] + blobs)
+        return ENTRY_MAGIC + bytes([ENTRY_FORMAT_VERSION]) + zlib.compress(payload)
+
+    @staticmethod
+    def header(blob):
+        """
+        returns the json header of a serialized entry (with its stype, url and
+        timestamp) without decompressing the documents following it, or None
+        if the blob isnt in a supported storage format. the blob can be only
+        the start of the entry, None is also returned if it doesnt hold the
+        whole header
+        """
+        if len(blob) <= len(ENTRY_MAGIC) or blob[: len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+            return None
+        if blob[len(ENTRY_MAGIC)] not in (1, ENTRY_FORMAT_VERSION):
+            return None
+        d = zlib.decompressobj()
+        payload = d.decompress(blob[len(ENTRY_MAGIC) + 1 :], 4)
+        if len(payload) < 4:
+            return None
+        (hlen,) = struct.unpack_from(">I", payload)
+        while len(payload) < 4 + hlen and not d.eof:
+            more = d.decompress(d.unconsumed_tail, 4 + hlen - len(payload))
+            if len(more) == 0:
+                return None
+            payload += more
+        if len(payload) < 4 + hlen:
+            return None
+        return json.loads(payload[4 : 4 + hlen])
+
+    @classmethod
+    def loads(cls, blob, recordstore=None):
+        """
+        deserializes an entry from bytes, returns None if the blob isnt in
+        a supported storage format. if the entry has csw records, they're
+        accessed via the given RecordStore
+        """
+        if blob[: len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+            return None
+        version = blob[len(ENTRY_MAGIC)]
+        if version not in (1, ENTRY_FORMAT_VERSION):
+            get_logger("OwsCapCache").warning(
+                f"unsupported cached entry format version {version}, ignoring it"
+            )
+            return None
+        payload = zlib.decompress(blob[len(ENTRY_MAGIC) + 1 :])
+        (hlen,) = struct.unpack_from(">I", payload)
+        pos = 4 + hlen
+        header = json.loads(payload[4:pos])
+        ce = cls(header["stype"], header["url"])
+        ce.timestamp = header["timestamp"]
+        ce.summary = header["summary"]
+        ce.etag = header.get("etag")
+        ce.lastmodified = header.get("lastmodified")
+        ce.lastsync = header.get("lastsync")
+        ce.failures = header.get("failures", 0)
+        ce.retry_at = header.get("retry_at")
+        ce.revision = header.get("revision")
+        if header["exception"] is not None:
+            ce.exception = restore_exception(header["exception"])
+        if header["xml"] > 0:
+            ce.xml = payload[pos : pos + header["xml"]]
+            pos += header["xml"]
+        if version > 1:
+            if header["records"] is not None and recordstore is not None:
+                ce._records = recordstore
+        elif header["records"] is not None:
+            ce._recordsxml = dict()
+            for uuid, length in header["records"]:
+                ce._recordsxml[uuid] = payload[pos : pos + length]
+                pos += length
+        return ce
+
+    def approx_size(self):
+        """
+        rough estimation of the memory used by this entry, from the size of
+        the raw xml documents and whether they were parsed into owslib objects
+        """
+        size = 0
+        if self.xml is not None:
+            size += len(self.xml)
+            if self._s is not None:
+                size += len(self.xml) * PARSED_XML_FACTOR
+        if self._recordsxml is not None:
+            size += sum(len(x) for x in self._recordsxml.values())
+        elif isinstance(self._records, dict):
+            size += sum(
+                len(getattr(r, "xml", b"")) * (1 + PARSED_XML_FACTOR)
+                for r in self._records.values()
+            )
+        return size
+
     def contents(self):
         if self.stype in ("wms", "wmts", "wfs"):
             return self.s.contents
-        if self.stype == "csw" and self.s is not None and self.records is None:
-            self.records = dict()
-            startpos = 0
-            while True:
-                self.s.getrecords2(
-                    constraints=[non_harvested],
-                    esn="full",
-                    startposition=startpos,
-                    maxrecords=100,
-                )
-                self.records |= self.s.records
-                get_logger("OwsCapCache").debug(
-                    f"start = {startpos}, res={self.s.results}, returned {len(self.s.records)}, mds={len(self.records)}"
-                )
-                startpos = self.s.results["nextrecord"]  # len(mds) + 1
-                if startpos > self.s.results["matches"] or startpos == 0:
-                    break
+        if (
+            self.stype == "csw"
+            and self.s is not None
+            and (
+                self.records is None
+                or (self.lastsync is not None and self.lastsync < self.timestamp)
+            )
+        ):
+            self.sync()
             get_logger("OwsCapCache").info(
                 f"cached {len(self.records)} csw records for {self.url}"
             )
@@ -76,6 +546,202 @@ class CachedEntry:
             )
         return self.records
 
+    def sync(self, full=False, progress=None):
+        """
+        synchronizes the csw records with the catalog. if they were never
+        fetched or if full is set, harvests all of them. otherwise, only
+        harvests the ones modified since the last sync and merges them, then
+        drops the ones removed from the catalog: if the amount of records in
+        the catalog differs from ours, a brief identifiers pass tells which.
+        progress is passed to harvest()
+        """
+        start = time()
+        if full or self.records is None or self.lastsync is None:
+            self.records = self.harvest([non_harvested], progress)
+            self.lastsync = start
+            self.dirty = True
+            return self.records
+        since = datetime.fromtimestamp(
+            self.lastsync - CSW_SYNC_MARGIN, timezone.utc
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        modified = self.harvest(
+            [And([non_harvested, PropertyIsGreaterThanOrEqualTo("Modified", since)])],
+            progress,
+        )
+        for uuid, r in modified.items():
+            self.records[uuid] = r
+        with owslib_session():
+            self.s.getrecords2(constraints=[non_harvested], resulttype="hits")
+        total = self.s.results["matches"]
+        deleted = list()
+        if total != len(self.records):
+            uuids = self.harvest([non_harvested], esn="brief")
+            deleted = [uuid for uuid in self.records if uuid not in uuids]
+            for uuid in deleted:
+                del self.records[uuid]
+        self.lastsync = start
+        self.dirty = True
+        get_logger("OwsCapCache").info(
+            f"synchronized csw records from {self.url} since {since}: {len(modified)} modified, {len(deleted)} deleted, {len(self.records)} records over {total}, took {time() - start:.2f}s"
+        )
+        return self.records
+
+    def harvest(self, constraints, progress=None, esn="full"):
+        """
+        fetches all the csw records matching the constraints: gets their amount
+        with a hits request, then fetches the pages concurrently in a bounded
+        pool of workers, each using its own service object built from the
+        cached capabilities. returns the records by uuid, in the catalog order.
+        progress is called with (fetched, total) as pages come in.
+        """
+        start = time()
+        with owslib_session():
+            self.s.getrecords2(constraints=constraints, resulttype="hits")
+        total = self.s.results["matches"]
+        pagesize = self.csw_page_size
+        positions = list(range(1, total + 1, pagesize))
+        # without the capabilities document, cant build other service objects
+        workers = self.csw_harvest_workers if self.xml is not None else 1
+        workers = max(1, min(workers, len(positions)))
+        local = threading.local()
+
+        def fetch_page(position):
+            if not hasattr(local, "s"):
+                local.s = (
+                    CachedCatalogueServiceWeb(self.url, self.xml)
+                    if workers > 1
+                    else self.s
+                )
+            with owslib_session():
+                local.s.getrecords2(
+                    constraints=constraints,
+                    esn=esn,
+                    startposition=position,
+                    maxrecords=pagesize,
+                )
+            get_logger("OwsCapCache").debug(
+                f"start = {position}, res={local.s.results}, returned {len(local.s.records)}"
+            )
+            return local.s.records
+
+        records = dict()
+        fetched = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages = [pool.submit(fetch_page, position) for position in positions]
+            for page in as_completed(pages):
+                fetched += len(page.result())
+                if progress is not None:
+                    progress(fetched, total)
+        for page in pages:
+            records |= page.result()
+        get_logger("OwsCapCache").info(
+            f"harvested {len(records)} csw records over {total} from {self.url} in {len(positions)} pages of {pagesize} with {workers} workers, took {time() - start:.2f}s"
+        )
+        return records
+
+
+class MemoryTier:
+    """
+    bounded in-process tier of the capabilities cache: an LRU of CachedEntry
+    objects keyed by (stype, url), evicting the least recently used entries
+    when their approximate total size goes over the byte budget, and the ones
+    that havent been used for more than idle_ttl seconds
+    """
+
+    def __init__(self, budget, idle_ttl):
+        self.budget = budget
+        self.idle_ttl = idle_ttl
+        # (stype, url) -> [entry, estimated size, last use]
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        # gunicorn gthread workers share the tier between threads
+        self.lock = threading.Lock()
+
+    def peek(self, stype, url):
+        """
+        returns the entry without touching the LRU order nor the stats
+        """
+        with self.lock:
+            e = self.entries.get((stype, url))
+            return e[0] if e else None
+
+    def get(self, stype, url):
+        with self.lock:
+            self.expire()
+            e = self.entries.get((stype, url))
+            if e is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.entries.move_to_end((stype, url))
+            e[2] = time()
+            # the entry grows when its service object or records are built
+            size = e[0].approx_size()
+            self.size += size - e[1]
+            e[1] = size
+            self.evict()
+            return e[0]
+
+    def put(self, stype, url, entry):
+        with self.lock:
+            old = self.entries.pop((stype, url), None)
+            if old is not None:
+                self.size -= old[1]
+            size = entry.approx_size()
+            self.entries[(stype, url)] = [entry, size, time()]
+            self.size += size
+            self.expire()
+            self.evict()
+
+    def pop(self, stype, url):
+        with self.lock:
+            e = self.entries.pop((stype, url), None)
+            if e is None:
+                return None
+            self.size -= e[1]
+            return e[0]
+
+    def expire(self):
+        now = time()
+        for k in list(self.entries.keys()):
+            e = self.entries[k]
+            if e[2] + self.idle_ttl > now:
+                # ordered by last use, the others are more recent
+                break
+            del self.entries[k]
+            self.size -= e[1]
+            self.stats["expirations"] += 1
+
+    def evict(self):
+        # always keep the most recently used entry, even if over budget
+        while self.size > self.budget and len(self.entries) > 1:
+            k, e = self.entries.popitem(last=False)
+            self.size -= e[1]
+            self.stats["evictions"] += 1
+            get_logger("OwsCapCache").debug(
+                f"evicted {k[0]} {k[1]} ({e[1]} bytes) from in-memory cache, now using {self.size}/{self.budget} bytes"
+            )
+
+    def resident(self):
+        """
+        returns the list of resident entries with their estimated size, from
+        the least to the most recently used
+        """
+        with self.lock:
+            return [
+                {
+                    "stype": k[0],
+                    "url": k[1],
+                    "size": e[1],
+                    "lastused": e[2],
+                    "timestamp": e[0].timestamp,
+                    "nelems": e[0].nelems() if e[0].exception is None else 0,
+                    "parsed": e[0]._s is not None,
+                }
+                for k, e in self.entries.items()
+            ]
+
 
 """ poorman's in-memory capabilities cache
 keep a timestamp for the last fetch, refresh every 12h by default, and
@@ -85,29 +751,77 @@ force-fetch on demand.
 
 class OwsCapCache:
     def __init__(self, conf, app):
-        self.services = dict()
         self.cache_lifetime = 12 * 60 * 60
+        # in-memory geoserver datadir view
+        self.gsdd = None
+        # conditional GetCapabilities requests stats, for this process
+        self.revalidation_hits = 0
+        self.revalidation_misses = 0
+        # pid of the process listening for invalidations, cf ensure_subscriber()
+        self.subscriber_pid = None
         try:
+            import config
             from config import url
 
+            self.revalidation = getattr(config, "capabilities_revalidation", True)
+            # after that delay a fetch lock is considered stale (eg crashed fetcher)
+            self.fetch_lock_timeout = getattr(
+                config, "capabilities_fetch_lock_timeout", 180
+            )
+            # serve expired entries while refreshing them in the background
+            self.stale_while_revalidate = getattr(
+                config, "capabilities_stale_while_revalidate", False
+            )
+            self.max_staleness = getattr(config, "capabilities_max_staleness", 86400)
+            # entries expiring within refresh_ahead seconds are refreshed in the
+            # background, with at most refresh_per_host concurrent refreshes per host
+            self.refresh_ahead = getattr(config, "capabilities_refresh_ahead", 1800)
+            self.refresh_per_host = getattr(config, "capabilities_refresh_per_host", 2)
+            # concurrent fetches when warming up the cache
+            self.warmup_workers = getattr(config, "capabilities_warmup_workers", 8)
+            # failed fetches are retried after failure_backoff seconds, doubling
+            # after each consecutive failure up to failure_backoff_max
+            self.failure_backoff = getattr(config, "capabilities_failure_backoff", 120)
+            self.failure_backoff_max = getattr(
+                config, "capabilities_failure_backoff_max", 3600
+            )
+            CachedEntry.csw_page_size = getattr(config, "csw_harvest_page_size", 100)
+            CachedEntry.csw_harvest_workers = getattr(config, "csw_harvest_workers", 4)
+            self.services = MemoryTier(
+                getattr(config, "capabilities_memory_budget", 512 * 1024 * 1024),
+                getattr(config, "capabilities_memory_idle_ttl", self.cache_lifetime),
+            )
             self.rediscli = Redis.from_url(url)
             self.conf = conf
         except:
             get_logger("OwsCapCache").error(f"wrong can't set redis url {url}")
 
+    def load_entry_from_redis(self, rkey):
+        """
+        returns a CachedEntry object regardless of its timestamp, or None if not found
+        """
+        re = self.rediscli.get(rkey)
+        if not re:
+            return None
+        ce = CachedEntry.loads(re, RecordStore(self.rediscli, rkey))
+        if ce is not None and re[len(ENTRY_MAGIC)] < ENTRY_FORMAT_VERSION:
+            self.rewrite_entry(rkey, ce)
+        if ce is None:
+            # eg persisted as jsonpickle'd objects by an older version, it
+            # will be replaced when fetched again
+            get_logger("OwsCapCache").warning(
+                f"cached entry behind {rkey} couldnt be decoded, ignoring it"
+            )
+        return ce
+
     def get_entry_from_redis(self, rkey, force_fetch=False):
         """
         returns a CachedEntry object, or None if not found
         """
-        re = self.rediscli.get(rkey)
-        if re:
-            ce = jsonpickle.decode(json.loads(re.decode("utf-8")))
+        ce = self.load_entry_from_redis(rkey)
+        if ce:
             # if found, only return fetched value from redis if ts is valid
-            if type(ce) != CachedEntry:
-                get_logger("OwsCapCache").error(
-                    f"cached entry behind {rkey} isnt a CachedEntry but a {type(ce)}?"
-                )
-            elif ce.timestamp + self.cache_lifetime > time() and not force_fetch:
+            if self.is_fresh(ce, force_fetch):
                 ttl = self.rediscli.ttl(rkey)
                 get_logger("OwsCapCache").debug(
                     f"returning {rkey} entry from redis cache with {ce.nelems()} items, ts={ce.timestamp} (and redis ttl {ttl})"
@@ -115,25 +829,114 @@ class OwsCapCache:
                 return ce
         return None
 
+    def rewrite_entry(self, rkey, ce):
+        """
+        persists an entry decoded from an older storage format in the current
+        one, keeping its remaining ttl
+        """
+        ttl = self.rediscli.ttl(rkey)
+        if ce.stype == "csw":
+            self.set_records_in_redis(rkey, ce, ttl if ttl > 0 else self.cache_lifetime)
+        self.rediscli.set(rkey, ce.dumps())
+        if ttl > 0:
+            self.rediscli.expire(rkey, ttl)
+        get_logger("OwsCapCache").info(
+            f"migrated entry behind {rkey} to format version {ENTRY_FORMAT_VERSION}, ttl {ttl}"
+        )
+
     def fetch(self, service_type, url, force_fetch=False):
         if service_type not in ("wms", "wmts", "wfs", "csw"):
             return None
         # check first in redis
         rkey = f"{service_type}-{url.replace('/','~')}"
         re = self.get_entry_from_redis(rkey, force_fetch)
+        metrics.inc(
+            "gaia_owscache_lookups_total",
+            stype=service_type,
+            tier="redis",
+            result="hit" if re else "miss",
+        )
         if re:
-            self.services[service_type][url] = re
+            self.services.put(service_type, url, re)
             return re
 
+        previous = self.services.peek(service_type, url)
+        if previous is None:
+            previous = self.load_entry_from_redis(rkey)
+        if (
+            not force_fetch
+            and previous is not None
+            and self.serve_stale(service_type, url, rkey, previous)
+        ):
+            return previous
+        # only one process at a time fetches a given service, the others
+        # return the stale entry or wait for the fetcher to persist its result
+        lock = self.rediscli.lock(f"lock-{rkey}", timeout=self.fetch_lock_timeout)
+        if not lock.acquire(blocking=False):
+            if previous is not None and not force_fetch:
+                get_logger("OwsCapCache").info(
+                    f"{service_type} getcapabilities for {url} already being fetched by another process, returning stale entry with ts={previous.timestamp}"
+                )
+                self.services.put(service_type, url, previous)
+                return previous
+            waitstart = time()
+            get_logger("OwsCapCache").info(
+                f"{service_type} getcapabilities for {url} already being fetched by another process, waiting for it"
+            )
+            if lock.acquire(blocking_timeout=self.fetch_lock_timeout):
+                re = self.load_entry_from_redis(rkey)
+                if re is not None and re.timestamp >= waitstart:
+                    lock.release()
+                    get_logger("OwsCapCache").debug(
+                        f"got {service_type} getcapabilities for {url} fetched by another process after {time() - waitstart:.1f}s"
+                    )
+                    self.services.put(service_type, url, re)
+                    return re
+            else:
+                get_logger("OwsCapCache").warning(
+                    f"gave up waiting for another process fetching {service_type} getcapabilities for {url}, fetching it"
+                )
+        try:
+            return self.fetch_remote(service_type, url, rkey, previous)
+        finally:
+            try:
+                if lock.owned():
+                    lock.release()
+            except LockError:
+                # the lock expired while fetching
+                pass
+
+    def fetch_remote(self, service_type, url, rkey, previous):
+        """
+        fetches the capabilities from the remote service, and persists the
+        resulting entry in redis
+        """
+        start = perf_counter()
+        xml = None
+        validators = (None, None)
+        version = capabilities_version(service_type, previous)
+        if self.revalidation:
+            unchanged, xml, validators = self.revalidate(
+                service_type, url, previous, version
+            )
+            if unchanged:
+                self.record_fetch(previous, start, "notmodified")
+                previous.timestamp = time()
+                previous.etag, previous.lastmodified = validators
+                self.services.put(service_type, url, previous)
+                self.set_entry_in_redis(rkey, previous)
+                return previous
+
         get_logger("OwsCapCache").info(
             "fetching {} getcapabilities for {}".format(service_type, url)
         )
         entry = CachedEntry(service_type, url)
+        entry.etag, entry.lastmodified = validators
         try:
             # XX consider passing parse_remote_metadata ?
             if service_type == "wms":
                 try:
-                    entry.s = WebMapService(url, version="1.3.0")
+                    entry.set_service(WebMapService(url, version=version, xml=xml))
                 except (AttributeError, ServiceException) as e:
                     # XXX hack parses the 403 page returned by the s-p ?
                     if (
@@ -150,16 +953,20 @@ class OwsCapCache:
                     else:
                         err = traceback.format_exception(e, limit=-1)
                         get_logger("OwsCapCache").error(
-                            f"failed loading {service_type} 1.3.0, exception catched: {err[-1]}"
+                            f"failed loading {service_type} {version}, exception catched: {err[-1]}"
                         )
                         get_logger("OwsCapCache").info("retrying with version=1.1.1")
-                        entry.s = WebMapService(url, version="1.1.1")
+                        entry.etag, entry.lastmodified = (None, None)
+                        entry.set_service(WebMapService(url, version="1.1.1"))
             elif service_type == "wfs":
-                entry.s = WebFeatureService(url, version="1.1.0")
+                entry.set_service(WebFeatureService(url, version=version, xml=xml))
             elif service_type == "csw":
-                entry.s = CatalogueServiceWeb(url, timeout=60)
+                if xml is not None:
+                    entry.set_service(CachedCatalogueServiceWeb(url, xml))
+                else:
+                    entry.set_service(CatalogueServiceWeb(url, timeout=60))
             elif service_type == "wmts":
-                entry.s = WebMapTileService(url)
+                entry.set_service(WebMapTileService(url, xml=xml))
         except ServiceException as e:
             # XXX hack parses the 403 page returned by the s-p ?
             if type(e.args) == tuple and (
@@ -203,63 +1010,416 @@ class OwsCapCache:
             entry.s = None
             # cache the failure
             entry.exception = e
+        if (
+            service_type == "csw"
+            and entry.exception is None
+            and previous is not None
+            and previous.records is not None
+            and previous.lastsync is not None
+        ):
+            # keep the known records, contents() will synchronize them incrementally
+            entry.records = previous.records
+            entry.lastsync = previous.lastsync
         entry.timestamp = time()
-        self.services[service_type][url] = entry
+        if entry.exception is not None:
+            self.set_failure_backoff(entry, previous)
+        self.record_fetch(
+            entry, start, "success" if entry.exception is None else "failure"
+        )
+        self.services.put(service_type, url, entry)
         # persist entry in redis
         self.set_entry_in_redis(rkey, entry)
         return entry
 
+    def record_fetch(self, entry, start, result):
+        """
+        records the metrics of a remote capabilities fetch started at start
+        """
+        metrics.inc(
+            "gaia_owscache_lookups_total",
+            stype=entry.stype,
+            tier="remote",
+            result=result,
+        )
+        metrics.observe(
+            "gaia_capabilities_fetch_seconds",
+            perf_counter() - start,
+            stype=entry.stype,
+            url=entry.url,
+        )
+        if entry.xml is not None:
+            metrics.set(
+                "gaia_capabilities_size_bytes",
+                len(entry.xml),
+                stype=entry.stype,
+                url=entry.url,
+            )
+
+    def revalidate(self, service_type, url, previous, version):
+        """
+        sends a GetCapabilities request in the given version (the one of the
+        previous entry, cf capabilities_version), made conditional by the
+        validators (etag/last-modified/updateSequence) of the previous entry if any.
+        returns a tuple with:
+        - whether the previous entry is still valid
+        - the capabilities document if it was fully downloaded and has
+          changed, None if owslib should fetch it by itself (eg on errors)
+        - the (etag, last-modified) validators sent by the remote
+        """
+        if previous is not None and previous.xml is None:
+            # previous failure, nothing to revalidate
+            previous = None
+        headers = dict()
+        params = capabilities_params(service_type, version)
+        if previous is not None:
+            if previous.etag:
+                headers["If-None-Match"] = previous.etag
+            if previous.lastmodified:
+                headers["If-Modified-Since"] = previous.lastmodified
+            if previous.summary.get("updateSequence"):
+                # geoserver answers with a short CurrentUpdateSequence exception if unchanged
+                params["updateSequence"] = previous.summary["updateSequence"]
+        try:
+            r = session().get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=60 if service_type == "csw" else 30,
+            )
+        except Exception as e:
+            get_logger("OwsCapCache").debug(
+                f"conditional getcapabilities on {service_type} {url} failed with {objtype(e)}, letting owslib fetch it"
+            )
+            return (False, None, (None, None))
+        validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        reason = None
+        if previous is not None:
+            if r.status_code == 304:
+                reason = "not modified"
+            elif r.status_code == 200 and b"CurrentUpdateSequence" in r.content[:1024]:
+                reason = "current updateSequence"
+            elif (
+                r.status_code == 200
+                and previous.summary.get("updateSequence") is not None
+                and root_attribute(r.content, "updateSequence")
+                == previous.summary["updateSequence"]
+            ):
+                reason = "same updateSequence"
+        if reason is not None:
+            self.revalidation_hits += 1
+            if validators == (None, None):
+                validators = (previous.etag, previous.lastmodified)
+            get_logger("OwsCapCache").info(
+                f"cached {service_type} getcapabilities for {url} still valid ({reason}), revalidation hits={self.revalidation_hits} misses={self.revalidation_misses}"
+            )
+            return (True, None, validators)
+        if previous is not None:
+            self.revalidation_misses += 1
+            get_logger("OwsCapCache").info(
+                f"cached {service_type} getcapabilities for {url} changed (http {r.status_code}), revalidation hits={self.revalidation_hits} misses={self.revalidation_misses}"
+            )
+        if r.status_code != 200 or b"UpdateSequence" in r.content[:1024]:
+            # errors and updateSequence exceptions are left to owslib
+            return (False, None, (None, None))
+        return (False, r.content, validators)
+
+    def is_fresh(self, entry, force_fetch=False):
+        """
+        returns True if the entry can be used without refetching it: failures
+        are kept until their next retry time even when forcing a fetch, so that
+        a broken service isnt hammered, and successes for cache_lifetime
+        """
+        if entry.exception is not None and entry.retry_at is not None:
+            return time() < entry.retry_at
+        return entry.timestamp + self.cache_lifetime > time() and not force_fetch
+
+    def set_failure_backoff(self, entry, previous):
+        """
+        counts the consecutive failures of a freshly failed entry, and sets
+        its next retry time with an exponential backoff
+        """
+        entry.failures = 1
+        if previous is not None and previous.exception is not None:
+            entry.failures = previous.failures + 1
+        delay = min(
+            self.failure_backoff * 2 ** (entry.failures - 1), self.failure_backoff_max
+        )
+        entry.retry_at = entry.timestamp + delay
+        get_logger("OwsCapCache").warning(
+            f"{entry.failures} consecutive failures fetching {entry.stype} {entry.url}, last a {objtype(entry.exception)}, next retry in {delay}s"
+        )
+
+    def is_stale(self, entry):
+        return entry.timestamp + self.cache_lifetime < time()
+
+    def serve_stale(self, service_type, url, rkey, entry):
+        """
+        in stale-while-revalidate mode, returns True if the given expired
+        entry can still be served, after having queued a background refresh
+        """
+        if not self.stale_while_revalidate or entry.exception is not None:
+            return False
+        age = time() - entry.timestamp
+        if age < self.cache_lifetime or age > self.cache_lifetime + self.max_staleness:
+            return False
+        # only queue one refresh at a time for a given entry
+        if self.rediscli.set(f"refresh-{rkey}", 1, nx=True, ex=self.fetch_lock_timeout):
+            from geordash.tasks.capabilities import refresh_capabilities
+
+            refresh_capabilities.delay(service_type, url)
+            get_logger("OwsCapCache").info(
+                f"queued a background refresh of {service_type} getcapabilities for {url}"
+            )
+        get_logger("OwsCapCache").debug(
+            f"returning stale {service_type} getcapabilities for {url}, ts={entry.timestamp} (age {int(age)}s)"
+        )
+        self.services.put(service_type, url, entry)
+        return True
+
     def set_entry_in_redis(self, rkey, entry):
-        if entry.exception is not None:
-            json_entry = json.dumps(jsonpickle.encode(entry, unpicklable=False))
-        else:
-            json_entry = json.dumps(jsonpickle.encode(entry))
-        self.rediscli.set(rkey, json_entry)
-        self.rediscli.expire(rkey, self.cache_lifetime)
+        ttl = self.cache_lifetime
+        if self.stale_while_revalidate:
+            # keep expired entries around to serve them while refreshing
+            ttl += self.max_staleness
+        if entry.stype == "csw":
+            self.set_records_in_redis(rkey, entry, ttl)
+        p = self.rediscli.pipeline()
+        p.incr(f"revision-{rkey}")
+        p.expire(f"revision-{rkey}", ttl)
+        entry.revision, _ = p.execute()
+        entry.dirty = False
+        self.rediscli.set(rkey, entry.dumps())
+        self.rediscli.expire(rkey, ttl)
+        self.publish_invalidation(entry.stype, entry.url, entry.revision)
+        if entry.stype in ("wms", "wmts", "wfs"):
+            self.set_names_in_redis(rkey, entry)
         if entry.exception is not None:
             get_logger("OwsCapCache").debug(
-                f"persisted {rkey} in redis with exception {type(entry.exception)}, ttl {self.cache_lifetime}, ts={entry.timestamp}"
+                f"persisted {rkey} in redis with exception {type(entry.exception)}, ttl {ttl}, ts={entry.timestamp}"
             )
         else:
             get_logger("OwsCapCache").debug(
-                f"persisted {rkey} in redis with nelems={entry.nelems()}, ttl {self.cache_lifetime}, ts={entry.timestamp}"
+                f"persisted {rkey} in redis with nelems={entry.nelems()}, ttl {ttl}, ts={entry.timestamp}"
+            )
+
+    def origin(self):
+        """
+        identifies this cache instance in the invalidation messages
+        """
+        return f"{socket.gethostname()}-{os.getpid()}-{id(self)}"
+
+    def publish_invalidation(self, stype, url, revision=None):
+        """
+        tells the other processes that their in-memory entry for stype/url is
+        outdated if older than revision (or in all cases if revision is None).
+        stype is None for the geoserver datadir view.
+        """
+        msg = {
+            "origin": self.origin(),
+            "stype": stype,
+            "url": url,
+            "revision": revision,
+        }
+        try:
+            self.rediscli.publish(INVALIDATION_CHANNEL, json.dumps(msg))
+        except Exception as e:
+            get_logger("OwsCapCache").error(
+                f"failed publishing invalidation of {stype} {url}: {objtype(e)} {str(e)}"
+            )
+
+    def ensure_subscriber(self):
+        """
+        starts listening for invalidations in the current process, if not done
+        yet - celery children are forked after the app creation, so this is
+        done lazily. entries inherited from the parent process might have
+        missed invalidations, so they're dropped.
+        """
+        if self.subscriber_pid == os.getpid():
+            return
+        self.subscriber_pid = os.getpid()
+        self.services = MemoryTier(self.services.budget, self.services.idle_ttl)
+        self.gsdd = None
+        pubsub = self.rediscli.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(INVALIDATION_CHANNEL)
+        threading.Thread(
+            name="owscache-invalidations",
+            target=self.listen_invalidations,
+            args=(pubsub,),
+            daemon=True,
+        ).start()
+
+    def listen_invalidations(self, pubsub):
+        origin = self.origin()
+        while True:
+            try:
+                for msg in pubsub.listen():
+                    if msg["type"] != "message":
+                        continue
+                    m = json.loads(msg["data"])
+                    if m["origin"] != origin:
+                        self.invalidate(m["stype"], m["url"], m["revision"])
+            except Exception as e:
+                get_logger("OwsCapCache").error(
+                    f"lost the invalidations channel ({objtype(e)} {str(e)}), resubscribing"
+                )
+                # we might have missed invalidations in between
+                self.services = MemoryTier(self.services.budget, self.services.idle_ttl)
+                self.gsdd = None
+                sleep(1)
+                try:
+                    pubsub = self.rediscli.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(INVALIDATION_CHANNEL)
+                except Exception:
+                    pass
+
+    def invalidate(self, stype, url, revision):
+        """
+        drops the in-memory entry for stype/url if older than revision, the
+        next get() will load the current one from redis
+        """
+        if stype is None:
+            self.gsdd = None
+            get_logger("OwsCapCache").debug(
+                "dropped the in-memory geoserver datadir view, updated elsewhere"
+            )
+            return
+        ce = self.services.peek(stype, url)
+        if ce is None:
+            return
+        if revision is None or ce.revision is None or ce.revision < revision:
+            self.services.pop(stype, url)
+            get_logger("OwsCapCache").debug(
+                f"dropped in-memory {stype} entry for {url} at revision {ce.revision}, now at {revision}"
             )
 
+    def set_records_in_redis(self, rkey, entry, ttl):
+        """
+        persists the in-memory csw records of the entry in its redis hash, and
+        replaces them by a RecordStore so that they dont stay in memory
+        """
+        store = RecordStore(self.rediscli, rkey)
+        if isinstance(entry._records, RecordStore):
+            self.rediscli.expire(store.key, ttl)
+            return
+        recordsxml = entry.records_xml()
+        if recordsxml is None:
+            self.rediscli.delete(store.key)
+            return
+        # fill a temporary hash and swap it, so that readers never see a partial set
+        tmpkey = f"{store.key}-new"
+        p = self.rediscli.pipeline()
+        p.delete(tmpkey)
+        uuids = list(recordsxml.keys())
+        for i in range(0, len(uuids), 1000):
+            p.hset(
+                tmpkey,
+                mapping={u: zlib.compress(recordsxml[u]) for u in uuids[i : i + 1000]},
+            )
+        if uuids:
+            p.rename(tmpkey, store.key)
+            p.expire(store.key, ttl)
+        else:
+            p.delete(store.key)
+        p.execute()
+        entry.records = store
+        get_logger("OwsCapCache").debug(
+            f"persisted {len(uuids)} csw records in {store.key}"
+        )
+
+    def set_names_in_redis(self, rkey, entry):
+        """
+        maintains the set of layer names of the service next to its entry, so that
+        has_layers() can answer without decoding it. the set expires when the entry
+        itself is considered expired, so that lookups go through get() again and
+        trigger a refresh.
+        """
+        nkey = f"names-{rkey}"
+        ttl = int(entry.timestamp + self.cache_lifetime - time())
+        p = self.rediscli.pipeline()
+        p.delete(nkey)
+        names = entry.names() if entry.exception is None else list()
+        if names and ttl > 0:
+            p.sadd(nkey, *names)
+            p.expire(nkey, ttl)
+        p.execute()
+
+    def has_layers(self, service_type, url, names):
+        """
+        tells for each of the given layer names if it exists in the service, as a
+        dict of name -> bool, or returns None if the service capabilities can't be
+        fetched (the failure is then available via get()).
+        looks at the in-memory entry first, then at the set of names in redis,
+        and only falls back to get() if none is usable.
+        """
+        if not url.startswith("http"):
+            url = "https://" + self.conf.get("domainName") + url
+        names = list(names)
+        self.ensure_subscriber()
+        ce = self.services.peek(service_type, url)
+        if ce is None or not self.is_fresh(ce):
+            rkey = f"{service_type}-{url.replace('/','~')}"
+            nkey = f"names-{rkey}"
+            if names:
+                p = self.rediscli.pipeline()
+                p.exists(nkey)
+                p.smismember(nkey, names)
+                exists, found = p.execute()
+                if exists:
+                    get_logger("OwsCapCache").debug(
+                        f"looked up {len(names)} layer names in {nkey}"
+                    )
+                    return {n: bool(f) for n, f in zip(names, found)}
+            ce = self.get(service_type, url)
+        if ce.exception is not None:
+            return None
+        known = set(ce.names())
+        return {n: n in known for n in names}
+
     def get(self, service_type, url, force_fetch=False):
+        self.ensure_subscriber()
         # is a relative url, prepend https://domainName
         if not url.startswith("http"):
             url = "https://" + self.conf.get("domainName") + url
-        if service_type not in self.services:
-            self.services[service_type] = dict()
-        if url not in self.services[service_type]:
+        ce = self.services.get(service_type, url)
+        if ce is None:
+            metrics.inc(
+                "gaia_owscache_lookups_total",
+                stype=service_type,
+                tier="memory",
+                result="miss",
+            )
             return self.fetch(service_type, url, force_fetch)
         else:
-            ce = self.services[service_type][url]
-            if ce.timestamp + self.cache_lifetime > time() and not force_fetch:
-                if ce.s == None:
+            metrics.inc(
+                "gaia_owscache_lookups_total",
+                stype=service_type,
+                tier="memory",
+                result="hit" if self.is_fresh(ce, force_fetch) else "miss",
+            )
+            if self.is_fresh(ce, force_fetch):
+                if ce.exception is not None:
                     get_logger("OwsCapCache").warning(
-                        f"already got a {type(ce.exception)} for {service_type} {url} in cache, returning cached failure"
+                        f"already got {ce.failures} {type(ce.exception)} for {service_type} {url} in cache, returning cached failure until {ce.retry_at}"
                     )
                     return ce
+                # changes made by other processes come via invalidations
                 if service_type == "csw":
                     rkey = f"{service_type}-{url.replace('/','~')}"
-                    re = self.get_entry_from_redis(rkey)
-                    if re is None:
-                        get_logger("OwsCapCache").info(
-                            f"redis key {rkey} doesnt exist but we have a (probably invalid now) in-memory entry for {service_type} {url}, refreshing"
-                        )
-                        return self.fetch(service_type, url, force_fetch)
-                    if re and re.records is None and ce.records is not None:
+                    if ce.dirty:
                         get_logger("OwsCapCache").info(
-                            f"updating redis key {rkey} with {ce.nelems()} cached records"
+                            f"updating redis key {rkey} with {ce.nelems()} csw records synchronized at {ce.lastsync}"
                         )
                         self.set_entry_in_redis(rkey, ce)
-                    if re and re.records is not None and ce.records is None:
-                        get_logger("OwsCapCache").debug(
-                            f"our in-memory csw cached entry for {url} had no records and the one in redis with {rkey} has {re.nelems()}, updating our local one"
-                        )
-                        self.services[service_type][url] = re
-                        ce = re
+                    elif ce.records is None:
+                        # only look in redis until the records are fetched, in
+                        # case an invalidation was missed
+                        re = self.get_entry_from_redis(rkey)
+                        if re is not None and re.records is not None:
+                            get_logger("OwsCapCache").debug(
+                                f"our in-memory csw cached entry for {url} had no records and the one in redis with {rkey} has {re.nelems()}, updating our local one"
+                            )
+                            self.services.put(service_type, url, re)
+                            ce = re
                 get_logger("OwsCapCache").debug(
                     f"returning {service_type} getcapabilities from process in-memory cache for {url} with {ce.nelems()} entries, ts={ce.timestamp}"
                 )
@@ -269,21 +1429,24 @@ class OwsCapCache:
                     get_logger("OwsCapCache").info(
                         f"force-fetching {service_type} getcapabilities from {url}"
                     )
-                elif ce.timestamp + self.cache_lifetime > time():
+                else:
                     get_logger("OwsCapCache").info(
                         f"cached entry for {service_type} {url} expired (ts={ce.timestamp}), refetching"
                     )
-                return self.fetch(service_type, url, True)
+                # another process might have refreshed it in redis already
+                return self.fetch(service_type, url, force_fetch)
 
     def forget(self, stype, url):
         if not url.startswith("http"):
             url = "https://" + self.conf.get("domainName") + url
-        if stype in self.services and url in self.services[stype]:
+        ce = self.services.pop(stype, url)
+        if ce is not None:
             get_logger("OwsCapCache").debug(
-                f"deleting {url} from {stype} in-memory cache, ts was {self.services[stype][url].timestamp}"
+                f"deleting {url} from {stype} in-memory cache, ts was {ce.timestamp}"
             )
-            del self.services[stype][url]
         rkey = f"{stype}-{url.replace('/','~')}"
+        self.rediscli.delete(f"names-{rkey}", f"records-{rkey}", f"revision-{rkey}")
+        self.publish_invalidation(stype, url)
         re = self.rediscli.get(rkey)
         if re:
             get_logger("OwsCapCache").debug(f"deleting {rkey} from capabilities cache")
@@ -314,18 +1477,19 @@ class OwsCapCache:
             return None
         # will parse global.xml to have the datadir version (should be _latest_)
         gsdd = gsdscanner.GSDatadirScanner(dp)
-        if rkey not in self.services:
+        self.ensure_subscriber()
+        if self.gsdd is None:
             re = self.rediscli.get(rkey)
             if re:
                 cached_gsdd = jsonpickle.decode(json.loads(re.decode("utf-8")))
                 if gsdd.version is None or cached_gsdd.version >= gsdd.version:
                     # update in-memory cache, this one is parsed
-                    self.services[rkey] = cached_gsdd
-                    return self.services[rkey]
+                    self.gsdd = cached_gsdd
+                    return self.gsdd
         else:
             # check if current is newer than the one cached in memory
-            if self.services[rkey].version >= gsdd.version:
-                return self.services[rkey]
+            if self.gsdd.version >= gsdd.version:
+                return self.gsdd
 
         if parse_now:
             gsdd.parseAll()
@@ -338,5 +1502,8 @@ class OwsCapCache:
         json_entry = json.dumps(jsonpickle.encode(gsdd))
         self.rediscli.set(rkey, json_entry)
         # update local version
-        self.services[rkey] = gsdd
-        get_logger("OwsCapCache").info(f"updated redis & in-memory geoserver datadir view with version {gsdd.version}")
+        self.gsdd = gsdd
+        self.publish_invalidation(None, None, gsdd.version)
+        get_logger("OwsCapCache").info(
+            f"updated redis & in-memory geoserver datadir view with version {gsdd.version}"
+        )
@@ -0,0 +1,232 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import urlparse
+import asyncio
+
+from geordash.logwrap import get_logger
+from geordash.metrics import metrics
+from geordash.httpclient import session, owslib_session, slot_wait, host_ceiling
+
+""" asyncio engine running many ows probes (getmap, getfeature, gettile..)
+concurrently from a single task. each probe is an owslib call, run a first
+time against a session capturing the request it builds instead of sending it.
+the captured requests are sent concurrently through the shared http session
+(so that they reuse its pooled connections and honor the per-host concurrency
+limits), from a pool of threads driven by the event loop. the probes of a
+given host wait for one of its http_host_concurrency slots in the event loop,
+so that the threads of the pool dont poll the redis semaphore of the host
+limiter behind each other. each owslib call is then replayed against its
+prefetched response, so that the usual owslib checks (http errors, xml
+service exceptions..) apply as if it had sent the request itself. a probe
+can also come with a reader, sending the captured request itself (eg to
+stream the response) and returning the outcome of the probe in place of the
+owslib call.
+"""
+
+# amount of probes in flight at once, across all hosts
+PROBE_CONCURRENCY = 100
+
+# overridden in config.py, read once at import
+try:
+    import config
+
+    PROBE_CONCURRENCY = getattr(config, "owslayer_probe_concurrency", PROBE_CONCURRENCY)
+except ImportError:
+    pass
+
+
+class CapturedRequest(Exception):
+    """
+    raised by CaptureSession in place of sending the request
+    """
+
+    def __init__(self, method, url, kwargs):
+        super().__init__(f"{method} {url}")
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+
+
+class CaptureSession:
+    def request(self, method, url, **kwargs):
+        raise CapturedRequest(method, url, kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request("POST", url, data=data, json=json, **kwargs)
+
+
+class ReplaySession:
+    """
+    answers the request of an owslib call with an already fetched response,
+    or raises the exception sending it failed with
+    """
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    def request(self, method, url, **kwargs):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request("POST", url, data=data, json=json, **kwargs)
+
+
+def capture(call):
+    """
+    returns the request an owslib call would send, or None if it didnt send one
+    """
+    try:
+        with owslib_session(CaptureSession()):
+            call()
+    except CapturedRequest as r:
+        return r
+    return None
+
+
+def replay(call, outcome):
+    """
+    runs an owslib call against the prefetched outcome of its request
+    """
+    with owslib_session(ReplaySession(outcome)):
+        return call()
+
+
+class HostSemaphores:
+    """
+    bounds the probes in flight to each host to the amount of concurrent
+    requests the host limiter allows it
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.semaphores = dict()
+
+    def get(self, url):
+        host = urlparse(url).hostname
+        if host not in self.semaphores:
+            ceiling = host_ceiling(url) or self.concurrency
+            self.semaphores[host] = asyncio.Semaphore(
+                max(1, min(ceiling, self.concurrency))
+            )
+        return self.semaphores[host]
+
+
+async def run_probe(
+    loop,
+    pool,
+    semaphore,
+    hostsemaphores,
+    check,
+    operation,
+    call,
+    reader=None,
+    timings=None,
+    key=None,
+):
+    """
+    runs a probe, returns the value returned by its call (or its reader) or
+    the exception it raised. the time to the first byte of the response (the
+    headers) and the total duration of the request are stored in timings[key],
+    without the time spent waiting for a slot on the host (cf HostLimiter)
+    """
+    try:
+        req = capture(call)
+        if req is None:
+            return call()
+    except Exception as e:
+        return e
+    ttfb = list()
+    # called by requests once the headers are received, before the body is read
+    req.kwargs["hooks"] = {
+        "response": lambda r, *args, **kwargs: ttfb.append(
+            r.elapsed.total_seconds() - getattr(r, "slot_wait", 0)
+        )
+    }
+
+    def send():
+        # in the pool thread, whose waits for a host slot are counted
+        slot_wait()
+        try:
+            if reader is not None:
+                outcome = reader(req)
+            else:
+                outcome = session().request(req.method, req.url, **req.kwargs)
+        except Exception as e:
+            outcome = e
+        return (outcome, slot_wait())
+
+    async with hostsemaphores.get(req.url), semaphore:
+        start = perf_counter()
+        (outcome, waited) = await loop.run_in_executor(pool, send)
+        elapsed = perf_counter() - start - waited
+        metrics.observe("gaia_probe_seconds", elapsed, check=check, operation=operation)
+        if timings is not None:
+            # the last response, after redirects
+            timings[key] = {
+                "ttfb": ttfb[-1] if len(ttfb) > 0 else None,
+                "total": elapsed,
+            }
+    if reader is not None:
+        return outcome
+    try:
+        return replay(call, outcome)
+    except Exception as e:
+        return e
+
+
+async def run_probes(probes, check, concurrency, timings=None):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    hostsemaphores = HostSemaphores(concurrency)
+    # only starts as many threads as there are probes in flight
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = await asyncio.gather(
+            *[
+                run_probe(
+                    loop,
+                    pool,
+                    semaphore,
+                    hostsemaphores,
+                    check,
+                    operation,
+                    call,
+                    reader,
+                    timings,
+                    key,
+                )
+                for key, (operation, call, reader) in probes.items()
+            ]
+        )
+    return dict(zip(probes.keys(), outcomes))
+
+
+def probe_concurrently(probes, check, concurrency=None, timings=None):
+    """
+    runs probes concurrently, up to owslayer_probe_concurrency at once
+    :param probes: a dict of key -> (operation, owslib call, reader or None)
+    :param check: the check name for the gaia_probe_seconds metric
+    :param timings: if given, a dict filled with the time to first byte and
+    total duration of the request of each probe by key
+    :return: a dict of key -> value returned by the call, or the exception it raised
+    """
+    if concurrency is None:
+        concurrency = PROBE_CONCURRENCY
+    if len(probes) == 0:
+        return dict()
+    concurrency = max(1, min(concurrency, len(probes)))
+    get_logger("Probes").debug(
+        f"running {len(probes)} {check} probes, {concurrency} at once"
+    )
+    return asyncio.run(run_probes(probes, check, concurrency, timings))
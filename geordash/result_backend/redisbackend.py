@@ -94,7 +94,10 @@ class RedisClient:
             if name is None:
                 name = task["name"]
             else:
-                if task["name"] != name:
+                # an incremental owsservice mixes owslayers and carry_owslayers
+                if task["name"] != name and not (
+                    name.endswith("owslayers") and task["name"].endswith("owslayers")
+                ):
                     get_logger("RedisClient").error(
                         f"{name} mismatched task name for {tid}"
                     )
@@ -127,7 +130,7 @@ class RedisClient:
                 date_done = subtask_done
             # print(f"{tid} {task['name']} {task['args'][:-1]} {task['date_done']} {date_done}")
         if name is not None:
-            if name.endswith("owslayer"):
+            if name.endswith("owslayer") or name.endswith("owslayers"):
                 name = "geordash.checks.ows.owsservice"
             if name.endswith("check_res"):
                 name = "geordash.checks.mapstore.check_resources"
@@ -145,6 +148,8 @@ class RedisClient:
             return self.r.get(key)
         else:
             if isinstance(key, str):
+                # <taskid>:<layername> for a layer checked by an owslayers task
+                key = key.partition(":")[0]
                 nk = "celery-task-meta-".encode() + key.encode()
             else:
                 nk = "celery-task-meta-".encode() + key
@@ -160,6 +165,13 @@ class RedisClient:
 
     def forget(self, taskid):
         get_logger("RedisClient").debug(f"forgetting {taskid}")
+        if ":" in taskid:
+            # a layer of an owslayers task, only forget that layer
+            for taskids in self.task_by_taskname.get(
+                "geordash.checks.ows.owslayer", dict()
+            ).values():
+                taskids.pop(taskid, None)
+            return None
         v = self.get(taskid)
         if v is None:
             return None
@@ -185,7 +197,7 @@ class RedisClient:
                 get_logger("RedisClient").error(f"discarding {ftid}, {str(e)}")
                 return None
             args = task["args"][:-1]
-            if task["name"].endswith("owslayer"):
+            if task["name"].endswith("owslayer") or task["name"].endswith("owslayers"):
                 taskname = "geordash.checks.ows.owsservice"
             if task["name"].endswith("check_res"):
                 taskname = "geordash.checks.mapstore.check_resources"
@@ -254,6 +266,22 @@ class RedisClient:
         return None
 
     def add_taskid_for_taskname_and_args(self, taskname, args, taskid, finished=None):
+        if taskname == "geordash.checks.ows.carry_owslayers":
+            # the layers werent checked again, their results are already
+            # registered with the owslayers task which checked them
+            return
+        if taskname == "geordash.checks.ows.owslayers" and args is not None:
+            # register the result of each layer of the chunk as if it came
+            # from an owslayer task, with a <taskid>:<layername> id
+            stype, url, layernames = args[:3]
+            for lname in layernames:
+                self.add_taskid_for_taskname_and_args(
+                    "geordash.checks.ows.owslayer",
+                    [stype, url, lname],
+                    f"{taskid}:{lname}",
+                    finished,
+                )
+            return
         if taskname not in self.task_by_taskname:
             self.task_by_taskname[taskname] = dict()
         if args is None:  # invalid task ?
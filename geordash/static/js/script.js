@@ -227,6 +227,10 @@ const GetPbStr = (p) => {
   if (p instanceof String) {
     return p
   }
+  if (p.tilematrix !== undefined) {
+    /* from a sampled wmts tile */
+    return GetPbStr({...p, tilematrix: undefined}) + ` (tilematrix ${p.tilematrix} of ${p.tilematrixset})`
+  }
   switch(p.type) {
     /* from ows */
     case 'NoMetadataUrl':
@@ -247,6 +251,10 @@ const GetPbStr = (p) => {
       return `${p.operation} succeeded but didnt return XML ? ${p.return}`
     case 'XMLParseError':
       return `${p.operation} succeeded but failed parsing XML ? ${p.return}`
+    case 'SlowResponse':
+      return `${p.operation} took ${p.latency}s (first byte after ${p.ttfb}s), ` + (p.median !== null ? `usually ${p.median}s` : `over ${p.threshold}s`)
+    case 'BlankImage':
+      return `${p.operation} returned a blank image (${p.width}x${p.height}, ${Math.round(p.transparent * 100)}% transparent, ` + (p.colors == 1 ? `single colour ${p.color})` : `${p.colors} colours)`)
     case 'ServiceException':
       return `Failed ${p.operation} on layer '${p.layername}' in ${p.stype} at ${p.url}, got ${p.e}: ${p.estr}`
     case 'ForbiddenAccess':
@@ -0,0 +1,273 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from flask import current_app as app
+from celery import shared_task
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import or_
+from urllib.parse import urlparse
+from time import time
+import json
+import random
+
+from geordash.logwrap import get_logger
+from geordash.httpclient import session
+from geordash.mviewer import parse_map
+from geordash.owscapcache import CachedEntry
+from geordash.utils import objtype
+
+
+@shared_task(bind=True, max_retries=20)
+def refresh_capabilities(self, stype, url):
+    """
+    refetch the capabilities of a service in a background task, queued when
+    an expired entry was served in stale-while-revalidate mode, or by
+    schedule_refreshes() before it expires. at most refresh_per_host
+    refreshes run at the same time against a given host, the others are
+    retried a bit later.
+    """
+    occ = app.extensions["owscache"]
+    host = urlparse(url).netloc or app.extensions["conf"].get("domainName")
+    hkey = f"refreshing-{host}"
+    p = occ.rediscli.pipeline()
+    p.incr(hkey)
+    # dont keep the counter forever if a worker dies while refreshing
+    p.expire(hkey, occ.fetch_lock_timeout)
+    running, _ = p.execute()
+    if running > occ.refresh_per_host:
+        occ.rediscli.decr(hkey)
+        get_logger("RefreshCapabilities").debug(
+            f"already {running - 1} refreshes running against {host}, retrying {stype} {url} later"
+        )
+        raise self.retry(countdown=random.uniform(10, 60))
+    try:
+        service = occ.get(stype, url, True)
+    finally:
+        occ.rediscli.decr(hkey)
+    if service.s is None:
+        get_logger("RefreshCapabilities").error(
+            f"failed refreshing {stype} getcapabilities for {url}: {service.exception}"
+        )
+        return False
+    return service.nelems()
+
+
+# bytes read from each cached entry by schedule_refreshes(), enough for the
+# header of most entries
+HEADER_PREFIX = 16 * 1024
+
+
+@shared_task()
+def schedule_refreshes():
+    """
+    called by beat scheduler: queues a refresh of each cached capabilities
+    entry expiring within refresh_ahead seconds, at a random time before its
+    expiry so that the refreshes are spread instead of all hitting the remote
+    services at once, and so that OwsCapCache.get() calls rarely miss.
+    :return: the amount of queued refreshes
+    """
+    occ = app.extensions["owscache"]
+    keys = list()
+    for stype in ("wms", "wmts", "wfs", "csw"):
+        for k in occ.rediscli.scan_iter(f"{stype}-*"):
+            keys.append((stype, k.decode()))
+    # the header with the url and timestamp is at the start of the entry, the
+    # ttl of the key is reset by each write (eg of csw records) so it doesnt
+    # tell when the entry was fetched
+    p = occ.rediscli.pipeline()
+    for stype, k in keys:
+        p.getrange(k, 0, HEADER_PREFIX - 1)
+    prefixes = p.execute()
+    queued = 0
+    for (stype, k), prefix in zip(keys, prefixes):
+        if not prefix:
+            continue
+        header = CachedEntry.header(prefix)
+        if header is None and len(prefix) == HEADER_PREFIX:
+            # a header longer than the prefix, eg with many layer fingerprints
+            blob = occ.rediscli.get(k)
+            header = CachedEntry.header(blob) if blob else None
+        if header is None:
+            continue
+        remaining = header["timestamp"] + occ.cache_lifetime - time()
+        if remaining > occ.refresh_ahead:
+            continue
+        # leave a minute for the refresh itself
+        countdown = random.uniform(0, max(0, remaining - 60))
+        # skip entries which already have a refresh queued
+        if not occ.rediscli.set(
+            f"refresh-{k}", 1, nx=True, ex=int(countdown) + occ.fetch_lock_timeout
+        ):
+            continue
+        refresh_capabilities.apply_async((stype, header["url"]), countdown=countdown)
+        queued += 1
+    get_logger("RefreshCapabilities").info(
+        f"queued {queued} capabilities refreshes over {len(keys)} cached entries"
+    )
+    return queued
+
+
+def absolute_url(url):
+    if not url.startswith("http"):
+        return "https://" + app.extensions["conf"].get("domainName") + url
+    return url
+
+
+def mapstore_services():
+    """
+    returns the set of (stype, url) used by the layers and catalogs of the
+    mapstore maps and contexts
+    """
+    msc = app.extensions["msc"]
+    services = set()
+    resources = (
+        msc.session()
+        .query(msc.Resource)
+        .filter(
+            or_(
+                msc.Resource.category_id == msc.cat["MAP"],
+                msc.Resource.category_id == msc.cat["CONTEXT"],
+            )
+        )
+        .all()
+    )
+    for r in resources:
+        data = json.loads(r.gs_stored_data[0].stored_data)
+        if r.category_id == msc.cat["CONTEXT"]:
+            data = data["mapConfig"]
+        layers = data["map"]["layers"] if "map" in data else list()
+        catalogs = data.get("catalogServices", dict()).get("services", dict())
+        for l in layers:
+            if l["type"] in ("wms", "wfs", "wmts") and l.get("url"):
+                services.add((l["type"], absolute_url(l["url"])))
+        for c in catalogs.values():
+            if c["type"] in ("wms", "wfs", "wmts", "csw") and c.get("url"):
+                services.add((c["type"], absolute_url(c["url"])))
+    return services
+
+
+def mviewer_services():
+    """
+    returns the set of (stype, url) used by the layers of the mviewer configs
+    """
+    services = set()
+    for url in app.extensions["owscache"].get_mviewer_configs() or list():
+        try:
+            r = session().get(url)
+        except Exception as e:
+            get_logger("WarmupCache").error(f"failed fetching {url}: {e}")
+            continue
+        if r.status_code != 200:
+            continue
+        details = parse_map(r.text)
+        for l in details["layers"] + details["baselayers"]:
+            if l["type"] in ("wms", "wfs", "wmts") and l["url"]:
+                services.add((l["type"], absolute_url(l["url"])))
+    return services
+
+
+def csw_services():
+    """
+    returns the set of (stype, url) referenced by the OGC links of the
+    records in the cached csw entries
+    """
+    occ = app.extensions["owscache"]
+    services = set()
+    for k in occ.rediscli.scan_iter("csw-*"):
+        ce = occ.load_entry_from_redis(k.decode())
+        if ce is None or ce.records is None:
+            continue
+        for r in ce.records.values():
+            for u in r.uris:
+                if u["protocol"] in ("OGC:WMS", "OGC:WFS") and u["url"]:
+                    stype = u["protocol"].split(":")[1].lower()
+                    services.add((stype, absolute_url(u["url"].rstrip("?"))))
+    return services
+
+
+def beat_services():
+    """
+    returns the set of (stype, url) checked by the tasks of the beat schedule
+    """
+    services = set()
+    schedule = app.extensions["celery"].conf.beat_schedule or dict()
+    for entry in schedule.values():
+        args = entry.get("args", list())
+        if entry["task"] == "geordash.checks.ows.owsservice" and len(args) > 1:
+            services.add((args[0], absolute_url(args[1])))
+        elif entry["task"] == "geordash.checks.csw.check_catalog" and len(args) > 0:
+            services.add(("csw", absolute_url(args[0])))
+    return services
+
+
+def warmup(progress=None):
+    """
+    collects all the services referenced by mapstore, mviewer, the cached csw
+    records and the beat schedule, and fetches their capabilities in a bounded
+    pool of warmup_workers threads. progress is called with (done, total).
+    :return: the amount of failures, the total duration and the time taken
+    by each service, slowest first
+    """
+    start = time()
+    occ = app.extensions["owscache"]
+    services = set()
+    for collect in (mapstore_services, mviewer_services, csw_services, beat_services):
+        try:
+            found = collect()
+        except Exception as e:
+            get_logger("WarmupCache").error(
+                f"{collect.__name__}() failed with {objtype(e)} {str(e)}, skipping"
+            )
+            continue
+        get_logger("WarmupCache").info(
+            f"{collect.__name__}() found {len(found)} services"
+        )
+        services |= found
+
+    def prefetch(stype, url):
+        # runs outside of the app context, only use occ
+        t = time()
+        ce = occ.get(stype, url)
+        return {
+            "stype": stype,
+            "url": url,
+            "duration": time() - t,
+            "nelems": ce.nelems() if ce is not None else 0,
+            "exception": (
+                objtype(ce.exception)
+                if ce is not None and ce.exception is not None
+                else None
+            ),
+        }
+
+    timings = list()
+    with ThreadPoolExecutor(max_workers=occ.warmup_workers) as pool:
+        futures = [pool.submit(prefetch, stype, url) for stype, url in services]
+        for f in as_completed(futures):
+            timings.append(f.result())
+            if progress is not None:
+                progress(len(timings), len(services))
+    timings.sort(key=lambda t: t["duration"], reverse=True)
+    failed = len([t for t in timings if t["exception"] is not None])
+    get_logger("WarmupCache").info(
+        f"warmed up {len(services)} services ({failed} failures) in {time() - start:.2f}s"
+    )
+    return {"failed": failed, "duration": time() - start, "timings": timings}
+
+
+@shared_task(bind=True)
+def warmup_cache(self):
+    """
+    prefetch the capabilities of all the referenced services in a background
+    task, eg after a redis flush or a fresh deploy
+    """
+    return warmup(
+        lambda current, total: self.update_state(
+            state="PROGRESS",
+            meta={
+                "current": current,
+                "total": total,
+            },
+        )
+    )
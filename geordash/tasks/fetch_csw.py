@@ -7,49 +7,29 @@ from celery import shared_task
 from geordash.logwrap import get_logger
 from geordash.owscapcache import OwsCapCache
 
-from owslib.fes import PropertyIsEqualTo, And
-
-non_harvested = PropertyIsEqualTo("isHarvested", "false")
-
 
 @shared_task(bind=True)
-def get_records(self, portal):
+def get_records(self, portal, full=False):
     """
-    fetch csw records in a background task
+    fetch csw records in a background task: only the ones modified since the
+    last synchronization, or all of them if full is set
     """
     localgn = app.extensions["conf"].get("localgn", "urls")
     cswurl = "/" + localgn + "/" + portal + "/fre/csw"
     occ = app.extensions["owscache"]
     service = occ.get("csw", cswurl)
 
-    # get the amount of records, mostly for logging
-    service.s.getrecords2(constraints=[non_harvested], resulttype="hits")
-    nrec = service.s.results["matches"]
-
-    records = dict()
-    startpos = 0
-    while True:
-        service.s.getrecords2(
-            constraints=[non_harvested],
-            esn="full",
-            startposition=startpos,
-            maxrecords=25,
-        )
-        startpos = service.s.results["nextrecord"]
-        records |= service.s.records
-        self.update_state(
+    records = service.sync(
+        full,
+        lambda current, total: self.update_state(
             state="PROGRESS",
             meta={
-                "current": startpos,
-                "total": nrec,
+                "current": current,
+                "total": total,
             },
-        )
-        get_logger("CswFetch").debug(
-            f"start = {startpos}, res={service.s.results}, returned {len(service.s.records)}, mds={len(records)}"
-        )
-        if startpos > service.s.results["matches"] or startpos == 0:
-            break
-    get_logger("CswFetch").info(f"fetched {len(records)} csw records over {nrec}")
+        ),
+    )
+    get_logger("CswFetch").info(f"fetched {len(records)} csw records")
     # update our in-memory cache
     service.records = records
     # persist entry with records in redis
@@ -8,13 +8,14 @@ from flask import current_app as app
 from flask import Blueprint
 from flask import request, abort
 from flask import jsonify
-import requests
 
 from geordash.utils import unmunge
+from geordash.httpclient import session
 from geordash.checks.mapstore import check_res, check_configs, check_resources
 from geordash.checks.gn_datadir import check_gn_meta
 from geordash.tasks.fetch_csw import get_records
 from geordash.tasks.gsdatadir import parse_gsdatadir
+from geordash.tasks.capabilities import warmup_cache
 import geordash.checks.ows
 import geordash.checks.csw
 import geordash.checks.mviewer
@@ -26,6 +27,8 @@ tasks_bp = Blueprint("tasks", __name__, url_prefix="/tasks")
 
 @tasks_bp.get("/result/<id>")
 def result(id: str) -> dict[str, object]:
+    if ":" in id:
+        return layer_result(*id.split(":", 1))
     result = GroupResult.restore(id)
     finished = None
     value = None
@@ -66,7 +69,18 @@ def result(id: str) -> dict[str, object]:
             value = list()
             for r in result.results:
                 try:
-                    value.append({"args": r.args, "problems": r.get()["problems"]})
+                    res = r.get()
+                    if "layers" in res:
+                        # owslayers chunk, one entry per layer as for owslayer
+                        for lname, lres in res["layers"].items():
+                            value.append(
+                                {
+                                    "args": list(r.args[:2]) + [lname],
+                                    "problems": lres["problems"],
+                                }
+                            )
+                        continue
+                    value.append({"args": r.args, "problems": res["problems"]})
                 except Exception as e:
                     app.logger.error(
                         f"failed getting results from celery on task {r.id} with {r.args}, got {str(e)}"
@@ -85,6 +99,29 @@ def result(id: str) -> dict[str, object]:
     }
 
 
+def layer_result(taskid: str, lname: str) -> dict[str, object]:
+    """
+    result of a layer checked by an owslayers task, as if checked by owslayer
+    """
+    result = AsyncResult(taskid)
+    value = None
+    ready = result.ready()
+    if ready and result.successful():
+        value = (result.get() or dict()).get("layers", dict()).get(lname)
+    finished = result.date_done
+    return {
+        "taskid": f"{taskid}:{lname}",
+        "ready": ready,
+        "completed": None,
+        "task": "geordash.checks.ows.owslayer",
+        "finished": (finished.timestamp() if finished is not None else False),
+        "args": list(result.args[:2]) + [lname] if result.args else None,
+        "successful": (result.successful() and value is not None) if ready else None,
+        "state": result.state,
+        "value": value,
+    }
+
+
 @tasks_bp.get("/lastresultbytask/<string:taskname>")
 def last_result_by_taskname_and_args(taskname: str) -> dict[str, object]:
     args = request.args.get("taskargs", None)
@@ -107,6 +144,9 @@ def last_result_by_taskname_and_args(taskname: str) -> dict[str, object]:
 def forget(id: str):
     # forget first in the revmap
     childid = app.extensions["rcli"].forget(id)
+    if ":" in id:
+        # a layer of an owslayers task, the other layers results are kept
+        return jsonify("ok")
     result = GroupResult.restore(id)
     if result is None:
         result = AsyncResult(id)
@@ -141,7 +181,15 @@ def start_parse_gsd():
 
 @tasks_bp.get("/fetchcswrecords/<string:portal>.json")
 def start_fetch_csw(portal: str):
-    result = get_records.delay(portal)
+    # ?full=1 to reharvest all records instead of synchronizing them
+    result = get_records.delay(portal, request.args.get("full") is not None)
+    return {"taskid": result.id}
+
+
+@tasks_bp.get("/warmupcache.json")
+@check_role(role="SUPERUSER")
+def start_warmup_cache():
+    result = warmup_cache.delay()
     return {"taskid": result.id}
 
 
@@ -220,7 +268,7 @@ def check_all_mviewer():
 @tasks_bp.route("/check/mviewer/<string:url>.json")
 def check_mviewer(url):
     url = unmunge(url, False)
-    r = requests.get(url)
+    r = session().get(url)
     if r.status_code != 200:
         return abort(404)
     result = geordash.checks.mviewer.check_mviewer.delay(url)
@@ -257,18 +305,19 @@ def check_owslayer(stype, url, lname):
         return abort(412)
     url = unmunge(url)
     service = app.extensions["owscache"].get(stype, url)
-    if service.s is None:
+    if service.exception is not None:
         return abort(404)
     # if a wfs from geoserver, prepend ws to lname
     if (
         stype == "wfs"
         and ":" not in lname
-        and service.s.updateSequence
-        and service.s.updateSequence.isdigit()
+        and service.updatesequence()
+        and service.updatesequence().isdigit()
     ):
         ws = url.split("/")[-2]
         lname = f"{ws}:{lname}"
-    if lname not in service.contents():
+    exists = app.extensions["owscache"].has_layers(stype, url, [lname])
+    if not exists or not exists[lname]:
         return abort(404)
     result = geordash.checks.ows.owslayer.delay(stype, url, lname, True)
     return {"result_id": result.id}
@@ -285,7 +334,10 @@ def check_owsservice(stype, url):
     service = app.extensions["owscache"].get(stype, url)
     if service.s is None:
         return abort(404)
-    groupresult = geordash.checks.ows.owsservice(stype, url)
+    # ?incremental=1 to only check the new, changed and failing layers
+    groupresult = geordash.checks.ows.owsservice(
+        stype, url, request.args.get("incremental") is not None
+    )
     if not groupresult:
         return abort(404)
     if groupresult.id:
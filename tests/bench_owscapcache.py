@@ -0,0 +1,114 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+"""
+compares the redis storage format of CachedEntry objects with the legacy
+double-encoded jsonpickle one: encoding/decoding time and bytes per entry.
+
+usage: python3 tests/bench_owscapcache.py <stype> <url or capabilities file> [iterations]
+
+with an url, the capabilities are fetched from the remote service (and for a
+csw, all the non-harvested records too). with a file, the capabilities
+document is read from disk.
+"""
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+import json
+import jsonpickle
+import os
+import zlib
+from time import perf_counter
+
+from owslib.wms import WebMapService
+from owslib.wfs import WebFeatureService
+from owslib.wmts import WebMapTileService
+from owslib.csw import CatalogueServiceWeb, CswRecord
+from owslib.etree import etree
+from geordash.owscapcache import (
+    CachedEntry,
+    CachedCatalogueServiceWeb,
+    ENTRY_FORMAT_VERSION,
+)
+
+
+def build_entry(stype, src):
+    entry = CachedEntry(stype, src)
+    xml = None
+    if os.path.exists(src):
+        with open(src, "rb") as f:
+            xml = f.read()
+        entry.url = "https://localhost/" + stype
+    if stype == "wms":
+        entry.set_service(WebMapService(entry.url, version="1.3.0", xml=xml))
+    elif stype == "wfs":
+        entry.set_service(WebFeatureService(entry.url, version="1.1.0", xml=xml))
+    elif stype == "wmts":
+        entry.set_service(WebMapTileService(entry.url, xml=xml))
+    elif stype == "csw":
+        if xml:
+            entry.set_service(CachedCatalogueServiceWeb(entry.url, xml))
+        else:
+            entry.set_service(CatalogueServiceWeb(entry.url, timeout=60))
+            entry.contents()
+    entry.timestamp = 0
+    return entry
+
+
+def timeit(f, iterations):
+    start = perf_counter()
+    for i in range(iterations):
+        r = f()
+    return ((perf_counter() - start) / iterations, r)
+
+
+def bench(stype, src, iterations=5):
+    entry = build_entry(stype, src)
+
+    # what was persisted before: the owslib object graph, without the raw xml
+    legacy = CachedEntry(entry.stype, entry.url)
+    legacy.s = entry.s
+    legacy.records = entry.records
+    legacy.timestamp = entry.timestamp
+    legacy.__dict__.pop("xml")
+    legacy.__dict__.pop("summary")
+    legacy.__dict__.pop("_recordsxml")
+
+    lenc, lblob = timeit(lambda: json.dumps(jsonpickle.encode(legacy)), iterations)
+    ldec, l = timeit(lambda: jsonpickle.decode(json.loads(lblob)), iterations)
+
+    # csw records are stored compressed one by one in a redis hash
+    def dumps_records():
+        recordsxml = entry.records_xml() or dict()
+        return {u: zlib.compress(x) for u, x in recordsxml.items()}
+
+    nenc, nblob = timeit(lambda: entry.dumps(), iterations)
+    renc, rblobs = timeit(dumps_records, iterations)
+    ndec, n = timeit(lambda: CachedEntry.loads(nblob), iterations)
+
+    def loads_and_rebuild():
+        ce = CachedEntry.loads(nblob)
+        ce.s
+        for x in rblobs.values():
+            CswRecord(etree.fromstring(zlib.decompress(x)))
+        return ce
+
+    nreb, n = timeit(loads_and_rebuild, iterations)
+    nsize = len(nblob) + sum(len(x) for x in rblobs.values())
+    print(f"{stype} {src}: {entry.nelems()} elements, {len(entry.xml)} bytes of xml")
+    print(f"jsonpickle: {len(lblob)} bytes, encode {lenc:.4f}s, decode {ldec:.4f}s")
+    print(
+        f"format v{ENTRY_FORMAT_VERSION}: {nsize} bytes, encode {nenc + renc:.4f}s, decode {ndec:.4f}s, decode+rebuild {nreb:.4f}s"
+    )
+
+
+# when run standalone
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    bench(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 5)
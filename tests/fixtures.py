@@ -0,0 +1,258 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+"""small capabilities documents used by the tests which dont need a remote
+service, and helpers to build the objects under test from them
+"""
+
+WMS_130_CAPS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" updateSequence="12" xmlns="http://www.opengis.net/wms" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Service>
+    <Name>WMS</Name>
+    <Title>test wms</Title>
+    <OnlineResource xlink:href="http://wms.example.org/ows"/>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>text/xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="http://wms.example.org/ows?"/></Get></HTTP></DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/png</Format>
+        <Format>image/jpeg</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="http://wms.example.org/ows?"/></Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Exception><Format>XML</Format></Exception>
+    <Layer>
+      <Title>root</Title>
+      <CRS>EPSG:4326</CRS>
+      <Layer queryable="1">
+        <Name>roads</Name>
+        <Title>Roads</Title>
+        <EX_GeographicBoundingBox>
+          <westBoundLongitude>-5</westBoundLongitude>
+          <eastBoundLongitude>10</eastBoundLongitude>
+          <southBoundLatitude>41</southBoundLatitude>
+          <northBoundLatitude>51</northBoundLatitude>
+        </EX_GeographicBoundingBox>
+        <BoundingBox CRS="EPSG:4326" minx="41" miny="-5" maxx="51" maxy="10"/>
+        <MetadataURL type="ISO19115:2003">
+          <Format>text/xml</Format>
+          <OnlineResource xlink:type="simple" xlink:href="http://md.example.org/roads.xml"/>
+        </MetadataURL>
+      </Layer>
+      <Layer queryable="1">
+        <Name>rivers</Name>
+        <Title>Rivers</Title>
+        <EX_GeographicBoundingBox>
+          <westBoundLongitude>0</westBoundLongitude>
+          <eastBoundLongitude>5</eastBoundLongitude>
+          <southBoundLatitude>43</southBoundLatitude>
+          <northBoundLatitude>48</northBoundLatitude>
+        </EX_GeographicBoundingBox>
+        <BoundingBox CRS="EPSG:4326" minx="43" miny="0" maxx="48" maxy="5"/>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMS_Capabilities>
+"""
+
+WMS_111_CAPS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1" updateSequence="7">
+  <Service>
+    <Name>OGC:WMS</Name>
+    <Title>test wms 1.1.1</Title>
+    <OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://wms.example.org/ows"/>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>application/vnd.ogc.wms_xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://wms.example.org/ows?"/></Get></HTTP></DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://wms.example.org/ows?"/></Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Exception><Format>application/vnd.ogc.se_xml</Format></Exception>
+    <Layer>
+      <Title>root</Title>
+      <SRS>EPSG:4326</SRS>
+      <Layer queryable="1">
+        <Name>lakes</Name>
+        <Title>Lakes</Title>
+        <LatLonBoundingBox minx="0" miny="43" maxx="5" maxy="48"/>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>
+"""
+
+
+def wmts_tilematrix(identifier, n):
+    return f"""
+      <TileMatrix>
+        <ows:Identifier>{identifier}</ows:Identifier>
+        <ScaleDenominator>{559082264.0287178 / 2 ** n}</ScaleDenominator>
+        <TopLeftCorner>-20037508.34 20037508.34</TopLeftCorner>
+        <TileWidth>256</TileWidth>
+        <TileHeight>256</TileHeight>
+        <MatrixWidth>{2 ** n}</MatrixWidth>
+        <MatrixHeight>{2 ** n}</MatrixHeight>
+      </TileMatrix>"""
+
+
+def wmts_tilematrixlimits(identifier, n):
+    # only the upper left quarter of each level has tiles
+    return f"""
+          <TileMatrixLimits>
+            <TileMatrix>{identifier}</TileMatrix>
+            <MinTileRow>0</MinTileRow>
+            <MaxTileRow>{max(0, 2 ** n // 2 - 1)}</MaxTileRow>
+            <MinTileCol>0</MinTileCol>
+            <MaxTileCol>{max(0, 2 ** n // 2 - 1)}</MaxTileCol>
+          </TileMatrixLimits>"""
+
+
+# the ortho layer is available in two tilematrixsets, the first with limits
+WMTS_CAPS = f"""<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>test wmts</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetTile">
+      <ows:DCP><ows:HTTP>
+        <ows:Get xlink:href="http://wmts.example.org/gwc/service/wmts?">
+          <ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint>
+        </ows:Get>
+      </ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>
+    <Layer>
+      <ows:Title>Ortho</ows:Title>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>-180 -85</ows:LowerCorner>
+        <ows:UpperCorner>180 85</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+      <ows:Identifier>ortho</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/jpeg</Format>
+      <TileMatrixSetLink>
+        <TileMatrixSet>PM</TileMatrixSet>
+        <TileMatrixSetLimits>{"".join(wmts_tilematrixlimits(f"PM:{n}", n) for n in range(6))}
+        </TileMatrixSetLimits>
+      </TileMatrixSetLink>
+      <TileMatrixSetLink>
+        <TileMatrixSet>WGS84</TileMatrixSet>
+      </TileMatrixSetLink>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>PM</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>{"".join(wmts_tilematrix(f"PM:{n}", n) for n in range(6))}
+    </TileMatrixSet>
+    <TileMatrixSet>
+      <ows:Identifier>WGS84</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::4326</ows:SupportedCRS>{"".join(wmts_tilematrix(f"WGS84:{n}", n) for n in range(3))}
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+""".encode()
+
+# advertises its GetRecords/GetRecordById endpoints on another host than the
+# one the capabilities are fetched from
+CSW_CAPS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<csw:Capabilities xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:ows="http://www.opengis.net/ows" xmlns:ogc="http://www.opengis.net/ogc" xmlns:xlink="http://www.w3.org/1999/xlink" version="2.0.2" updateSequence="42">
+  <ows:ServiceIdentification>
+    <ows:Title>test catalog</ows:Title>
+    <ows:ServiceType>CSW</ows:ServiceType>
+    <ows:ServiceTypeVersion>2.0.2</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetRecords">
+      <ows:DCP><ows:HTTP>
+        <ows:Get xlink:href="http://endpoint.example.org/srv/csw-get"/>
+        <ows:Post xlink:href="http://endpoint.example.org/srv/csw-post"/>
+      </ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetRecordById">
+      <ows:DCP><ows:HTTP>
+        <ows:Get xlink:href="http://endpoint.example.org/srv/csw-get"/>
+        <ows:Post xlink:href="http://endpoint.example.org/srv/csw-post"/>
+      </ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <ogc:Filter_Capabilities>
+    <ogc:Spatial_Capabilities><ogc:GeometryOperands/><ogc:SpatialOperators/></ogc:Spatial_Capabilities>
+    <ogc:Scalar_Capabilities/>
+    <ogc:Id_Capabilities><ogc:EID/></ogc:Id_Capabilities>
+  </ogc:Filter_Capabilities>
+</csw:Capabilities>
+"""
+
+CSW_RECORD = b"""<csw:Record xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <dc:identifier>%s</dc:identifier>
+  <dc:title>record %s</dc:title>
+</csw:Record>"""
+
+
+def wms_entry(url="http://wms.example.org/ows", xml=WMS_130_CAPS):
+    """
+    returns a CachedEntry for a wms service, as after a successful fetch
+    """
+    from time import time
+    from owslib.wms import WebMapService
+    from geordash.owscapcache import CachedEntry
+
+    entry = CachedEntry("wms", url)
+    entry.set_service(WebMapService(url, version="1.3.0", xml=xml))
+    entry.timestamp = time()
+    return entry
+
+
+def capcache(server=None):
+    """
+    returns an OwsCapCache backed by a fakeredis server, without flask app
+    nor georchestra datadir. caches given the same fakeredis.FakeServer stand
+    for several processes sharing the same redis
+    """
+    import fakeredis
+    from geordash.owscapcache import OwsCapCache
+
+    c = OwsCapCache(None, None)
+    c.rediscli = fakeredis.FakeRedis(server=server or fakeredis.FakeServer())
+    # dont listen for invalidations from other processes
+    c.ensure_subscriber = lambda: None
+    return c
+
+
+def plain_session():
+    """
+    makes the shared http session of the process skip the per-host
+    concurrency limiter, which lives in the instance redis
+    """
+    import os
+    from geordash import httpclient
+
+    httpclient._session = httpclient.PooledSession(httpclient.DEFAULT_TIMEOUT, 4, 4)
+    httpclient._session_pid = os.getpid()
+
+
+def serve(handler):
+    """
+    starts a local http server answering with the given handler class,
+    returns the server and its base url
+    """
+    from http.server import ThreadingHTTPServer
+    import threading
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
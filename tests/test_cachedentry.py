@@ -0,0 +1,120 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from owslib.csw import CswRecord
+from owslib.etree import etree
+from requests.exceptions import ReadTimeout
+
+# import the module we want to test
+from geordash.owscapcache import (
+    CachedEntry,
+    CachedCatalogueServiceWeb,
+    ENTRY_MAGIC,
+    ENTRY_FORMAT_VERSION,
+)
+from geordash.probes import capture
+from tests.fixtures import wms_entry, CSW_CAPS, CSW_RECORD
+
+
+def test_entry_roundtrip():
+    entry = wms_entry()
+    entry.etag = '"abc"'
+    entry.revision = 3
+    blob = entry.dumps()
+    assert blob.startswith(ENTRY_MAGIC + bytes([ENTRY_FORMAT_VERSION]))
+    ce = CachedEntry.loads(blob)
+    assert ce.stype == "wms" and ce.url == entry.url
+    assert ce.timestamp == entry.timestamp
+    assert ce.xml == entry.xml
+    assert (ce.etag, ce.revision) == ('"abc"', 3)
+    # the summary answers without rebuilding the owslib object
+    assert ce.names() == ["roads", "rivers"]
+    assert ce.nelems() == 2
+    assert ce.updatesequence() == "12"
+    assert ce._s is None
+    # which is rebuilt on demand
+    assert ce.s.contents["roads"].title == "Roads"
+    assert ce.fingerprints() == entry.fingerprints()
+
+
+def test_entry_roundtrip_failure():
+    entry = CachedEntry("wfs", "http://wfs.example.org/ows")
+    entry.exception = ReadTimeout("timed out")
+    entry.timestamp = 1000
+    entry.failures = 2
+    entry.retry_at = 1480
+    ce = CachedEntry.loads(entry.dumps())
+    assert type(ce.exception) == ReadTimeout
+    assert str(ce.exception) == "timed out"
+    assert ce.s is None
+    assert ce.nelems() == 0
+    assert (ce.failures, ce.retry_at) == (2, 1480)
+
+
+def test_entry_loads_rejects_unknown_blobs():
+    # eg an entry persisted as jsonpickle by an older version
+    assert CachedEntry.loads(b'"{\\"py/object\\": \\"x\\"}"') is None
+    blob = wms_entry().dumps()
+    assert (
+        CachedEntry.loads(ENTRY_MAGIC + bytes([99]) + blob[len(ENTRY_MAGIC) + 1 :])
+        is None
+    )
+
+
+def test_entry_v1_records():
+    # version 1 kept the csw records inline, after the capabilities
+    entry = CachedEntry("csw", "http://csw.example.org/csw")
+    entry.xml = CSW_CAPS
+    entry.summary = {"version": "2.0.2", "updateSequence": "42", "title": None}
+    entry.timestamp = 1000
+    entry.records = {
+        u: CswRecord(etree.fromstring(CSW_RECORD % (u.encode(), u.encode())))
+        for u in ("a", "b")
+    }
+    recordsxml = entry.records_xml()
+    blob = entry.dumps()
+    # rewrite the header the way version 1 did
+    import json, struct, zlib
+
+    payload = zlib.decompress(blob[len(ENTRY_MAGIC) + 1 :])
+    (hlen,) = struct.unpack_from(">I", payload)
+    header = json.loads(payload[4 : 4 + hlen])
+    header["records"] = [[u, len(x)] for u, x in recordsxml.items()]
+    jheader = json.dumps(header).encode()
+    payload = (
+        struct.pack(">I", len(jheader))
+        + jheader
+        + payload[4 + hlen :]
+        + b"".join(recordsxml.values())
+    )
+    ce = CachedEntry.loads(ENTRY_MAGIC + bytes([1]) + zlib.compress(payload))
+    assert ce.xml == CSW_CAPS
+    assert ce.nelems() == 2
+    assert ce.records["b"].title == "record b"
+
+
+def test_cached_csw_uses_advertised_endpoints():
+    s = CachedCatalogueServiceWeb("http://base.example.org/csw", CSW_CAPS)
+    assert s.identification.title == "test catalog"
+    assert s.updateSequence == "42"
+    r = capture(lambda: s.getrecordbyid(["abc"]))
+    assert r.method == "GET"
+    assert r.url.startswith("http://endpoint.example.org/srv/csw-get?")
+    r = capture(lambda: s.getrecords2(maxrecords=1))
+    assert r.method == "POST"
+    assert r.url == "http://endpoint.example.org/srv/csw-post"
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_entry_roundtrip()
+    test_entry_roundtrip_failure()
+    test_entry_loads_rejects_unknown_blobs()
+    test_entry_v1_records()
+    test_cached_csw_uses_advertised_endpoints()
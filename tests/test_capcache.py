@@ -0,0 +1,551 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from owslib.wms import WebMapService
+from owslib.csw import CswRecord
+from owslib.etree import etree
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+import fakeredis
+
+# import the module we want to test
+from geordash.owscapcache import (
+    CachedEntry,
+    MemoryTier,
+    RecordStore,
+    PARSED_XML_FACTOR,
+)
+from tests.fixtures import (
+    capcache,
+    plain_session,
+    serve,
+    wms_entry,
+    CSW_CAPS,
+    CSW_RECORD,
+    WMS_111_CAPS,
+    WMS_130_CAPS,
+)
+
+
+class CapabilitiesHandler(BaseHTTPRequestHandler):
+    """
+    answers GetCapabilities requests with the class document, or a 304 if
+    the etag sent matches, and records the query parameters of each request
+    """
+
+    doc = WMS_111_CAPS
+    etag = '"v1"'
+    requests = list()
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        type(self).requests.append(params)
+        if self.etag is not None and self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        if self.etag is not None:
+            self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(self.doc)
+
+    def log_message(self, *args):
+        pass
+
+
+def expired_wms_111_entry(url):
+    entry = CachedEntry("wms", url)
+    entry.set_service(WebMapService(url, version="1.1.1", xml=WMS_111_CAPS))
+    entry.etag = '"v1"'
+    entry.timestamp = 0
+    return entry
+
+
+def test_revalidation_keeps_the_service_version():
+    plain_session()
+    server, url = serve(CapabilitiesHandler)
+    try:
+        c = capcache()
+        rkey = f"wms-{url.replace('/','~')}"
+        previous = expired_wms_111_entry(url)
+        assert previous.summary["version"] == "1.1.1"
+        c.rediscli.set(rkey, previous.dumps())
+        # unchanged: the conditional request is answered with a 304
+        CapabilitiesHandler.requests = list()
+        ce = c.get("wms", url)
+        assert [r["version"] for r in CapabilitiesHandler.requests] == ["1.1.1"]
+        assert ce.timestamp > 0 and ce.names() == ["lakes"]
+        assert c.revalidation_hits == 1
+        # changed: the new document is parsed in the version it was requested
+        CapabilitiesHandler.etag = '"v2"'
+        CapabilitiesHandler.doc = WMS_111_CAPS.replace(b'"7"', b'"8"')
+        CapabilitiesHandler.requests = list()
+        ce = c.get("wms", url, True)
+        assert [r["version"] for r in CapabilitiesHandler.requests] == ["1.1.1"]
+        assert ce.exception is None
+        assert ce.summary["version"] == "1.1.1"
+        assert ce.etag == '"v2"'
+        assert ce.updatesequence() == "8"
+        assert CachedEntry.loads(c.rediscli.get(rkey)).names() == ["lakes"]
+    finally:
+        server.shutdown()
+
+
+class SlowCapabilitiesHandler(CapabilitiesHandler):
+    """
+    takes its time to answer, and counts the requests
+    """
+
+    doc = WMS_130_CAPS
+    etag = None
+    requests = list()
+
+    def do_GET(self):
+        sleep(0.5)
+        super().do_GET()
+
+
+def test_fetches_are_coalesced_across_processes():
+    plain_session()
+    server, url = serve(SlowCapabilitiesHandler)
+    try:
+        SlowCapabilitiesHandler.requests = list()
+        # several processes sharing the same redis
+        redis = fakeredis.FakeServer()
+        caches = [capcache(redis) for i in range(5)]
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            entries = list(pool.map(lambda c: c.get("wms", url), caches))
+        assert len(SlowCapabilitiesHandler.requests) == 1
+        assert all(e.names() == ["roads", "rivers"] for e in entries)
+        assert len(set(e.timestamp for e in entries)) == 1
+        # once expired, the other processes get the stale entry while one refetches
+        rkey = f"wms-{url.replace('/','~')}"
+        expired = CachedEntry.loads(caches[0].rediscli.get(rkey))
+        expired.timestamp = 0
+        caches[0].rediscli.set(rkey, expired.dumps())
+        for c in caches:
+            c.services.put("wms", url, CachedEntry.loads(expired.dumps()))
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            entries = list(pool.map(lambda c: c.get("wms", url), caches))
+        assert len(SlowCapabilitiesHandler.requests) == 2
+        assert sum(1 for e in entries if e.timestamp == 0) == 4
+    finally:
+        server.shutdown()
+
+
+def test_stale_entries_are_served_while_refreshing():
+    from geordash.tasks import capabilities
+
+    plain_session()
+    server, url = serve(SlowCapabilitiesHandler)
+    c = capcache()
+    c.stale_while_revalidate = True
+    c.max_staleness = 3600
+    rkey = f"wms-{url.replace('/','~')}"
+    entry = wms_entry(url)
+    entry.timestamp = time() - c.cache_lifetime - 600
+    c.set_entry_in_redis(rkey, entry)
+    # expired entries are kept in redis to be served
+    assert c.rediscli.ttl(rkey) > c.cache_lifetime
+    queued = list()
+    delay = capabilities.refresh_capabilities.delay
+    capabilities.refresh_capabilities.delay = lambda *args: queued.append(args)
+    try:
+        SlowCapabilitiesHandler.requests = list()
+        assert c.get("wms", url).timestamp == entry.timestamp
+        assert c.get("wms", url).timestamp == entry.timestamp
+        # without waiting for the remote, and only queueing one refresh
+        assert SlowCapabilitiesHandler.requests == list()
+        assert queued == [("wms", url)]
+        # too old to be served, fetched right away
+        entry.timestamp = time() - c.cache_lifetime - c.max_staleness - 10
+        c.services.pop("wms", url)
+        c.set_entry_in_redis(rkey, entry)
+        ce = c.get("wms", url)
+        assert ce.timestamp > time() - 60
+        assert len(SlowCapabilitiesHandler.requests) == 1
+        assert len(queued) == 1
+    finally:
+        capabilities.refresh_capabilities.delay = delay
+        server.shutdown()
+
+
+def test_crashed_fetcher_lock_expires():
+    plain_session()
+    server, url = serve(SlowCapabilitiesHandler)
+    try:
+        SlowCapabilitiesHandler.requests = list()
+        c = capcache()
+        c.fetch_lock_timeout = 1
+        # taken by a process which crashed while fetching
+        rkey = f"wms-{url.replace('/','~')}"
+        c.rediscli.lock(f"lock-{rkey}", timeout=1).acquire()
+        start = time()
+        ce = c.get("wms", url)
+        assert ce.names() == ["roads", "rivers"]
+        assert len(SlowCapabilitiesHandler.requests) == 1
+        assert 1 <= time() - start < 3
+    finally:
+        server.shutdown()
+
+
+class FailingHandler(CapabilitiesHandler):
+    """
+    answers every request with an error, and counts them
+    """
+
+    requests = list()
+
+    def do_GET(self):
+        type(self).requests.append(self.path)
+        self.send_response(500)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def test_failures_are_retried_with_a_backoff():
+    plain_session()
+    server, url = serve(FailingHandler)
+    try:
+        FailingHandler.requests = list()
+        c = capcache()
+        c.failure_backoff = 100
+        c.failure_backoff_max = 300
+        ce = c.get("wms", url)
+        assert ce.exception is not None
+        assert (ce.failures, ce.retry_at) == (1, ce.timestamp + 100)
+        sent = len(FailingHandler.requests)
+        assert sent > 0
+        # the failure is returned until its retry time, even when forcing
+        assert c.get("wms", url) is ce
+        assert c.get("wms", url, True) is ce
+        assert len(FailingHandler.requests) == sent
+        # and by the other processes, from redis
+        rkey = f"wms-{url.replace('/','~')}"
+        assert c.get_entry_from_redis(rkey, True).retry_at == ce.retry_at
+        # the delay doubles with each consecutive failure, up to the max
+        for failures, delay in ((2, 200), (3, 300)):
+            ce.retry_at = time() - 1
+            c.rediscli.set(rkey, ce.dumps())
+            ce = c.get("wms", url)
+            assert (ce.failures, ce.retry_at) == (failures, ce.timestamp + delay)
+        assert len(FailingHandler.requests) == 3 * sent
+    finally:
+        server.shutdown()
+
+
+def test_layer_names_index():
+    redis = fakeredis.FakeServer()
+    url = "http://wms.example.org/ows"
+    rkey = f"wms-{url.replace('/','~')}"
+    capcache(redis).set_entry_in_redis(rkey, wms_entry(url))
+    # another process answers from the set of names, without decoding the entry
+    c = capcache(redis)
+    c.get = None
+    assert c.has_layers("wms", url, ["roads", "lakes"]) == {
+        "roads": True,
+        "lakes": False,
+    }
+    assert c.services.peek("wms", url) is None
+    # failures have no set of names, has_layers() then goes through get()
+    failure = CachedEntry("wms", url)
+    failure.exception = Exception("down")
+    failure.timestamp = time()
+    failure.retry_at = time() + 60
+    c.set_entry_in_redis(rkey, failure)
+    assert not c.rediscli.exists(f"names-{rkey}")
+    c = capcache(redis)
+    assert c.has_layers("wms", url, ["roads"]) is None
+
+
+def subscribed_capcache(server):
+    """
+    returns a capcache listening for the invalidations of the others
+    """
+    c = capcache(server)
+    del c.ensure_subscriber
+    c.ensure_subscriber()
+    return c
+
+
+def test_invalidations_across_processes():
+    redis = fakeredis.FakeServer()
+    url = "http://wms.example.org/ows"
+    rkey = f"wms-{url.replace('/','~')}"
+    a, b = (subscribed_capcache(redis), subscribed_capcache(redis))
+    a.set_entry_in_redis(rkey, wms_entry(url))
+    assert b.get("wms", url).names() == ["roads", "rivers"]
+    # a newer revision is persisted by another process
+    changed = wms_entry(url, WMS_130_CAPS.replace(b"<Name>rivers<", b"<Name>lakes<"))
+    a.set_entry_in_redis(rkey, changed)
+    deadline = time() + 5
+    while b.services.peek("wms", url) is not None and time() < deadline:
+        sleep(0.05)
+    assert b.services.peek("wms", url) is None
+    assert b.get("wms", url).names() == ["roads", "lakes"]
+    # older revisions dont drop the entry
+    b.invalidate("wms", url, changed.revision - 1)
+    assert b.services.peek("wms", url) is not None
+    # forgetting an entry drops it everywhere
+    a.forget("wms", url)
+    deadline = time() + 5
+    while b.services.peek("wms", url) is not None and time() < deadline:
+        sleep(0.05)
+    assert b.services.peek("wms", url) is None
+
+
+def csw_record(uuid):
+    return CswRecord(etree.fromstring(CSW_RECORD % (uuid.encode(), uuid.encode())))
+
+
+def test_csw_records_are_stored_one_by_one():
+    redis = fakeredis.FakeServer()
+    url = "http://csw.example.org/csw"
+    rkey = f"csw-{url.replace('/','~')}"
+    entry = CachedEntry("csw", url)
+    entry.xml = CSW_CAPS
+    entry.summary = {"version": "2.0.2", "updateSequence": "42", "title": None}
+    entry.timestamp = time()
+    entry.records = {u: csw_record(u) for u in ("a", "b", "c")}
+    c = capcache(redis)
+    c.set_entry_in_redis(rkey, entry)
+    assert sorted(c.rediscli.hkeys(f"records-{rkey}")) == [b"a", b"b", b"c"]
+    assert 0 < c.rediscli.ttl(f"records-{rkey}") <= c.rediscli.ttl(rkey)
+    # the records dont stay in memory once persisted
+    assert isinstance(entry.records, RecordStore)
+    # another process reads them from the hash, only when accessed
+    ce = capcache(redis).load_entry_from_redis(rkey)
+    assert isinstance(ce.records, RecordStore)
+    assert ce.nelems() == 3
+    assert ce.records["b"].title == "record b"
+    assert "d" not in ce.records
+    # updating a record only writes that one, without rewriting the entry
+    blob = c.rediscli.get(rkey)
+    ce.records["d"] = csw_record("d")
+    del ce.records["a"]
+    assert sorted(ce.records) == ["b", "c", "d"]
+    assert {u: r.title for u, r in ce.records.items()}["d"] == "record d"
+    assert c.rediscli.get(rkey) == blob
+    assert c.load_entry_from_redis(rkey).nelems() == 3
+
+
+def test_scheduled_refreshes_keep_the_url():
+    from flask import Flask
+    from geordash.tasks import capabilities
+
+    c = capcache()
+    c.refresh_ahead = 1800
+    # '~' in the url cant be told apart from a '/' in the entry key
+    url = "http://wms.example.org/~user/ows"
+    rkey = f"wms-{url.replace('/','~')}"
+    entry = wms_entry(url)
+    assert CachedEntry.header(entry.dumps())["url"] == url
+    # expiring in 10 minutes, though its key was just rewritten with a full ttl
+    entry.timestamp = time() - c.cache_lifetime + 600
+    c.set_entry_in_redis(rkey, entry)
+    # fresh, though its key expires soon
+    fresh = wms_entry("http://wms.example.org/fresh")
+    c.set_entry_in_redis("wms-http:~~wms.example.org~fresh", fresh)
+    c.rediscli.expire("wms-http:~~wms.example.org~fresh", 600)
+    queued = list()
+    app = Flask(__name__)
+    app.extensions["owscache"] = c
+    apply_async = capabilities.refresh_capabilities.apply_async
+    capabilities.refresh_capabilities.apply_async = (
+        lambda args, countdown: queued.append(args)
+    )
+    try:
+        with app.app_context():
+            assert capabilities.schedule_refreshes() == 1
+            # already queued
+            assert capabilities.schedule_refreshes() == 0
+    finally:
+        capabilities.refresh_capabilities.apply_async = apply_async
+    assert queued == [("wms", url)]
+
+
+class GeorchestraConf:
+    """
+    stands for the georchestra datadir configuration
+    """
+
+    def get(self, key, section="default"):
+        return {"domainName": "georchestra.example.org"}.get(key)
+
+
+class ServicesHandler(CapabilitiesHandler):
+    """
+    answers the GetCapabilities requests of any service path
+    """
+
+    doc = WMS_130_CAPS
+    etag = None
+    requests = list()
+
+
+def test_warmup_fetches_the_referenced_services():
+    from types import SimpleNamespace
+    from flask import Flask
+    from geordash.tasks import capabilities
+
+    plain_session()
+    server, url = serve(ServicesHandler)
+    try:
+        c = capcache()
+        c.warmup_workers = 2
+        # a cached csw record links to another service on the same server
+        catalog = CachedEntry("csw", "http://csw.example.org/csw")
+        catalog.xml = CSW_CAPS
+        catalog.summary = {"version": "2.0.2", "updateSequence": "42", "title": None}
+        catalog.timestamp = time()
+        link = f'<dc:URI protocol="OGC:WMS">{url}/other?</dc:URI>'.encode()
+        record = CSW_RECORD.replace(b"</csw:Record>", link + b"</csw:Record>")
+        catalog.records = {"md": CswRecord(etree.fromstring(record % (b"md", b"md")))}
+        c.set_entry_in_redis("csw-http:~~csw.example.org~csw", catalog)
+        app = Flask(__name__)
+        app.extensions["owscache"] = c
+        app.extensions["conf"] = GeorchestraConf()
+        # without mapstore database, its services are skipped
+        beat_schedule = {
+            "ows": {
+                "task": "geordash.checks.ows.owsservice",
+                "args": ("wms", f"{url}/ows"),
+            },
+            "down": {
+                "task": "geordash.checks.ows.owsservice",
+                "args": ("wms", "http://127.0.0.1:1/ows"),
+            },
+        }
+        app.extensions["celery"] = SimpleNamespace(
+            conf=SimpleNamespace(beat_schedule=beat_schedule)
+        )
+        progress = list()
+        with app.app_context():
+            r = capabilities.warmup(lambda current, total: progress.append(current))
+        assert sorted(t["url"] for t in r["timings"]) == [
+            "http://127.0.0.1:1/ows",
+            f"{url}/other",
+            f"{url}/ows",
+        ]
+        assert r["failed"] == 1
+        assert progress == [1, 2, 3]
+        # slowest first
+        durations = [t["duration"] for t in r["timings"]]
+        assert durations == sorted(durations, reverse=True)
+        for u in (f"{url}/ows", f"{url}/other"):
+            assert c.rediscli.exists(f"wms-{u.replace('/','~')}")
+            assert c.services.peek("wms", u).names() == ["roads", "rivers"]
+    finally:
+        server.shutdown()
+
+
+def test_entry_header_from_a_prefix():
+    blob = wms_entry().dumps()
+    header = CachedEntry.header(blob[:600])
+    assert (header["stype"], header["url"]) == ("wms", "http://wms.example.org/ows")
+    # the prefix doesnt hold the whole header
+    assert CachedEntry.header(blob[:20]) is None
+    assert CachedEntry.header(blob[:5]) is None
+
+
+class SizedEntry:
+    """
+    stands for a CachedEntry of a given approximate size
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.timestamp = 0
+        self.exception = None
+        self._s = None
+
+    def approx_size(self):
+        return self.size
+
+    def nelems(self):
+        return 1
+
+
+def test_memory_tier_evicts_least_recently_used():
+    tier = MemoryTier(1000, 3600)
+    for name in ("a", "b", "c"):
+        tier.put("wms", name, SizedEntry(300))
+    assert tier.size == 900
+    # a becomes the most recently used, b the least
+    assert tier.get("wms", "a") is not None
+    tier.put("wms", "d", SizedEntry(300))
+    assert tier.peek("wms", "b") is None
+    assert [e["url"] for e in tier.resident()] == ["c", "a", "d"]
+    assert tier.size == 900
+    assert tier.stats["evictions"] == 1
+    assert tier.get("wms", "b") is None
+    assert (tier.stats["hits"], tier.stats["misses"]) == (1, 1)
+
+
+def test_memory_tier_accounts_growing_entries():
+    tier = MemoryTier(1000, 3600)
+    a = SizedEntry(100)
+    tier.put("wms", "a", a)
+    tier.put("wms", "b", SizedEntry(100))
+    # eg the service object of a was rebuilt from its xml
+    a.size = 950
+    tier.get("wms", "a")
+    assert tier.size == 950
+    assert tier.peek("wms", "b") is None
+    # the most recently used entry is kept, even over budget
+    a.size = 2000
+    tier.get("wms", "a")
+    assert tier.peek("wms", "a") is a
+    assert tier.size == 2000
+    assert tier.pop("wms", "a") is a
+    assert tier.size == 0
+
+
+def test_entry_size_estimation():
+    ce = CachedEntry.loads(wms_entry().dumps())
+    assert ce.approx_size() == len(ce.xml)
+    ce.s
+    assert ce.approx_size() == len(ce.xml) * (1 + PARSED_XML_FACTOR)
+
+
+def test_memory_tier_expires_idle_entries():
+    tier = MemoryTier(1000, 1)
+    tier.put("wms", "a", SizedEntry(100))
+    tier.put("wms", "b", SizedEntry(100))
+    sleep(0.6)
+    tier.get("wms", "b")
+    sleep(0.6)
+    # a wasnt used for more than idle_ttl
+    assert tier.get("wms", "a") is None
+    assert tier.peek("wms", "b") is not None
+    assert tier.stats["expirations"] == 1
+    assert tier.size == 100
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_revalidation_keeps_the_service_version()
+    test_fetches_are_coalesced_across_processes()
+    test_stale_entries_are_served_while_refreshing()
+    test_crashed_fetcher_lock_expires()
+    test_failures_are_retried_with_a_backoff()
+    test_layer_names_index()
+    test_invalidations_across_processes()
+    test_csw_records_are_stored_one_by_one()
+    test_scheduled_refreshes_keep_the_url()
+    test_warmup_fetches_the_referenced_services()
+    test_entry_header_from_a_prefix()
+    test_memory_tier_evicts_least_recently_used()
+    test_memory_tier_accounts_growing_entries()
+    test_entry_size_estimation()
+    test_memory_tier_expires_idle_entries()
@@ -61,7 +61,7 @@ def test_get_gsd_view():
 def check_single_item(itemtype, itemid):
     # force-forget existing cache
     c.rediscli.delete("geoserver_datadir")
-    c.services["geoserver_datadir"] = None
+    c.gsdd = None
     # queue a task checking the given item
     task = gsdatadir_item.delay(itemtype, itemid)
     wait_for_task_completion(task.id)
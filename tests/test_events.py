@@ -0,0 +1,86 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from celery import Celery
+from celery.events import Event
+from celery.utils.saferepr import saferepr
+
+# import the module we want to test
+from geordash.events import CeleryEventsHandler
+
+
+class RecordingClient:
+    """
+    stands for the RedisClient, records the registered tasks
+    """
+
+    def __init__(self):
+        self.tasks = list()
+
+    def add_taskid_for_taskname_and_args(self, taskname, args, taskid):
+        self.tasks.append((taskname, args, taskid))
+
+
+class FakeApp:
+    def __init__(self):
+        self.extensions = {"celery": Celery(), "rcli": RecordingClient()}
+
+
+def task_sent(uuid, name, args):
+    # as sent by celery with task_send_sent_event
+    return Event(
+        "task-sent",
+        uuid=uuid,
+        name=name,
+        args=saferepr(args, 1024),
+        kwargs="{}",
+        retries=0,
+        eta=None,
+        expires=None,
+        queue="celery",
+        exchange="",
+        routing_key="celery",
+        root_id=uuid,
+        parent_id=None,
+        hostname="gen1@worker",
+        clock=1,
+        local_received=0,
+    )
+
+
+def test_task_sent_registers_the_task():
+    app = FakeApp()
+    evh = CeleryEventsHandler(app)
+    evh.task_sent(
+        task_sent("a", "geordash.checks.ows.owslayers", ("wms", "http://x", ["l1"]))
+    )
+    assert app.extensions["rcli"].tasks == [
+        ("geordash.checks.ows.owslayers", ["wms", "http://x", ["l1"]], "a")
+    ]
+
+
+def test_task_sent_skips_truncated_args():
+    app = FakeApp()
+    evh = CeleryEventsHandler(app)
+    # a chunk of layers whose args repr is longer than 1024 chars
+    args = ("wms", "http://x", [f"layer_{'x' * 40}_{i}" for i in range(30)])
+    assert saferepr(args, 1024).endswith("...])")
+    evh.task_sent(task_sent("a", "geordash.checks.ows.owslayers", args))
+    assert app.extensions["rcli"].tasks == list()
+    # the next events are still handled
+    evh.task_sent(task_sent("b", "geordash.checks.ows.owsservice", ("wms", "http://x")))
+    assert app.extensions["rcli"].tasks == [
+        ("geordash.checks.ows.owsservice", ["wms", "http://x"], "b")
+    ]
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_task_sent_registers_the_task()
+    test_task_sent_skips_truncated_args()
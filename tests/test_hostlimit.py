@@ -0,0 +1,65 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+from time import perf_counter
+from flask import Flask
+import fakeredis
+
+# import the module we want to test
+from geordash.hostlimit import HostLimiter
+from geordash.httpclient import PooledSession
+from tests.fixtures import serve
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_limit_adapts_to_the_host():
+    limiter = HostLimiter(fakeredis.FakeRedis(), ceiling=4)
+    token = limiter.acquire("a.example.org")
+    assert limiter.release("a.example.org", token, 0.1, 503) == 2
+    token = limiter.acquire("a.example.org")
+    assert limiter.release("a.example.org", token, 0.1, 200) == 2.5
+    # connection failures and timeouts count as congestion
+    token = limiter.acquire("a.example.org")
+    assert limiter.release("a.example.org", token, 0.1) == 1.25
+
+
+def test_interactive_requests_dont_wait_behind_tasks():
+    server, url = serve(OkHandler)
+    try:
+        limiter = HostLimiter(fakeredis.FakeRedis(), ceiling=1, interactive_wait=0.5)
+        limiter.wait_timeout = 2
+        s = PooledSession(5, 1, 1, limiter)
+        # the only slot is taken by a long probe
+        assert limiter.acquire("127.0.0.1") is not None
+        start = perf_counter()
+        with Flask(__name__).test_request_context():
+            assert s.get(url).status_code == 200
+        assert 0.5 <= perf_counter() - start < 1.5
+        # outside of a web request, waits up to wait_timeout
+        start = perf_counter()
+        assert s.get(url).status_code == 200
+        assert perf_counter() - start >= 2
+    finally:
+        server.shutdown()
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_limit_adapts_to_the_host()
+    test_interactive_requests_dont_wait_behind_tasks()
@@ -0,0 +1,100 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+import threading
+import requests
+import owslib.util
+
+# import the module we want to test
+from geordash.httpclient import owslib_session
+from geordash.probes import capture, replay, CaptureSession
+from tests.fixtures import serve
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """
+    answers with an xml document giving the method, path and body received
+    """
+
+    def respond(self, body):
+        doc = f"<echo method='{self.command}' path='{self.path}'>{body}</echo>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(doc.encode())
+
+    def do_GET(self):
+        self.respond("")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.respond(self.rfile.read(length).decode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_owslib_http_post_through_session():
+    server, url = serve(EchoHandler)
+    try:
+        # owslib passes the request body as a positional argument
+        with owslib_session(requests.Session()):
+            r = owslib.util.http_post(f"{url}/csw", "<GetRecords/>")
+        assert r.status_code == 200
+        assert b"method='POST'" in r.content
+        assert b"<GetRecords/>" in r.content
+    finally:
+        server.shutdown()
+
+
+def test_owslib_openurl_through_session():
+    server, url = serve(EchoHandler)
+    try:
+        with owslib_session(requests.Session()):
+            r = owslib.util.openURL(f"{url}/ows", {"request": "GetCapabilities"})
+            assert b"path='/ows?request=GetCapabilities'" in r.read()
+            r = owslib.util.openURL(f"{url}/ows", "<GetFeature/>", method="Post")
+            assert b"<GetFeature/>" in r.read()
+    finally:
+        server.shutdown()
+
+
+def test_capture_and_replay_post():
+    req = capture(lambda: owslib.util.http_post("http://csw.example.org", "<x/>"))
+    assert (req.method, req.url) == ("POST", "http://csw.example.org")
+    assert req.kwargs["data"] == "<x/>"
+    r = requests.Response()
+    r.status_code = 200
+    r._content = b"<done/>"
+    outcome = replay(lambda: owslib.util.http_post("http://csw.example.org", "<x/>"), r)
+    assert outcome.content == b"<done/>"
+
+
+def test_session_shim_is_thread_local():
+    seen = list()
+
+    def other_thread():
+        # not in an owslib_session() block, goes to the requests module
+        seen.append(owslib.util.requests._target())
+
+    with owslib_session(CaptureSession()):
+        t = threading.Thread(target=other_thread)
+        t.start()
+        t.join()
+        assert isinstance(owslib.util.requests._target(), CaptureSession)
+    assert seen == [requests]
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_owslib_http_post_through_session()
+    test_owslib_openurl_through_session()
+    test_capture_and_replay_post()
+    test_session_shim_is_thread_local()
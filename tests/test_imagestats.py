@@ -0,0 +1,64 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from io import BytesIO
+import pytest
+
+# pillow and numpy are optional dependencies
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+# import the module we want to test
+from geordash.imagestats import image_stats
+
+
+def png(img):
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_transparent_image():
+    stats = image_stats(png(Image.new("RGBA", (256, 256), (0, 0, 0, 0))))
+    assert stats["blank"]
+    assert (stats["width"], stats["height"]) == (256, 256)
+    assert stats["transparent"] == 1
+
+
+def test_single_colour_image():
+    stats = image_stats(png(Image.new("RGB", (10, 20), (255, 255, 255))))
+    assert stats["blank"]
+    assert (stats["width"], stats["height"]) == (10, 20)
+    assert stats["transparent"] == 0
+    assert (stats["colors"], stats["color"]) == (1, "#ffffffff")
+
+
+def test_varied_image():
+    img = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+    # a road crossing a transparent image
+    for x in range(256):
+        img.putpixel((x, 128), (200, 0, 0, 255))
+    stats = image_stats(png(img))
+    assert not stats["blank"]
+    assert stats["colors"] == 2
+    assert stats["transparent"] == round(255 / 256, 4)
+    assert "color" not in stats
+
+
+def test_undecodable_image():
+    assert image_stats(b"<ServiceExceptionReport/>") is None
+    assert image_stats(png(Image.new("RGB", (8, 8)))[:40]) is None
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_transparent_image()
+    test_single_colour_image()
+    test_varied_image()
+    test_undecodable_image()
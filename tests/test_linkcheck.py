@@ -0,0 +1,186 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+import fakeredis
+
+# import the module we want to test
+from geordash.linkcheck import LinkChecker, normalize_url
+from tests.fixtures import plain_session, serve
+
+
+class LinkHandler(BaseHTTPRequestHandler):
+    """
+    /ok answers HEAD requests, /nohead only answers ranged GET requests, /login
+    redirects to /ok, the other paths dont exist. records the method and path
+    of each request
+    """
+
+    requests = list()
+    delay = 0
+
+    def answer(self, code, length=0):
+        type(self).requests.append((self.command, self.path))
+        sleep(self.delay)
+        self.send_response(code)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def redirect(self):
+        type(self).requests.append((self.command, self.path))
+        self.send_response(302)
+        self.send_header("Location", "/ok")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        if self.path.split("?")[0] == "/ok":
+            self.answer(200)
+        elif self.path == "/login":
+            self.redirect()
+        elif self.path == "/nohead":
+            self.answer(405)
+        else:
+            self.answer(404)
+
+    def do_GET(self):
+        if self.path == "/nohead" and self.headers.get("Range") == "bytes=0-0":
+            self.answer(206, 1)
+            self.wfile.write(b"x")
+        else:
+            self.answer(404)
+
+    def log_message(self, *args):
+        pass
+
+
+def linkchecker(server=None):
+    lc = LinkChecker("redis://localhost")
+    lc.rediscli = fakeredis.FakeRedis(server=server or fakeredis.FakeServer())
+    return lc
+
+
+def test_normalize_url():
+    assert (
+        normalize_url("HTTP://Example.ORG:80/md?b=2&a=1#top")
+        == "http://example.org/md?a=1&b=2"
+    )
+    assert normalize_url("https://example.org:443") == "https://example.org/"
+    assert normalize_url("https://example.org:8443/x") == "https://example.org:8443/x"
+    assert normalize_url(" https://u:p@Example.org/x ") == "https://u:p@example.org/x"
+    assert normalize_url("http://[::1]:8080/x") == "http://[::1]:8080/x"
+    # the path stays case-sensitive
+    assert normalize_url("http://example.org/MD") != normalize_url(
+        "http://example.org/md"
+    )
+
+
+def test_head_falls_back_to_ranged_get():
+    plain_session()
+    server, url = serve(LinkHandler)
+    try:
+        LinkHandler.requests = list()
+        lc = linkchecker()
+        res = lc.probe(f"{url}/ok")
+        assert (res["code"], res["method"]) == (200, "HEAD")
+        res = lc.probe(f"{url}/nohead")
+        assert (res["code"], res["method"]) == (200, "GET")
+        res = lc.probe(f"{url}/missing")
+        assert (res["code"], res["method"]) == (404, "GET")
+        assert LinkHandler.requests == [
+            ("HEAD", "/ok"),
+            ("HEAD", "/nohead"),
+            ("GET", "/nohead"),
+            ("HEAD", "/missing"),
+            ("GET", "/missing"),
+        ]
+        # redirects are reported, not followed
+        LinkHandler.requests = list()
+        res = lc.probe(f"{url}/login")
+        assert (res["code"], res["method"]) == (302, "HEAD")
+        assert LinkHandler.requests == [("HEAD", "/login")]
+        res = lc.probe("http://127.0.0.1:1/closed")
+        assert res["code"] is None
+        assert res["exception"] == "requests.exceptions.ConnectionError"
+    finally:
+        server.shutdown()
+
+
+def test_results_are_cached_by_normalized_url():
+    plain_session()
+    server, url = serve(LinkHandler)
+    try:
+        LinkHandler.requests = list()
+        lc = linkchecker()
+        lc.check(f"{url}/ok?b=1&a=2")
+        res = lc.check(f"{url.upper()}/ok?a=2&b=1#md")
+        assert res["code"] == 200
+        assert len(LinkHandler.requests) == 1
+        assert 0 < lc.rediscli.ttl(lc.key(f"{url}/ok?a=2&b=1")) <= lc.success_ttl
+        # failures are kept for a shorter time
+        lc.check(f"{url}/missing")
+        assert 0 < lc.rediscli.ttl(lc.key(f"{url}/missing")) <= lc.failure_ttl
+        lc.check(f"{url}/ok?a=2&b=1", force=True)
+        assert len(LinkHandler.requests) == 4
+    finally:
+        server.shutdown()
+
+
+def test_failures_are_checked_again_with_a_longer_timeout():
+    plain_session()
+    server, url = serve(LinkHandler)
+    try:
+        LinkHandler.requests = list()
+        lc = linkchecker()
+        lc.check(f"{url}/missing", 5)
+        lc.check(f"{url}/missing", 5)
+        lc.check(f"{url}/missing", 1)
+        assert len(LinkHandler.requests) == 2
+        # a failure within 5s doesnt say much about a 60s download
+        res = lc.check(f"{url}/missing", 60)
+        assert (res["code"], res["timeout"]) == (404, 60)
+        assert len(LinkHandler.requests) == 4
+        lc.check(f"{url}/missing", 5)
+        assert len(LinkHandler.requests) == 4
+        # successes are reused whatever the timeout
+        lc.check(f"{url}/ok", 5)
+        lc.check(f"{url}/ok", 60)
+        lc.check(f"{url}/ok")
+        assert len(LinkHandler.requests) == 5
+    finally:
+        server.shutdown()
+
+
+def test_concurrent_checks_are_merged():
+    plain_session()
+    server, url = serve(LinkHandler)
+    try:
+        LinkHandler.requests = list()
+        LinkHandler.delay = 0.5
+        # several processes sharing the same redis
+        redis = fakeredis.FakeServer()
+        checkers = [linkchecker(redis) for i in range(5)]
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            results = list(pool.map(lambda lc: lc.check(f"{url}/ok"), checkers))
+        assert len(LinkHandler.requests) == 1
+        assert all(r["code"] == 200 for r in results)
+    finally:
+        LinkHandler.delay = 0
+        server.shutdown()
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_normalize_url()
+    test_head_falls_back_to_ranged_get()
+    test_results_are_cached_by_normalized_url()
+    test_failures_are_checked_again_with_a_longer_timeout()
+    test_concurrent_checks_are_merged()
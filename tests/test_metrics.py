@@ -0,0 +1,85 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+import fakeredis
+
+# import the module we want to test
+from geordash.metrics import Metrics, labelstr
+from tests.fixtures import capcache, wms_entry
+
+
+def process_metrics(server):
+    """
+    returns the metrics of a process writing to the given fakeredis server
+    """
+    m = Metrics()
+    m.rediscli = fakeredis.FakeRedis(server=server)
+    return m
+
+
+def test_labels_are_escaped():
+    assert labelstr({"url": 'http://x/"a"\n', "stype": "wms"}) == (
+        'stype="wms",url="http://x/\\"a\\"\\n"'
+    )
+
+
+def test_metrics_are_aggregated_across_processes():
+    server = fakeredis.FakeServer()
+    a, b = (process_metrics(server), process_metrics(server))
+    a.inc("gaia_linkcheck_lookups_total", result="hit")
+    b.inc("gaia_linkcheck_lookups_total", result="hit")
+    b.inc("gaia_linkcheck_lookups_total", result="checked")
+    a.observe("gaia_probe_seconds", 0.07, check="ows", operation="GetMap")
+    b.observe("gaia_probe_seconds", 3, check="ows", operation="GetMap")
+    b.set("gaia_host_concurrency_limit", 4, host="wms.example.org")
+    # kept in memory until flushed
+    assert a.rediscli.keys("metrics-*") == list()
+    a.flush()
+    lines = b.render().splitlines()
+    assert 'gaia_linkcheck_lookups_total{result="hit"} 2' in lines
+    assert 'gaia_linkcheck_lookups_total{result="checked"} 1' in lines
+    assert 'gaia_host_concurrency_limit{host="wms.example.org"} 4' in lines
+    labels = 'check="ows",operation="GetMap"'
+    assert f'gaia_probe_seconds_bucket{{{labels},le="0.05"}} 0' in lines
+    assert f'gaia_probe_seconds_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'gaia_probe_seconds_bucket{{{labels},le="5"}} 2' in lines
+    assert f'gaia_probe_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f"gaia_probe_seconds_sum{{{labels}}} 3.07" in lines
+    assert f"gaia_probe_seconds_count{{{labels}}} 2" in lines
+    # every metric is described, even without samples
+    assert "# TYPE gaia_task_seconds histogram" in lines
+
+
+def test_cache_lookups_are_counted():
+    from geordash import owscapcache
+
+    server = fakeredis.FakeServer()
+    m = process_metrics(server)
+    counted = owscapcache.metrics
+    owscapcache.metrics = m
+    try:
+        c = capcache(server)
+        url = "http://wms.example.org/ows"
+        c.set_entry_in_redis(f"wms-{url.replace('/','~')}", wms_entry(url))
+        c.get("wms", url)
+        c.get("wms", url)
+    finally:
+        owscapcache.metrics = counted
+    lines = m.render().splitlines()
+    name = "gaia_owscache_lookups_total"
+    assert f'{name}{{result="miss",stype="wms",tier="memory"}} 1' in lines
+    assert f'{name}{{result="hit",stype="wms",tier="memory"}} 1' in lines
+    assert f'{name}{{result="hit",stype="wms",tier="redis"}} 1' in lines
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_labels_are_escaped()
+    test_metrics_are_aggregated_across_processes()
+    test_cache_lookups_are_counted()
@@ -45,7 +45,7 @@ def test_csw_update_redis():
     # ensure the cached entry has no records
     assert s.records == None
     assert (
-        c.services["csw"]["https://ids.dev.craig.fr/geocat/atmo/fre/csw"].records
+        c.services.peek("csw", "https://ids.dev.craig.fr/geocat/atmo/fre/csw").records
         == None
     )
 
@@ -0,0 +1,469 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from io import BytesIO
+from flask import Flask
+from celery.utils.saferepr import saferepr
+from owslib.wmts import WebMapTileService
+from time import time
+import json
+import ast
+import pytest
+
+# import the module we want to test
+from geordash.checks import ows
+from geordash.owscapcache import CachedEntry, CachedCatalogueServiceWeb
+from tests.fixtures import (
+    capcache,
+    plain_session,
+    serve,
+    wms_entry,
+    CSW_CAPS,
+    WMS_130_CAPS,
+    WMTS_CAPS,
+)
+
+
+class GeorchestraConf:
+    """
+    stands for the georchestra datadir configuration
+    """
+
+    def get(self, key, section="default"):
+        return {"domainName": "georchestra.example.org", "localgn": "geonetwork"}.get(
+            key
+        )
+
+
+def app_with_capcache():
+    app = Flask(__name__)
+    app.extensions["conf"] = GeorchestraConf()
+    app.extensions["owscache"] = capcache()
+    app.extensions["owscache"].conf = app.extensions["conf"]
+    return app
+
+
+def tile_sample(tm, total):
+    return {
+        "checked": 0,
+        "operation": "GetTile",
+        "ttfb": total / 2,
+        "total": total,
+        "ok": True,
+        "tilematrixset": tm.split(":")[0],
+        "tilematrix": tm,
+    }
+
+
+def test_probetimes_are_kept_by_tilematrix():
+    url = "http://wmts.example.org/gwc/service/wmts"
+    with app_with_capcache().app_context():
+        # the deep levels are slower, each run samples every level
+        for i in range(ows.PROBE_HISTORY):
+            slow = ows.record_probetimes(
+                "wmts",
+                url,
+                {
+                    ("ortho", ("PM", f"PM:{n}")): tile_sample(f"PM:{n}", 0.1 + n)
+                    for n in range(6)
+                },
+            )
+            assert slow == dict()
+        history = ows.probe_history("wmts", url, "ortho")
+        assert [h["tilematrix"] for h in history] == [f"PM:{n}" for n in range(6)]
+        # the other levels didnt push the samples of a level out of its history
+        assert all(len(h["probes"]) == ows.PROBE_HISTORY for h in history)
+        # compared with the median of its own tilematrix
+        slow = ows.record_probetimes(
+            "wmts",
+            url,
+            {
+                ("ortho", ("PM", "PM:0")): tile_sample("PM:0", 2.5),
+                ("ortho", ("PM", "PM:5")): tile_sample("PM:5", 5.1),
+            },
+        )
+        assert list(slow.keys()) == [("ortho", ("PM", "PM:0"))]
+        assert slow[("ortho", ("PM", "PM:0"))]["median"] == 0.1
+
+
+def test_probetimes_are_kept_by_operation():
+    url = "http://wms.example.org/ows"
+    with app_with_capcache().app_context():
+        for i in range(ows.SLOW_MIN_SAMPLES):
+            ows.record_probetimes(
+                "wms",
+                url,
+                {
+                    ("roads", None): {
+                        "checked": 0,
+                        "operation": "GetMap",
+                        "ttfb": 0.1,
+                        "total": 0.2,
+                        "ok": True,
+                    }
+                },
+            )
+        history = ows.probe_history("wms", url, "roads")
+        assert [(h["operation"], h["tilematrix"]) for h in history] == [
+            ("GetMap", None)
+        ]
+        # a new operation starts its own series, without a median yet
+        sample = {
+            "checked": 0,
+            "operation": "GetFeature",
+            "ttfb": 2,
+            "total": 3,
+            "ok": True,
+        }
+        slow = ows.record_probetimes("wms", url, {("roads", None): sample})
+        assert slow == dict()
+        assert len(ows.probe_history("wms", url, "roads")) == 2
+        assert ows.probe_history("wms", url, "lakes") == list()
+
+
+def test_layernames_chunks_fit_in_the_task_events():
+    url = "http://wms.example.org/geoserver/ows"
+    lnames = [f"workspace:layer_{i}" for i in range(50)]
+    assert [len(c) for c in ows.layernames_chunks("wms", url, lnames, 20)] == [
+        20,
+        20,
+        10,
+    ]
+    # long names make smaller chunks, whose args celery doesnt truncate
+    lnames = [f"workspace:{'x' * 60}_{i}" for i in range(50)]
+    chunks = list(ows.layernames_chunks("wms", url, lnames, 20))
+    assert sum(chunks, list()) == lnames
+    assert all(len(c) < 20 for c in chunks)
+    for chunk in chunks:
+        assert ast.literal_eval(saferepr(("wms", url, chunk), 1024)) == (
+            "wms",
+            url,
+            chunk,
+        )
+    # a name longer than the limit on its own
+    assert list(ows.layernames_chunks("wms", url, ["a", "x" * 2000, "b"], 20)) == [
+        ["a"],
+        ["x" * 2000],
+        ["b"],
+    ]
+
+
+def set_layerstate(url, lname, fingerprint, checked, problems=list()):
+    ows.app.extensions["owscache"].rediscli.hset(
+        ows.layerstate_key("wms", url),
+        lname,
+        json.dumps(
+            {"fingerprint": fingerprint, "checked": checked, "problems": problems}
+        ),
+    )
+
+
+def test_incremental_selection():
+    url = "http://wms.example.org/ows"
+    service = wms_entry(url)
+    fingerprints = service.fingerprints()
+    with app_with_capcache().app_context():
+        # everything is new
+        assert ows.incremental_selection("wms", url, service) == (
+            ["roads", "rivers"],
+            dict(),
+        )
+        ows.record_layerstates(
+            "wms", url, service, {n: {"problems": list()} for n in fingerprints}
+        )
+        # unchanged, the layer checked the longest time ago is sampled
+        set_layerstate(url, "roads", fingerprints["roads"], 200)
+        set_layerstate(url, "rivers", fingerprints["rivers"], 100)
+        lnames, carried = ows.incremental_selection("wms", url, service)
+        assert lnames == ["rivers"]
+        assert carried == {"roads": {"problems": list(), "checked": 200}}
+        # failing layers are checked again
+        set_layerstate(url, "roads", fingerprints["roads"], 200, [{"type": "x"}])
+        lnames, carried = ows.incremental_selection("wms", url, service)
+        assert lnames == ["roads", "rivers"]
+        assert carried == dict()
+        # as the ones whose properties changed in the capabilities
+        set_layerstate(url, "roads", fingerprints["roads"], 200)
+        changed = wms_entry(url, WMS_130_CAPS.replace(b">Roads<", b">Highways<"))
+        lnames, carried = ows.incremental_selection("wms", url, changed)
+        assert lnames == ["roads", "rivers"]
+        assert carried == dict()
+        # the carried layers are read back from the layerstates by name
+        assert ows.carry_owslayers("wms", url, ["roads", "rivers", "lakes"]) == {
+            "problems": list(),
+            "layers": {
+                "roads": {"problems": list(), "checked": 200},
+                "rivers": {"problems": list(), "checked": 100},
+            },
+        }
+        # the states of the layers removed from the service are forgotten
+        set_layerstate(url, "lakes", "x", 300)
+        ows.prune_layerstates("wms", url, service)
+        states = ows.app.extensions["owscache"].rediscli.hkeys(
+            ows.layerstate_key("wms", url)
+        )
+        assert sorted(states) == [b"rivers", b"roads"]
+
+
+class GetRecordByIdHandler(BaseHTTPRequestHandler):
+    """
+    answers GetRecordById requests with the brief records of the known uuids
+    among the requested ones, and records the uuids of each request
+    """
+
+    known = ("b",)
+    requests = list()
+
+    def do_GET(self):
+        params = {
+            k.lower(): v[0] for k, v in parse_qs(urlparse(self.path).query).items()
+        }
+        uuids = params["id"].split(",")
+        type(self).requests.append(uuids)
+        records = "".join(
+            f"<csw:BriefRecord><dc:identifier>{u}</dc:identifier></csw:BriefRecord>"
+            for u in uuids
+            if u in self.known
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(
+            (
+                '<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" '
+                f'xmlns:dc="http://purl.org/dc/elements/1.1/">{records}'
+                "</csw:GetRecordByIdResponse>"
+            ).encode()
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+def local_mdurl(uuid):
+    return (
+        '<MetadataURL type="ISO19115:2003"><Format>text/xml</Format>'
+        '<OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" '
+        f'xlink:href="https://georchestra.example.org/geonetwork/srv/api/records/{uuid}/formatters/xml"/>'
+        "</MetadataURL>"
+    ).encode()
+
+
+def test_local_metadata_uuids_are_resolved_in_a_prepass():
+    plain_session()
+    server, url = serve(GetRecordByIdHandler)
+    try:
+        GetRecordByIdHandler.requests = list()
+        # roads links to a harvested record, rivers to one which isnt yet and
+        # to a missing one
+        caps = WMS_130_CAPS.replace(
+            b"<Title>Roads</Title>", b"<Title>Roads</Title>" + local_mdurl("a")
+        ).replace(
+            b"<Title>Rivers</Title>",
+            b"<Title>Rivers</Title>" + local_mdurl("b") + local_mdurl("c"),
+        )
+        service = wms_entry("http://wms.example.org/ows", caps)
+        cswurl = "https://georchestra.example.org/geonetwork/srv/fre/csw"
+        catalog = CachedEntry("csw", cswurl)
+        catalog.xml = CSW_CAPS.replace(b"http://endpoint.example.org", url.encode())
+        catalog.s = CachedCatalogueServiceWeb(cswurl, catalog.xml)
+        catalog.timestamp = time()
+        catalog.records = {"a": None}
+        app = app_with_capcache()
+        app.extensions["owscache"].services.put("csw", cswurl, catalog)
+        with app.app_context():
+            mdexists = ows.resolve_localmduuids(service, ["roads", "rivers"])
+            assert mdexists == {"a": True, "b": True, "c": False}
+            # the harvested uuid isnt looked up, the others in a single request
+            assert GetRecordByIdHandler.requests == [["b", "c"]]
+            # the uuids whose request failed are left to the layer checks
+            server.shutdown()
+            server.server_close()
+            assert ows.resolve_localmduuids(service, ["roads", "rivers"]) == {"a": True}
+    finally:
+        server.shutdown()
+
+
+class GetFeatureHandler(BaseHTTPRequestHandler):
+    """
+    /features streams a collection of features ignoring maxfeatures, /garbage
+    never gets to a root element, /exception answers with an exception report
+    and /denied with a 403. records how many features were sent
+    """
+
+    sent = 0
+
+    def do_GET(self):
+        if self.path == "/denied":
+            self.send_response(403)
+            self.send_header("Content-Length", "9")
+            self.end_headers()
+            self.wfile.write(b"forbidden")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        try:
+            if self.path == "/exception":
+                self.wfile.write(
+                    b'<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows">'
+                    b"<ows:Exception><ows:ExceptionText>Unknown type roads</ows:ExceptionText>"
+                    b"</ows:Exception></ows:ExceptionReport>"
+                )
+            elif self.path == "/garbage":
+                self.wfile.write(b"<!--" + b"x" * 1024 * 1024)
+            else:
+                self.wfile.write(
+                    b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs">'
+                )
+                for i in range(100000):
+                    self.wfile.write(b"<wfs:member>" + b"x" * 1000 + b"</wfs:member>")
+                    type(self).sent += 1
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def test_getfeature_responses_are_read_until_their_root_element():
+    from owslib.util import ServiceException
+    from geordash.probes import CapturedRequest
+
+    plain_session()
+    server, url = serve(GetFeatureHandler)
+    maxbytes = ows.WFS_MAX_BYTES
+    try:
+        ows.WFS_MAX_BYTES = 64 * 1024
+        GetFeatureHandler.sent = 0
+        r = ows.read_root_element(CapturedRequest("GET", f"{url}/features", dict()))
+        assert r["root"] == "{http://www.opengis.net/wfs}FeatureCollection"
+        assert (r["error"], r["truncated"]) == (None, False)
+        assert r["excerpt"].startswith("<wfs:FeatureCollection")
+        # the connection was closed without reading the whole collection
+        assert GetFeatureHandler.sent < 100000
+        # reading stops at the byte cap
+        r = ows.read_root_element(CapturedRequest("GET", f"{url}/garbage", dict()))
+        assert (r["root"], r["truncated"]) == (None, True)
+        assert r["error"].startswith("no root element in the first")
+        assert len(r["excerpt"]) == ows.EXCERPT_LENGTH
+        with pytest.raises(ServiceException, match="Unknown type roads"):
+            ows.read_root_element(CapturedRequest("GET", f"{url}/exception", dict()))
+        with pytest.raises(ServiceException, match="forbidden"):
+            ows.read_root_element(CapturedRequest("GET", f"{url}/denied", dict()))
+    finally:
+        ows.WFS_MAX_BYTES = maxbytes
+        server.shutdown()
+
+
+def test_sample_tiles():
+    wmts = WebMapTileService("http://wmts.example.org/gwc/service/wmts", xml=WMTS_CAPS)
+    # the levels are spread over each tilematrixset
+    tiles = ows.sample_tiles(wmts, "ortho", 3)
+    assert [(tms, tm) for (tms, tm, r, c) in tiles] == [
+        ("PM", "PM:0"),
+        ("PM", "PM:2"),
+        ("PM", "PM:5"),
+        ("WGS84", "WGS84:0"),
+        ("WGS84", "WGS84:1"),
+        ("WGS84", "WGS84:2"),
+    ]
+    # at the center of the tilematrixlimits if any, of the matrix otherwise
+    assert [(r, c) for (tms, tm, r, c) in tiles] == [
+        (0, 0),
+        (0, 0),
+        (7, 7),
+        (0, 0),
+        (1, 1),
+        (2, 2),
+    ]
+    assert ows.sample_tiles(wmts, "ortho", 1) == [
+        ("PM", "PM:5", 7, 7),
+        ("WGS84", "WGS84:2", 2, 2),
+    ]
+    # more levels than the tilematrixsets have
+    assert len(ows.sample_tiles(wmts, "ortho", 10)) == 6 + 3
+
+
+class GetMapHandler(BaseHTTPRequestHandler):
+    """
+    renders roads as a line across the layer, away from its center, and
+    rivers as nothing at all. records the size of each GetMap request
+    """
+
+    sizes = list()
+
+    def do_GET(self):
+        from PIL import Image
+
+        params = {
+            k.upper(): v[0] for k, v in parse_qs(urlparse(self.path).query).items()
+        }
+        width, height = (int(params["WIDTH"]), int(params["HEIGHT"]))
+        type(self).sizes.append((params["LAYERS"], width))
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        # the tiny bbox at the center of the layer misses the road
+        if params["LAYERS"] == "roads" and width > 10:
+            for x in range(width):
+                img.putpixel((x, height // 8), (200, 0, 0, 255))
+        buf = BytesIO()
+        img.save(buf, format="PNG")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_blank_images_are_confirmed_on_the_whole_layer():
+    # pillow and numpy are optional dependencies
+    pytest.importorskip("numpy")
+    pytest.importorskip("PIL")
+    plain_session()
+    server, url = serve(GetMapHandler)
+    blankcheck = ows.BLANK_IMAGE_CHECK
+    try:
+        ows.BLANK_IMAGE_CHECK = True
+        GetMapHandler.sizes = list()
+        service = wms_entry(
+            f"{url}/ows", WMS_130_CAPS.replace(b"http://wms.example.org", url.encode())
+        )
+        layers = {"roads": {"problems": list()}, "rivers": {"problems": list()}}
+        with app_with_capcache().app_context():
+            ows.probe_layers("wms", f"{url}/ows", service, layers)
+        assert sorted(GetMapHandler.sizes) == [
+            ("rivers", 10),
+            ("rivers", 256),
+            ("roads", 10),
+            ("roads", 256),
+        ]
+        # the tiny GetMap of both layers is blank, only rivers is blank overall
+        assert layers["roads"]["problems"] == list()
+        (problem,) = layers["rivers"]["problems"]
+        assert (problem["type"], problem["operation"]) == ("BlankImage", "GetMap")
+        assert (problem["width"], problem["transparent"]) == (256, 1)
+    finally:
+        ows.BLANK_IMAGE_CHECK = blankcheck
+        server.shutdown()
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_probetimes_are_kept_by_tilematrix()
+    test_probetimes_are_kept_by_operation()
+    test_layernames_chunks_fit_in_the_task_events()
+    test_incremental_selection()
+    test_local_metadata_uuids_are_resolved_in_a_prepass()
+    test_getfeature_responses_are_read_until_their_root_element()
+    test_sample_tiles()
+    test_blank_images_are_confirmed_on_the_whole_layer()
@@ -0,0 +1,154 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# allows to run the python file standalone
+import sys
+
+sys.path.append(".")
+
+from http.server import BaseHTTPRequestHandler
+from time import perf_counter, sleep
+from requests.exceptions import HTTPError
+import threading
+import os
+import owslib.util
+import fakeredis
+
+# import the module we want to test
+from geordash import httpclient
+from geordash.hostlimit import HostLimiter
+from geordash.probes import probe_concurrently
+from tests.fixtures import plain_session, serve
+
+
+class XmlHandler(BaseHTTPRequestHandler):
+    """
+    answers with a small xml document after delay seconds, or a 500 error on
+    /error. records the max amount of requests in flight at once
+    """
+
+    delay = 0
+    inflight = 0
+    maxinflight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.inflight += 1
+            cls.maxinflight = max(cls.maxinflight, cls.inflight)
+        sleep(self.delay)
+        with cls.lock:
+            cls.inflight -= 1
+        if self.path.startswith("/error"):
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(b"<ok/>")
+
+    def log_message(self, *args):
+        pass
+
+
+def limited_session(ceiling):
+    """
+    makes the shared http session of the process go through a HostLimiter
+    backed by a fakeredis server, and returns the limiter
+    """
+    limiter = HostLimiter(fakeredis.FakeRedis(), ceiling)
+    httpclient._session = httpclient.PooledSession(5, 4, 4, limiter)
+    httpclient._session_pid = os.getpid()
+    return limiter
+
+
+def test_timings_dont_count_the_wait_for_a_host_slot():
+    server, url = serve(XmlHandler)
+    try:
+        limiter = limited_session(1)
+        # the only slot of the host is held by another request for a second
+        token = limiter.acquire("127.0.0.1")
+        threading.Timer(
+            1, lambda: limiter.release("127.0.0.1", token, 0.1, 200)
+        ).start()
+        timings = dict()
+        start = perf_counter()
+        outcomes = probe_concurrently(
+            {"a": ("GetCapabilities", lambda: owslib.util.openURL(f"{url}/ows"), None)},
+            "test",
+            timings=timings,
+        )
+        assert perf_counter() - start >= 1
+        assert outcomes["a"].read() == b"<ok/>"
+        assert timings["a"]["ttfb"] < 0.5
+        assert timings["a"]["total"] < 0.5
+    finally:
+        server.shutdown()
+
+
+def test_probes_are_replayed_through_owslib():
+    plain_session()
+    server, url = serve(XmlHandler)
+    try:
+        outcomes = probe_concurrently(
+            {
+                "ok": ("GetMap", lambda: owslib.util.openURL(f"{url}/ok"), None),
+                # owslib raises on 5xx answers, as if it had sent the request
+                "error": ("GetMap", lambda: owslib.util.openURL(f"{url}/error"), None),
+                # calls which dont send a request are only run
+                "local": ("GetMap", lambda: 42, None),
+                "broken": ("GetMap", lambda: 1 / 0, None),
+                # the reader sends the captured request in place of owslib
+                "reader": (
+                    "GetFeature",
+                    lambda: owslib.util.openURL(f"{url}/ok"),
+                    lambda req: (req.method, req.url),
+                ),
+            },
+            "test",
+        )
+        assert outcomes["ok"].read() == b"<ok/>"
+        assert isinstance(outcomes["error"], HTTPError)
+        assert outcomes["local"] == 42
+        assert isinstance(outcomes["broken"], ZeroDivisionError)
+        assert outcomes["reader"] == ("GET", f"{url}/ok")
+    finally:
+        server.shutdown()
+
+
+def test_probes_wait_for_a_host_slot_in_the_event_loop():
+    server, url = serve(XmlHandler)
+    try:
+        XmlHandler.delay = 0.2
+        XmlHandler.maxinflight = 0
+        limiter = limited_session(2)
+        calls = list()
+        acquire_script = limiter.acquire_script
+        limiter.acquire_script = lambda **kwargs: calls.append(1) or acquire_script(
+            **kwargs
+        )
+        outcomes = probe_concurrently(
+            {
+                i: ("GetMap", lambda i=i: owslib.util.openURL(f"{url}/{i}"), None)
+                for i in range(10)
+            },
+            "test",
+            concurrency=100,
+        )
+        assert all(o.read() == b"<ok/>" for o in outcomes.values())
+        assert XmlHandler.maxinflight == 2
+        # each request got a slot at once, instead of polling for one
+        assert len(calls) == 10
+    finally:
+        XmlHandler.delay = 0
+        server.shutdown()
+
+
+# when run standalone
+if __name__ == "__main__":
+    test_timings_dont_count_the_wait_for_a_host_slot()
+    test_probes_are_replayed_through_owslib()
+    test_probes_wait_for_a_host_slot_in_the_event_loop()